@@ -0,0 +1,232 @@
+import os
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Callable
+
+
+ACKNOWLEDGEMENT_RESPONSE = "Спасибо за вопрос! Сейчас много обращений — отвечу чуть позже."
+OVERLOADED_RESPONSE = "Извините, сейчас слишком много обращений. Пожалуйста, повторите вопрос через несколько минут."
+
+
+class AdmissionClass:
+    """Класс запросов с ограничением одновременных обработок и очереди ожидания"""
+
+    def __init__(self, name: str, concurrency: int, queue_limit: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        self._async_semaphore: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.stats = {'admitted': 0, 'queued': 0, 'shed': 0}
+
+    def _enter_queue(self) -> bool:
+        with self._lock:
+            if self.waiting >= self.queue_limit:
+                self.stats['shed'] += 1
+                return False
+            self.waiting += 1
+            self.stats['queued'] += 1
+            return True
+
+    def _leave_queue(self, admitted: bool):
+        with self._lock:
+            self.waiting -= 1
+            if admitted:
+                self.in_flight += 1
+                self.stats['admitted'] += 1
+            else:
+                self.stats['shed'] += 1
+
+    def _admit_immediately(self, acquired: bool) -> bool:
+        if acquired:
+            with self._lock:
+                self.in_flight += 1
+                self.stats['admitted'] += 1
+        return acquired
+
+    def try_acquire(self) -> bool:
+        """Захват слота без ожидания и без учета в очереди (для опрашивающих диспетчеров)"""
+        return self._admit_immediately(self._semaphore.acquire(blocking=False))
+
+    def acquire(self, timeout: float) -> bool:
+        """Захват слота с ожиданием не дольше timeout"""
+        if self._admit_immediately(self._semaphore.acquire(blocking=False)):
+            return True
+        if not self._enter_queue():
+            return False
+        admitted = self._semaphore.acquire(timeout=timeout)
+        self._leave_queue(admitted)
+        return admitted
+
+    def acquire_blocking(self):
+        """Захват слота без ограничения очереди (для отложенной обработки)"""
+        self._semaphore.acquire()
+        self._admit_immediately(True)
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._semaphore.release()
+
+    async def aacquire(self, timeout: float) -> bool:
+        """Асинхронный захват слота (для обработчиков в цикле событий)"""
+        if self._async_semaphore is None:
+            self._async_semaphore = asyncio.Semaphore(self.concurrency)
+        if not self._async_semaphore.locked():
+            await self._async_semaphore.acquire()
+            return self._admit_immediately(True)
+        if not self._enter_queue():
+            return False
+        try:
+            await asyncio.wait_for(self._async_semaphore.acquire(), timeout)
+            admitted = True
+        except asyncio.TimeoutError:
+            admitted = False
+        self._leave_queue(admitted)
+        return admitted
+
+    async def aacquire_blocking(self):
+        if self._async_semaphore is None:
+            self._async_semaphore = asyncio.Semaphore(self.concurrency)
+        await self._async_semaphore.acquire()
+        self._admit_immediately(True)
+
+    def arelease(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._async_semaphore.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'concurrency': self.concurrency,
+                'queue_limit': self.queue_limit,
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                **self.stats,
+            }
+
+
+class AdmissionController:
+    """Контроль допуска сообщений по ожидаемой стоимости обработки
+
+    Дешевые сообщения (совпадение с категориями базы знаний) и дорогие
+    (вероятный вызов YandexGPT) ограничиваются раздельно, поэтому всплеск
+    запросов к LLM не задерживает быстрые ответы. Если слот не освободился
+    за целевое время, пользователь сразу получает подтверждение, а сообщение
+    обрабатывается отложенно.
+    """
+
+    def __init__(self):
+        self.latency_target = float(os.environ.get('ADMISSION_LATENCY_TARGET', '5'))
+        self.classes = {
+            'kb': AdmissionClass(
+                'kb',
+                int(os.environ.get('ADMISSION_KB_CONCURRENCY', '32')),
+                int(os.environ.get('ADMISSION_KB_QUEUE', '128'))
+            ),
+            'llm': AdmissionClass(
+                'llm',
+                int(os.environ.get('ADMISSION_LLM_CONCURRENCY', '8')),
+                int(os.environ.get('ADMISSION_LLM_QUEUE', '32'))
+            ),
+        }
+
+        self.deferred_limit = int(os.environ.get('ADMISSION_DEFERRED_LIMIT', '500'))
+        self._deferred_executor: Optional[ThreadPoolExecutor] = None
+        self._deferred_lock = threading.Lock()
+        self.deferred_pending = 0
+        self.deferred_rejected = 0
+        self._deferred_tasks = set()
+
+    def classify(self, classification: Dict[str, Any]) -> str:
+        """Оценка стоимости сообщения по результату message_classifier без обращения к БД и LLM"""
+        if classification['category'] or classification['response_ids']:
+            return 'kb'
+        return 'llm'
+
+    def acquire(self, cost_class: str, timeout: Optional[float] = None) -> bool:
+        """Захват слота класса; timeout — остаток общего бюджета ожидания (по умолчанию latency_target)"""
+        return self.classes[cost_class].acquire(self.latency_target if timeout is None else timeout)
+
+    def release(self, cost_class: str):
+        self.classes[cost_class].release()
+
+    async def aacquire(self, cost_class: str, timeout: Optional[float] = None) -> bool:
+        return await self.classes[cost_class].aacquire(self.latency_target if timeout is None else timeout)
+
+    def arelease(self, cost_class: str):
+        self.classes[cost_class].arelease()
+
+    def _reserve_deferred(self) -> bool:
+        with self._deferred_lock:
+            if self.deferred_pending >= self.deferred_limit:
+                self.deferred_rejected += 1
+                return False
+            self.deferred_pending += 1
+            return True
+
+    def _finish_deferred(self):
+        with self._deferred_lock:
+            self.deferred_pending -= 1
+
+    def defer(self, func: Callable[[], Any]) -> bool:
+        """Отложенная обработка в фоновом пуле; False, если очередь переполнена"""
+        if not self._reserve_deferred():
+            return False
+
+        if self._deferred_executor is None:
+            with self._deferred_lock:
+                if self._deferred_executor is None:
+                    self._deferred_executor = ThreadPoolExecutor(
+                        max_workers=int(os.environ.get('ADMISSION_DEFERRED_WORKERS', '4')),
+                        thread_name_prefix='deferred-message'
+                    )
+
+        def run():
+            try:
+                func()
+            except Exception as e:
+                logging.error(f"Error in deferred message processing: {str(e)}")
+            finally:
+                self._finish_deferred()
+
+        self._deferred_executor.submit(run)
+        return True
+
+    def adefer(self, coroutine_factory: Callable[[], Any]) -> bool:
+        """Отложенная обработка задачей в цикле событий"""
+        if not self._reserve_deferred():
+            return False
+
+        async def run():
+            try:
+                await coroutine_factory()
+            except Exception as e:
+                logging.error(f"Error in deferred message processing: {str(e)}")
+            finally:
+                self._finish_deferred()
+
+        # Ссылка на задачу нужна, чтобы ее не собрал сборщик мусора
+        task = asyncio.get_running_loop().create_task(run())
+        self._deferred_tasks.add(task)
+        task.add_done_callback(self._deferred_tasks.discard)
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._deferred_lock:
+            deferred = {'pending': self.deferred_pending, 'rejected': self.deferred_rejected, 'limit': self.deferred_limit}
+        return {
+            'latency_target': self.latency_target,
+            'classes': {name: admission_class.get_stats() for name, admission_class in self.classes.items()},
+            'deferred': deferred,
+        }
+
+
+admission_controller = AdmissionController()
@@ -0,0 +1,61 @@
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from ttl_cache import TTLCache
+
+
+# Готовый ответ: ('article' | 'response', id источника, текст ответа)
+PreparedAnswer = Tuple[str, int, str]
+
+
+def cache_key(text: str, portal_id: Optional[int]) -> Tuple[Optional[int], str]:
+    """Ключ вопроса: портал и текст без учета регистра и лишних пробелов"""
+    return portal_id, ' '.join(text.lower().split())
+
+
+class PreparedAnswerCache:
+    """Кэш готовых ответов: статья базы знаний или предопределенный ответ
+
+    Закэшированный ответ избавляет от поиска по базе знаний и триггерам;
+    отсутствие готового ответа кэшируется на меньший срок. Кэш свой у
+    каждого процесса: изменения базы знаний очищают его в текущем
+    процессе, остальные увидят их не позже ANSWER_CACHE_TTL.
+    """
+
+    def __init__(self):
+        self.ttl = float(os.environ.get('ANSWER_CACHE_TTL', '300'))
+        self.cache = TTLCache(
+            maxsize=int(os.environ.get('ANSWER_CACHE_SIZE', '10000')),
+            ttl=self.ttl,
+            stale_ttl=0,
+            negative_ttl=float(os.environ.get('ANSWER_CACHE_NEGATIVE_TTL', '60'))
+        )
+        self.stats = {'warmed': 0, 'invalidations': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def lookup(self, text: str, portal_id: Optional[int]) -> Tuple[bool, Optional[PreparedAnswer]]:
+        if not self.enabled:
+            return False, None
+        found, answer, _ = self.cache.lookup(cache_key(text, portal_id))
+        return found, answer
+
+    def store(self, text: str, portal_id: Optional[int], answer: Optional[PreparedAnswer], warmed: bool = False):
+        if not self.enabled:
+            return
+        self.cache.set(cache_key(text, portal_id), answer)
+        if warmed:
+            self.stats['warmed'] += 1
+
+    def clear(self):
+        """Сброс после изменения статей или предопределенных ответов"""
+        self.cache.clear()
+        self.stats['invalidations'] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'enabled': self.enabled, 'ttl': self.ttl, **self.cache.get_stats(), **self.stats}
+
+
+answer_cache = PreparedAnswerCache()
@@ -1,41 +1,85 @@
 import os
-import logging
+import time
 
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
-from werkzeug.middleware.proxy_fix import ProxyFix
+_import_started = time.perf_counter()
+
+from flask import Flask  # noqa: E402
+from flask_sqlalchemy import SQLAlchemy  # noqa: E402
+from sqlalchemy.orm import DeclarativeBase  # noqa: E402
+from werkzeug.middleware.proxy_fix import ProxyFix  # noqa: E402
+
+from logging_setup import logging_pipeline  # noqa: E402
+from startup import startup_report  # noqa: E402
+from db_routing import replica_router, RoutingSession  # noqa: E402
+
+startup_report.mark_import_started(_import_started)
 
 
 class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
 
 # create the app
 app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
-# configure logging
-logging.basicConfig(level=logging.DEBUG)
 
-# configure the database
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+def create_app():
+    """Фабрика приложения
+
+    Настраивает приложение и подключает маршруты без обращения к базе данных:
+    схема создается отдельным шагом (flask migrate), клиенты создаются лениво.
+    """
+    if app.extensions.get('app_factory_ready'):
+        return app
+
+    # configure logging: записи уходят в очередь и пишутся фоновым потоком
+    with startup_report.phase('logging'):
+        logging_pipeline.configure()
+
+    with startup_report.phase('config'):
+        app.secret_key = os.environ.get("SESSION_SECRET")
+
+        # configure the database
+        app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            "pool_recycle": 300,
+            "pool_pre_ping": True,
+        }
+
+        # реплика для чтения подключается отдельным bind (DATABASE_REPLICA_URL)
+        replica_router.configure(app)
+
+        # initialize the app with the extension
+        db.init_app(app)
+        replica_router.init_app(app, db)
+
+    with startup_report.phase('extensions'):
+        # профилирование SQL-запросов в рамках HTTP-запроса
+        from query_profiler import query_profiler
+        query_profiler.init_app(app)
+        # единый классификатор сообщений перечитывает триггеры ответов из БД
+        from message_classifier import message_classifier
+        message_classifier.init_app(app)
+        # реестр порталов Битрикс24 перечитывает таблицу Portal
+        from portals import portal_registry
+        portal_registry.init_app(app)
+        startup_report.init_app(app)
 
-# initialize the app with the extension
-db.init_app(app)
+    with startup_report.phase('routes'):
+        import models  # noqa: F401
+        import routes  # noqa: F401
+        import commands  # noqa: F401
 
-with app.app_context():
-    # Import models to ensure tables are created
-    import models  # noqa: F401
-    
-    db.create_all()
+    # Совместимость с окружениями без отдельного шага миграции
+    if os.environ.get('DB_AUTO_MIGRATE', 'false').lower() == 'true':
+        with startup_report.phase('migrate'):
+            from schema import migrate_schema
+            with app.app_context():
+                migrate_schema()
 
-# Import routes after app creation
-from routes import *  # noqa: F401, E402
+    app.extensions['app_factory_ready'] = True
+    startup_report.mark_ready()
+    return app
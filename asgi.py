@@ -0,0 +1,236 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import anyio
+from a2wsgi import WSGIMiddleware
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from app import create_app, db
+from http_pool import close_async_client
+from startup import LazyService
+
+flask_app = create_app()
+
+import routes  # noqa: E402
+from routes_bitrix import router as bitrix_router  # noqa: E402
+from models import Conversation  # noqa: E402
+from outbox import enqueue_message  # noqa: E402
+from admission import admission_controller, ACKNOWLEDGEMENT_RESPONSE, OVERLOADED_RESPONSE  # noqa: E402
+from reply_pipeline import keep_typing, with_deadline, reply_settings  # noqa: E402
+from message_classifier import message_classifier  # noqa: E402
+from portals import portal_registry, UnknownPortalError  # noqa: E402
+from warmup import cache_warmer  # noqa: E402
+from chat_affinity import chat_affinity  # noqa: E402
+
+
+# Пул потоков только для работы с БД; размер согласован с пулом соединений
+db_limiter = anyio.CapacityLimiter(int(os.environ.get('DB_THREADS', '10')))
+
+
+async def run_db(func, *args):
+    """Выполнение синхронной работы с БД в пуле потоков внутри контекста приложения"""
+    def call():
+        with flask_app.app_context():
+            return func(*args)
+    return await anyio.to_thread.run_sync(call, limiter=db_limiter)
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    LazyService.warm_all()
+    await run_db(message_classifier.reload)
+    # Сервер начинает принимать запросы после прогрева (в пределах WARMUP_BUDGET_SECONDS)
+    await run_db(cache_warmer.run)
+    if os.environ.get('OUTBOX_DISPATCHER', 'inprocess') == 'inprocess':
+        routes.outbox_dispatcher.start_background(flask_app)
+    if chat_affinity.enabled:
+        chat_affinity.start_background(flask_app)
+    yield
+    if chat_affinity.enabled:
+        await anyio.to_thread.run_sync(chat_affinity.stop, flask_app)
+    routes.outbox_dispatcher.stop()
+    await close_async_client()
+
+
+application = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+application.include_router(bitrix_router)
+
+
+def _store_user_message(incoming):
+    return routes.store_user_message(incoming).id
+
+
+def _conversation_context(conversation_id):
+    return routes.get_conversation_context(db.session.get(Conversation, conversation_id))
+
+
+def _enqueue_incoming(incoming, cost_class):
+    conversation_id = routes.store_user_message(incoming).id
+    chat_affinity.enqueue(incoming, conversation_id, cost_class)
+    db.session.commit()
+
+
+def _enqueue_reply(chat_id, text, portal_id=None):
+    enqueue_message(chat_id, text, portal_id)
+    db.session.commit()
+
+
+async def prepare_response(incoming, conversation_id):
+    """Поиск готового ответа, затем генерация через YandexGPT"""
+    try:
+        bot_response = await run_db(
+            routes.find_prepared_response, incoming['text'], incoming.get('classification'), incoming.get('portal_id')
+        )
+        if bot_response:
+            return bot_response
+        context = await run_db(_conversation_context, conversation_id)
+        # Предохранитель проверяется для модели, которую выберет план ответа
+        if not routes.gpt_client.is_available(incoming['text'], context):
+            bot_response = await run_db(routes.get_fallback_response, incoming['text'])
+        else:
+            bot_response = await routes.gpt_client.agenerate_response(incoming['text'], context)
+        return bot_response
+    except Exception as e:
+        logging.error(f"Error processing message: {str(e)}")
+        return routes.PROCESSING_ERROR_RESPONSE
+
+
+async def answer_message(incoming, conversation_id):
+    """Подготовка ответа: внешний I/O в цикле событий, БД в пуле потоков
+
+    Статус «печатает» обновляется параллельно с обработкой; если ответ
+    не готов к сроку, сначала уходит промежуточное сообщение.
+    """
+    chat_id = incoming['chat_id']
+    portal_id = incoming.get('portal_id')
+
+    async def send_interim():
+        interim = routes.get_interim_response(incoming['text'])
+        await run_db(_enqueue_reply, chat_id, interim, portal_id)
+
+    portal = portal_registry.require(portal_id, refresh=False)
+    typing_task = None
+    if reply_settings.typing_enabled:
+        typing_task = asyncio.create_task(
+            keep_typing(portal.client.aset_bot_typing, chat_id, reply_settings.typing_refresh)
+        )
+
+    start_time = datetime.utcnow()
+    try:
+        bot_response = await with_deadline(
+            prepare_response(incoming, conversation_id),
+            reply_settings.interim_deadline,
+            send_interim
+        )
+    finally:
+        if typing_task is not None:
+            typing_task.cancel()
+    response_time = (datetime.utcnow() - start_time).total_seconds()
+
+    # Отправку выполняет диспетчер outbox вне пути запроса
+    await run_db(routes.store_bot_message, conversation_id, incoming['chat_id'], bot_response, response_time, portal_id)
+
+
+async def defer_message(incoming, conversation_id, cost_class):
+    """Немедленное подтверждение пользователю и отложенная обработка сообщения"""
+    portal_id = incoming.get('portal_id')
+    portal = portal_registry.require(portal_id, refresh=False)
+    await run_db(_enqueue_reply, incoming['chat_id'], ACKNOWLEDGEMENT_RESPONSE, portal_id)
+
+    async def job():
+        try:
+            admission_class = admission_controller.classes[cost_class]
+            await admission_class.aacquire_blocking()
+            try:
+                await answer_message(incoming, conversation_id)
+            finally:
+                admission_class.arelease()
+        finally:
+            portal.finish_deferred()
+
+    # Квота портала ограничивает его долю общей очереди отложенных сообщений
+    accepted = portal.reserve_deferred()
+    if accepted and not admission_controller.adefer(job):
+        portal.finish_deferred()
+        accepted = False
+
+    if not accepted:
+        logging.warning("Deferred queue is full, message in chat %s was not processed", incoming['chat_id'])
+        await run_db(_enqueue_reply, incoming['chat_id'], OVERLOADED_RESPONSE, portal_id)
+
+
+@application.post('/webhook/bitrix')
+async def bitrix_webhook(request: Request):
+    """Веб-хук Битрикс24: внешний I/O в цикле событий, БД в пуле потоков"""
+    try:
+        data = await request.json()
+    except Exception:
+        data = None
+
+    if not data:
+        logging.error("No data received in webhook")
+        return JSONResponse({'error': 'No data received'}, status_code=400)
+
+    try:
+        routes.log_webhook_payload(data)
+
+        # Реестр порталов периодически перечитывает БД, поэтому определение портала — в пуле потоков
+        try:
+            portal = await run_db(portal_registry.resolve, data)
+        except UnknownPortalError as e:
+            logging.warning(f"Webhook from unknown portal rejected: {str(e)}")
+            return JSONResponse({'error': 'Unknown portal'}, status_code=403)
+
+        incoming = routes.parse_webhook_message(data, portal.portal_id)
+        if not incoming:
+            logging.error("Missing required fields in webhook data")
+            return JSONResponse({'error': 'Missing required fields'}, status_code=400)
+
+        cost_class = admission_controller.classify(incoming['classification'])
+
+        # Сообщение обработает воркер, владеющий партицией чата
+        if chat_affinity.enabled:
+            await run_db(_enqueue_incoming, incoming, cost_class)
+            return JSONResponse({'status': 'queued'}, status_code=202)
+
+        conversation_id = await run_db(_store_user_message, incoming)
+
+        # Сначала квота портала: всплеск на одном портале не занимает общие слоты.
+        # Обе квоты ждут в пределах одного latency_target, а не по очереди
+        deadline = time.monotonic() + admission_controller.latency_target
+        if not await portal.admission.aacquire(admission_controller.latency_target):
+            await defer_message(incoming, conversation_id, cost_class)
+            return JSONResponse({'status': 'accepted'}, status_code=202)
+
+        try:
+            # При перегрузке отвечаем подтверждением и обрабатываем сообщение отложенно
+            if not await admission_controller.aacquire(cost_class, max(0.0, deadline - time.monotonic())):
+                await defer_message(incoming, conversation_id, cost_class)
+                return JSONResponse({'status': 'accepted'}, status_code=202)
+
+            try:
+                await answer_message(incoming, conversation_id)
+            finally:
+                admission_controller.arelease(cost_class)
+        finally:
+            portal.admission.arelease()
+
+        return JSONResponse({'status': 'success'}, status_code=200)
+
+    except UnknownPortalError as e:
+        # Портал отключили между приемом события и обработкой
+        logging.warning(f"Webhook for portal that is no longer served: {str(e)}")
+        return JSONResponse({'error': 'Unknown portal'}, status_code=403)
+
+    except Exception as e:
+        logging.error(f"Error processing webhook: {str(e)}")
+        return JSONResponse({'error': 'Internal server error'}, status_code=500)
+
+
+# Остальные маршруты (дашборд, админка, API) обслуживает Flask в пуле потоков
+application.mount('/', WSGIMiddleware(flask_app, workers=int(os.environ.get('WSGI_THREADS', '10'))))
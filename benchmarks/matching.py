@@ -0,0 +1,324 @@
+"""Масштабный бенчмарк поиска по базе знаний и сопоставления триггеров
+
+Для каждого размера корпуса генерируются синтетические русскоязычные статьи,
+предопределенные ответы и словарь категорий, затем для каждого пути
+сопоставления измеряются время построения индекса, занимаемая память
+и задержка на запрос. Бенчмарк работает на отдельной временной SQLite-базе.
+
+    python -m benchmarks.matching --sizes 6,100,1000,10000 --queries 500 -o results.json
+
+Новый поисковый движок добавляется классом с методами build(corpus)
+и query(text) и передается через --engine module:Class.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import importlib
+import tracemalloc
+from typing import Dict, Any, List, Optional
+
+# Отдельная база и тихие логи до импорта приложения
+_workdir = tempfile.mkdtemp(prefix='matching-bench-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_workdir, 'bench.db')}"
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('SQL_PROFILING_ENABLED', 'false')
+os.environ['DATABASE_REPLICA_URL'] = ''
+os.environ['LEXICON_RELOAD_SECONDS'] = '1000000'
+
+from sqlalchemy import delete, insert  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from models import KnowledgeBaseArticle, BotResponse  # noqa: E402
+from lexicons import CATEGORY_KEYWORDS, POSITIVE_WORDS, NEGATIVE_WORDS, FORBIDDEN_WORDS  # noqa: E402
+from message_classifier import CompiledLexicon, message_classifier  # noqa: E402
+
+
+# ==== Синтетический корпус ====
+
+STEMS = [
+    'отпуск', 'больничн', 'зарплат', 'преми', 'справк', 'документ', 'график', 'смен',
+    'командировк', 'обучени', 'курс', 'тренинг', 'ноутбук', 'компьютер', 'пропуск',
+    'парковк', 'столов', 'руководител', 'сотрудник', 'договор', 'увольнени', 'перевод',
+    'компенсаци', 'льгот', 'страховк', 'отгул', 'переработк', 'декрет', 'пособи', 'налог',
+    'бухгалтери', 'заявлени', 'согласовани', 'оформлени', 'выплат', 'расчет', 'аванс',
+]
+ENDINGS = ['', 'а', 'у', 'ом', 'е', 'ы', 'ов', 'ам', 'ах', 'ой', 'и', 'ия', 'ию', 'ий']
+SUFFIX_LETTERS = 'бвгдклмнпрстхц'
+FILLER = ['как', 'где', 'когда', 'нужно', 'можно', 'ли', 'для', 'при', 'на', 'по', 'в', 'с', 'мне', 'это']
+
+
+class SyntheticCorpus:
+    """Статьи, триггеры и категории заданного размера с воспроизводимым seed"""
+
+    def __init__(self, size: int, seed: int = 42):
+        self.size = size
+        self.random = random.Random(seed + size)
+        self.vocabulary = self._vocabulary(max(200, size // 5))
+        self.categories = self._categories(max(10, size // 100))
+        self.articles = [self._article(index) for index in range(size)]
+        self.triggers = [self._trigger(index) for index in range(max(5, size // 10))]
+
+    def _vocabulary(self, count: int) -> List[str]:
+        words = set()
+        while len(words) < count:
+            stem = self.random.choice(STEMS)
+            suffix = '' if len(words) < len(STEMS) else ''.join(self.random.choice(SUFFIX_LETTERS) for _ in range(3))
+            words.add(stem + suffix)
+        return sorted(words)
+
+    def word(self) -> str:
+        return self.random.choice(self.vocabulary) + self.random.choice(ENDINGS)
+
+    def phrase(self, words: int) -> str:
+        parts = [self.word() if self.random.random() < 0.6 else self.random.choice(FILLER) for _ in range(words)]
+        return ' '.join(parts)
+
+    def _categories(self, count: int) -> Dict[str, List[str]]:
+        categories = {name: list(keywords) for name, keywords in CATEGORY_KEYWORDS.items()}
+        for index in range(len(categories), count):
+            categories[f"категория {index}"] = [self.random.choice(self.vocabulary) for _ in range(5)]
+        return categories
+
+    def _article(self, index: int) -> Dict[str, Any]:
+        return {
+            'title': f"{self.phrase(4).capitalize()} №{index}",
+            'content': self.phrase(self.random.randint(50, 150)),
+            'category': self.random.choice(list(self.categories)),
+            'tags': ', '.join(self.word() for _ in range(3)),
+            'is_active': True,
+            'usage_count': 0,
+        }
+
+    def _trigger(self, index: int) -> Dict[str, Any]:
+        return {
+            'trigger_keywords': ', '.join(self.word() for _ in range(self.random.randint(1, 4))),
+            'response_text': f"Ответ {index}: {self.phrase(20)}",
+            'category': self.random.choice(list(self.categories)),
+            'priority': self.random.randint(0, 10),
+            'is_active': True,
+            'usage_count': 0,
+        }
+
+    def queries(self, count: int) -> List[str]:
+        """Смесь запросов: заголовки, слова из словаря, промахи; частые вопросы повторяются"""
+        distinct = []
+        for _ in range(max(10, count // 4)):
+            kind = self.random.random()
+            if kind < 0.2 and self.articles:
+                title = self.random.choice(self.articles)['title']
+                distinct.append(' '.join(title.split()[:3]))
+            elif kind < 0.8:
+                distinct.append(self.phrase(self.random.randint(3, 12)))
+            else:
+                distinct.append('вопрос не по теме ' + str(self.random.randint(0, 10 ** 6)))
+        # Распределение Ципфа: несколько вопросов задают намного чаще остальных
+        weights = [1.0 / (rank + 1) for rank in range(len(distinct))]
+        return self.random.choices(distinct, weights=weights, k=count)
+
+
+# ==== Пути сопоставления ====
+
+class LegacyCategoryEngine:
+    """Прежний _find_relevant_category: вложенный цикл по подстрокам"""
+    name = 'category_substring'
+
+    def build(self, corpus: SyntheticCorpus):
+        self.categories = corpus.categories
+
+    def query(self, text: str) -> Optional[str]:
+        text = text.lower()
+        for category, keywords in self.categories.items():
+            for keyword in keywords:
+                if keyword in text:
+                    return category
+        return None
+
+
+class ClassifierCategoryEngine:
+    """Категория из единого классификатора (один проход по основам слов)"""
+    name = 'category_classifier'
+
+    def build(self, corpus: SyntheticCorpus):
+        self.lexicon = CompiledLexicon(corpus.categories, POSITIVE_WORDS, NEGATIVE_WORDS, FORBIDDEN_WORDS, [])
+
+    def query(self, text: str) -> Optional[str]:
+        return self.lexicon.classify(text)['category']
+
+
+class LegacyTriggerEngine:
+    """Прежний get_predefined_response: все активные ответы из БД и перебор подстрок"""
+    name = 'triggers_scan'
+
+    def build(self, corpus: SyntheticCorpus):
+        pass
+
+    def query(self, text: str) -> Optional[str]:
+        text = text.lower()
+        responses = BotResponse.query.filter_by(is_active=True).order_by(BotResponse.priority.desc()).all()
+        for response in responses:
+            keywords = [keyword.strip().lower() for keyword in response.trigger_keywords.split(',')]
+            if any(keyword in text for keyword in keywords):
+                return response.response_text
+        return None
+
+
+class ClassifierTriggerEngine:
+    """Текущий find_predefined_response: кандидаты из классификатора, загрузка одного ответа"""
+    name = 'triggers_classifier'
+
+    def build(self, corpus: SyntheticCorpus):
+        message_classifier.reload(force=True)
+
+    def query(self, text: str) -> Optional[str]:
+        import routes
+        found = routes.find_predefined_response(message_classifier.classify(text))
+        return found[1] if found else None
+
+
+class KnowledgeBaseSearchEngine:
+    """KnowledgeBaseManager.search_knowledge_base на SQLite"""
+    name = 'kb_search'
+
+    def build(self, corpus: SyntheticCorpus):
+        import routes
+        self.manager = routes.kb_manager
+
+    def query(self, text: str) -> Optional[str]:
+        return self.manager.search_knowledge_base(text)
+
+
+DEFAULT_ENGINES = [
+    KnowledgeBaseSearchEngine,
+    LegacyCategoryEngine,
+    ClassifierCategoryEngine,
+    LegacyTriggerEngine,
+    ClassifierTriggerEngine,
+]
+
+
+def load_engine(spec: str):
+    module_name, class_name = spec.split(':', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+# ==== Измерения ====
+
+def load_corpus(corpus: SyntheticCorpus) -> float:
+    """Загрузка корпуса в БД; возвращает время в секундах"""
+    started = time.perf_counter()
+    db.session.execute(delete(KnowledgeBaseArticle))
+    db.session.execute(delete(BotResponse))
+    if corpus.articles:
+        db.session.execute(insert(KnowledgeBaseArticle), corpus.articles)
+    if corpus.triggers:
+        db.session.execute(insert(BotResponse), corpus.triggers)
+    db.session.commit()
+    return time.perf_counter() - started
+
+
+def percentile(samples: List[float], q: float) -> float:
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+
+def measure(engine, corpus: SyntheticCorpus, queries: List[str], warmup: int) -> Dict[str, Any]:
+    tracemalloc.start()
+    started = time.perf_counter()
+    engine.build(corpus)
+    build_seconds = time.perf_counter() - started
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for text in queries[:warmup]:
+        engine.query(text)
+
+    latencies = []
+    hits = 0
+    for text in queries:
+        started = time.perf_counter()
+        result = engine.query(text)
+        latencies.append(time.perf_counter() - started)
+        hits += result is not None
+    latencies.sort()
+    total = sum(latencies)
+
+    return {
+        'engine': engine.name,
+        'size': corpus.size,
+        'queries': len(queries),
+        'build_ms': round(build_seconds * 1000, 2),
+        'memory_kb': round(retained / 1024, 1),
+        'memory_peak_kb': round(peak / 1024, 1),
+        'hit_ratio': round(hits / len(queries), 4) if queries else 0.0,
+        'mean_us': round(total / len(latencies) * 1e6, 1) if latencies else 0.0,
+        'p50_us': round(percentile(latencies, 0.5) * 1e6, 1),
+        'p95_us': round(percentile(latencies, 0.95) * 1e6, 1),
+        'p99_us': round(percentile(latencies, 0.99) * 1e6, 1),
+        'qps': round(len(latencies) / total, 1) if total else 0.0,
+    }
+
+
+def render_table(results: List[Dict[str, Any]]) -> str:
+    columns = ['engine', 'size', 'build_ms', 'memory_kb', 'hit_ratio', 'p50_us', 'p95_us', 'p99_us', 'qps']
+    rows = [[str(result[column]) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[index]) for row in rows)) for index, column in enumerate(columns)]
+    lines = [
+        ' | '.join(column.ljust(width) for column, width in zip(columns, widths)),
+        '-+-'.join('-' * width for width in widths),
+    ]
+    lines += [' | '.join(value.ljust(width) for value, width in zip(row, widths)) for row in rows]
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска по базе знаний и триггеров")
+    parser.add_argument('--sizes', default='6,100,1000,10000', help='Размеры корпуса через запятую')
+    parser.add_argument('--queries', type=int, default=500, help='Число запросов на размер')
+    parser.add_argument('--warmup', type=int, default=20, help='Запросов на прогрев перед замером')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--engine', action='append', default=[], help='Дополнительный движок module:Class')
+    parser.add_argument('--only', default='', help='Только перечисленные движки (по name) через запятую')
+    parser.add_argument('--output', '-o', default=None, help='Файл для JSON-результатов')
+    args = parser.parse_args(argv)
+
+    engines = DEFAULT_ENGINES + [load_engine(spec) for spec in args.engine]
+    if args.only:
+        selected = set(args.only.split(','))
+        engines = [engine for engine in engines if engine.name in selected]
+
+    app = create_app()
+    results = []
+    with app.app_context():
+        from schema import migrate_schema
+        migrate_schema()
+
+        for size in [int(value) for value in args.sizes.split(',')]:
+            corpus = SyntheticCorpus(size, args.seed)
+            queries = corpus.queries(args.queries)
+            load_seconds = load_corpus(corpus)
+            print(f"size={size}: corpus loaded in {load_seconds * 1000:.0f} ms", file=sys.stderr)
+
+            for engine_class in engines:
+                result = measure(engine_class(), corpus, queries, args.warmup)
+                result['corpus_load_ms'] = round(load_seconds * 1000, 2)
+                results.append(result)
+                print(f"  {result['engine']}: p50 {result['p50_us']} us, p95 {result['p95_us']} us", file=sys.stderr)
+
+    report = {
+        'python': sys.version.split()[0],
+        'database': db.engine.dialect.name,
+        'queries_per_size': args.queries,
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, ensure_ascii=False, indent=2)
+    print(render_table(results))
+
+
+if __name__ == '__main__':
+    main()
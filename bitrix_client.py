@@ -1,39 +1,69 @@
 import os
 import requests
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 
 
 class BitrixClient:
     """Клиент для работы с Битрикс24 REST API"""
     
-    def __init__(self):
-        self.webhook_url = os.environ.get('BITRIX_WEBHOOK_URL', '')
-        self.access_token = os.environ.get('BITRIX_ACCESS_TOKEN', '')
-        self.base_url = os.environ.get('BITRIX_BASE_URL', '')
+    def __init__(self, webhook_url: Optional[str] = None, access_token: Optional[str] = None,
+                 base_url: Optional[str] = None, rate_limiter=None, pool_name: str = 'default'):
+        # Без аргументов используется портал из переменных окружения
+        self.webhook_url = (webhook_url if webhook_url is not None else os.environ.get('BITRIX_WEBHOOK_URL', '')).rstrip('/')
+        self.access_token = access_token if access_token is not None else os.environ.get('BITRIX_ACCESS_TOKEN', '')
+        self.base_url = base_url if base_url is not None else os.environ.get('BITRIX_BASE_URL', '')
+        self.rate_limiter = rate_limiter
+        self.pool_name = pool_name
+        self.pool_size = int(os.environ.get('BITRIX_POOL_SIZE', '10'))
+        
+        # Собственный пул соединений клиента: у каждого портала свой
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         
         if not any([self.webhook_url, self.access_token]):
             logging.warning("Bitrix credentials not found in environment variables")
     
+    def _method_url(self, method: str) -> str:
+        """URL метода REST API"""
+        if self.webhook_url:
+            return f"{self.webhook_url}/{method}"
+        return f"{self.base_url}/rest/{self.access_token}/{method}"
+    
+    def _post(self, url: str, data: Dict[str, Any], timeout: float) -> requests.Response:
+        """POST через пул клиента с ожиданием лимита частоты портала"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return self.session.post(url, json=data, timeout=timeout)
+    
+    def _async_client(self, http_client):
+        if http_client is not None:
+            return http_client
+        from http_pool import get_async_client
+        return get_async_client(self.pool_name, self.pool_size if self.pool_name != 'default' else None)
+    
+    def throttle_delay(self) -> float:
+        """Сколько секунд ждать до следующего разрешенного запроса к порталу"""
+        return self.rate_limiter.delay() if self.rate_limiter is not None else 0.0
+    
     def send_message(self, chat_id: str, message: str) -> bool:
         """Отправка сообщения в чат Битрикс24"""
         try:
-            if self.webhook_url:
-                url = f"{self.webhook_url}/im.message.add"
-            else:
-                url = f"{self.base_url}/rest/{self.access_token}/im.message.add"
+            url = self._method_url('im.message.add')
             
             data = {
                 'DIALOG_ID': chat_id,
                 'MESSAGE': message
             }
             
-            response = requests.post(url, json=data, timeout=10)
+            response = self._post(url, data, timeout=10)
             response.raise_for_status()
             
             result = response.json()
             if result.get('result'):
-                logging.info(f"Message sent successfully to chat {chat_id}")
+                logging.info("Message sent successfully to chat %s", chat_id)
                 return True
             else:
                 logging.error(f"Failed to send message: {result.get('error_description', 'Unknown error')}")
@@ -46,19 +76,83 @@ class BitrixClient:
             logging.error(f"Unexpected error sending message: {str(e)}")
             return False
     
+    async def asend_message(self, chat_id: str, message: str, http_client=None) -> bool:
+        """Асинхронная отправка сообщения через пул httpx портала"""
+        import httpx
+        
+        try:
+            http_client = self._async_client(http_client)
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire()
+            
+            data = {
+                'DIALOG_ID': chat_id,
+                'MESSAGE': message
+            }
+            
+            response = await http_client.post(self._method_url('im.message.add'), json=data, timeout=10)
+            response.raise_for_status()
+            
+            result = response.json()
+            if result.get('result'):
+                logging.info("Message sent successfully to chat %s", chat_id)
+                return True
+            else:
+                logging.error(f"Failed to send message: {result.get('error_description', 'Unknown error')}")
+                return False
+                
+        except httpx.HTTPError as e:
+            logging.error(f"Error sending message to Bitrix24: {str(e)}")
+            return False
+        except Exception as e:
+            logging.error(f"Unexpected error sending message: {str(e)}")
+            return False
+    
+    async def asend_bot_message(self, bot_id: str, dialog_id: str, message: str,
+                                client_id: Optional[str] = None, http_client=None) -> bool:
+        """Асинхронная отправка сообщения от имени чат-бота приложения (imbot.message.add)"""
+        import httpx
+        
+        try:
+            http_client = self._async_client(http_client)
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire()
+            
+            data = {
+                'BOT_ID': bot_id,
+                'DIALOG_ID': dialog_id,
+                'MESSAGE': message
+            }
+            if client_id:
+                data['CLIENT_ID'] = client_id
+            
+            response = await http_client.post(self._method_url('imbot.message.add.json'), json=data, timeout=10)
+            response.raise_for_status()
+            
+            result = response.json()
+            if result.get('result'):
+                return True
+            else:
+                logging.error(f"Failed to send bot message: {result.get('error_description', 'Unknown error')}")
+                return False
+                
+        except httpx.HTTPError as e:
+            logging.error(f"Error sending bot message to Bitrix24: {str(e)}")
+            return False
+        except Exception as e:
+            logging.error(f"Unexpected error sending bot message: {str(e)}")
+            return False
+    
     def get_user_info(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Получение информации о пользователе"""
         try:
-            if self.webhook_url:
-                url = f"{self.webhook_url}/user.get"
-            else:
-                url = f"{self.base_url}/rest/{self.access_token}/user.get"
+            url = self._method_url('user.get')
             
             data = {
                 'ID': user_id
             }
             
-            response = requests.post(url, json=data, timeout=10)
+            response = self._post(url, data, timeout=10)
             response.raise_for_status()
             
             result = response.json()
@@ -78,16 +172,13 @@ class BitrixClient:
     def get_chat_info(self, chat_id: str) -> Optional[Dict[str, Any]]:
         """Получение информации о чате"""
         try:
-            if self.webhook_url:
-                url = f"{self.webhook_url}/im.chat.get"
-            else:
-                url = f"{self.base_url}/rest/{self.access_token}/im.chat.get"
+            url = self._method_url('im.chat.get')
             
             data = {
                 'CHAT_ID': chat_id
             }
             
-            response = requests.post(url, json=data, timeout=10)
+            response = self._post(url, data, timeout=10)
             response.raise_for_status()
             
             result = response.json()
@@ -107,16 +198,13 @@ class BitrixClient:
     def set_bot_typing(self, chat_id: str) -> bool:
         """Установка статуса 'печатает' для бота"""
         try:
-            if self.webhook_url:
-                url = f"{self.webhook_url}/im.dialog.writing"
-            else:
-                url = f"{self.base_url}/rest/{self.access_token}/im.dialog.writing"
+            url = self._method_url('im.dialog.writing')
             
             data = {
                 'DIALOG_ID': chat_id
             }
             
-            response = requests.post(url, json=data, timeout=5)
+            response = self._post(url, data, timeout=5)
             response.raise_for_status()
             
             return True
@@ -128,19 +216,41 @@ class BitrixClient:
             logging.error(f"Unexpected error setting typing status: {str(e)}")
             return False
     
+    async def aset_bot_typing(self, chat_id: str, http_client=None) -> bool:
+        """Асинхронная установка статуса 'печатает' для бота"""
+        import httpx
+        
+        try:
+            http_client = self._async_client(http_client)
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire()
+            
+            data = {
+                'DIALOG_ID': chat_id
+            }
+            
+            response = await http_client.post(self._method_url('im.dialog.writing'), json=data, timeout=5)
+            response.raise_for_status()
+            
+            return True
+                
+        except httpx.HTTPError as e:
+            logging.error(f"Error setting typing status: {str(e)}")
+            return False
+        except Exception as e:
+            logging.error(f"Unexpected error setting typing status: {str(e)}")
+            return False
+    
     def get_department_info(self, department_id: str) -> Optional[Dict[str, Any]]:
         """Получение информации о подразделении"""
         try:
-            if self.webhook_url:
-                url = f"{self.webhook_url}/department.get"
-            else:
-                url = f"{self.base_url}/rest/{self.access_token}/department.get"
+            url = self._method_url('department.get')
             
             data = {
                 'ID': department_id
             }
             
-            response = requests.post(url, json=data, timeout=10)
+            response = self._post(url, data, timeout=10)
             response.raise_for_status()
             
             result = response.json()
@@ -157,13 +267,39 @@ class BitrixClient:
             logging.error(f"Unexpected error getting department info: {str(e)}")
             return None
     
+    def list_page(self, method: str, start: int = 0,
+                  params: Optional[Dict[str, Any]] = None) -> Optional[Tuple[List[Dict[str, Any]], Optional[int]]]:
+        """Получение одной страницы списочного метода (user.get, department.get)
+
+        Возвращает записи и позицию следующей страницы (None, если страниц больше нет).
+        """
+        try:
+            url = self._method_url(method)
+            
+            data = dict(params or {})
+            data['start'] = start
+            
+            response = self._post(url, data, timeout=30)
+            response.raise_for_status()
+            
+            result = response.json()
+            if 'result' in result:
+                return result['result'] or [], result.get('next')
+            else:
+                logging.error(f"Failed to list {method}: {result.get('error_description', 'Unknown error')}")
+                return None
+                
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error listing {method} from Bitrix24: {str(e)}")
+            return None
+        except Exception as e:
+            logging.error(f"Unexpected error listing {method}: {str(e)}")
+            return None
+    
     def create_task(self, title: str, description: str, responsible_id: str) -> Optional[str]:
         """Создание задачи в Битрикс24 для эскалации"""
         try:
-            if self.webhook_url:
-                url = f"{self.webhook_url}/tasks.task.add"
-            else:
-                url = f"{self.base_url}/rest/{self.access_token}/tasks.task.add"
+            url = self._method_url('tasks.task.add')
             
             data = {
                 'fields': {
@@ -174,13 +310,13 @@ class BitrixClient:
                 }
             }
             
-            response = requests.post(url, json=data, timeout=10)
+            response = self._post(url, data, timeout=10)
             response.raise_for_status()
             
             result = response.json()
             if result.get('result'):
                 task_id = result['result']['task']['id']
-                logging.info(f"Task created successfully with ID: {task_id}")
+                logging.info("Task created successfully with ID: %s", task_id)
                 return task_id
             else:
                 logging.error(f"Failed to create task: {result.get('error_description', 'Unknown error')}")
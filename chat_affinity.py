@@ -0,0 +1,420 @@
+import os
+import json
+import socket
+import uuid
+import zlib
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, or_, exists, select, update, delete
+from sqlalchemy.orm import aliased
+from app import db
+from models import InboxMessage, AffinityMember, Conversation
+from portals import UnknownPortalError
+
+
+CONTEXT_MESSAGES = 10
+
+
+class LeaseLostError(Exception):
+    """Аренда записи inbox истекла и запись захвачена другим воркером"""
+
+
+def partition_for(dialog_id: str, portal_id: Optional[int], partitions: int) -> int:
+    """Партиция чата: постоянна, пока не меняется CHAT_PARTITIONS"""
+    return zlib.crc32(f"{portal_id or ''}:{dialog_id}".encode('utf-8')) % partitions
+
+
+def rendezvous_owner(partition: int, members: List[str]) -> Optional[str]:
+    """Владелец партиции по наибольшему весу (rendezvous hashing)
+
+    При добавлении или уходе воркера переезжают только партиции,
+    у которых он был или становится владельцем, — примерно 1/N.
+    """
+    def weight(member):
+        return hashlib.sha1(f"{member}:{partition}".encode('utf-8')).digest()
+    return max(members, key=weight) if members else None
+
+
+class ChatAffinityDispatcher:
+    """Обработка сообщений чата одним воркером развертывания
+
+    Веб-хук сохраняет сообщение и ставит его в inbox с номером партиции
+    чата. Живые воркеры отмечаются в таблице AffinityMember, партиции
+    делятся между ними rendezvous-хешированием и перераспределяются,
+    когда число воркеров меняется. Владелец захватывает с арендой первую
+    необработанную запись каждого своего чата, поэтому у чата один
+    писатель и сохраняется порядок, а контекст разговора держится
+    в памяти владельца и не читается из БД на каждое сообщение.
+    Запись захватывается только при свободных слотах портала и класса
+    стоимости (kb/llm) AdmissionController, поэтому всплеск вопросов к LLM
+    не задерживает ответы из базы знаний; вместо отказа при перегрузке
+    сообщение ждет в inbox, а пользователь, ожидающий дольше
+    ADMISSION_LATENCY_TARGET, получает подтверждение.
+    Включается CHAT_AFFINITY=true.
+    """
+
+    def __init__(self):
+        self.enabled = os.environ.get('CHAT_AFFINITY', 'false').lower() == 'true'
+        self.partitions = int(os.environ.get('CHAT_PARTITIONS', '64'))
+        self.threads = int(os.environ.get('CHAT_AFFINITY_THREADS', '8'))
+        self.heartbeat_interval = float(os.environ.get('CHAT_AFFINITY_HEARTBEAT_SECONDS', '5'))
+        self.member_ttl = float(os.environ.get('CHAT_AFFINITY_MEMBER_TTL', '20'))
+        self.lease_seconds = int(os.environ.get('CHAT_AFFINITY_LEASE_SECONDS', '120'))
+        self.max_attempts = int(os.environ.get('CHAT_AFFINITY_MAX_ATTEMPTS', '3'))
+        self.poll_interval = float(os.environ.get('CHAT_AFFINITY_POLL_INTERVAL', '0.5'))
+        self.contexts_per_partition = int(os.environ.get('CHAT_AFFINITY_CONTEXTS', '256'))
+
+        self.worker_id: Optional[str] = None
+        self.members: List[str] = []
+        self.owned: Set[int] = set()
+        self._heartbeat_at: Optional[datetime] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self.in_flight = 0
+        # Контексты разговоров по партициям: при потере партиции сбрасываются целиком
+        self._contexts: Dict[int, 'OrderedDict[int, List[Dict[str, str]]]'] = {}
+        self.stats = {'enqueued': 0, 'processed': 0, 'failed_attempts': 0, 'dead_lettered': 0,
+                      'context_hits': 0, 'context_misses': 0, 'rebalances': 0, 'leases_lost': 0,
+                      'acknowledged': 0}
+
+    # ==== Постановка в очередь ====
+
+    def enqueue(self, incoming: Dict[str, Any], conversation_id: int, cost_class: str = 'llm') -> InboxMessage:
+        """Запись сообщения в inbox (без commit)"""
+        dialog_id = str(incoming['chat_id'])
+        entry = InboxMessage(
+            portal_id=incoming.get('portal_id'),
+            partition_no=partition_for(dialog_id, incoming.get('portal_id'), self.partitions),
+            dialog_id=dialog_id,
+            conversation_id=conversation_id,
+            payload=json.dumps(incoming, ensure_ascii=False),
+            cost_class=cost_class
+        )
+        db.session.add(entry)
+        self.stats['enqueued'] += 1
+        # Своя партиция обрабатывается без ожидания следующего опроса
+        if entry.partition_no in self.owned:
+            self._wake.set()
+        return entry
+
+    # ==== Членство и распределение партиций ====
+
+    def _heartbeat(self, now: datetime):
+        member = db.session.get(AffinityMember, self.worker_id)
+        if member is None:
+            db.session.add(AffinityMember(worker_id=self.worker_id, started_at=now, heartbeat_at=now))
+        else:
+            member.heartbeat_at = now
+        # Записи давно умерших воркеров удаляются любым живым
+        db.session.execute(
+            delete(AffinityMember).where(AffinityMember.heartbeat_at < now - timedelta(seconds=self.member_ttl * 10))
+        )
+        db.session.commit()
+        self._heartbeat_at = now
+
+    def rebalance(self):
+        """Отметка о живости и пересчет своих партиций по списку живых воркеров"""
+        now = datetime.utcnow()
+        if self._heartbeat_at is None or (now - self._heartbeat_at).total_seconds() >= self.heartbeat_interval:
+            self._heartbeat(now)
+
+        members = sorted(db.session.execute(
+            select(AffinityMember.worker_id).where(
+                AffinityMember.heartbeat_at >= now - timedelta(seconds=self.member_ttl)
+            )
+        ).scalars().all())
+        if members == self.members:
+            return
+
+        owned = {partition for partition in range(self.partitions)
+                 if rendezvous_owner(partition, members) == self.worker_id}
+        with self._lock:
+            for partition in self.owned - owned:
+                self._contexts.pop(partition, None)
+            self.owned = owned
+            self.members = members
+        self.stats['rebalances'] += 1
+        logging.info(f"Chat affinity rebalanced: {len(members)} workers, {len(owned)} partitions owned by {self.worker_id}")
+
+    # ==== Захват и обработка ====
+
+    def _claimable_condition(self, now: datetime):
+        return or_(
+            and_(InboxMessage.status == 'pending', InboxMessage.next_attempt_at <= now),
+            and_(InboxMessage.status == 'processing', InboxMessage.locked_until < now)
+        )
+
+    def _acknowledge_waiting(self, entry: InboxMessage, now: datetime):
+        """Подтверждение пользователю, если сообщение ждет слота дольше целевого времени"""
+        from admission import admission_controller, ACKNOWLEDGEMENT_RESPONSE
+        from outbox import enqueue_message
+
+        if entry.acknowledged or (now - entry.created_at).total_seconds() < admission_controller.latency_target:
+            return
+        enqueue_message(entry.dialog_id, ACKNOWLEDGEMENT_RESPONSE, entry.portal_id)
+        entry.acknowledged = True
+        self.stats['acknowledged'] += 1
+
+    def claim_batch(self, limit: int) -> List[Tuple[InboxMessage, Any, Any]]:
+        """Захват первых необработанных сообщений чатов своих партиций
+
+        Возвращает (запись, портал, класс допуска); слоты портала и класса
+        освобождаются после обработки записи.
+        """
+        from portals import portal_registry
+        from admission import admission_controller
+
+        now = datetime.utcnow()
+        earlier = aliased(InboxMessage)
+        candidates = db.session.execute(
+            select(InboxMessage).where(
+                InboxMessage.partition_no.in_(self.owned),
+                self._claimable_condition(now),
+                ~exists().where(
+                    earlier.dialog_id == InboxMessage.dialog_id,
+                    earlier.portal_id.is_not_distinct_from(InboxMessage.portal_id),
+                    earlier.id < InboxMessage.id,
+                    earlier.status.in_(['pending', 'processing'])
+                )
+            ).order_by(InboxMessage.id).limit(limit)
+        ).scalars().all()
+
+        claimed, admitted = [], []
+        try:
+            for entry in candidates:
+                # Квота портала: шумный портал не занимает все потоки обработки
+                portal = portal_registry.get(entry.portal_id)
+                if portal is None:
+                    # Портал больше не обслуживается: ответить некому, а запись блокирует чат
+                    self._bury_unclaimed(entry, now, f"portal {entry.portal_id} is no longer served")
+                    continue
+                if not portal.admission.try_acquire():
+                    self._acknowledge_waiting(entry, now)
+                    continue
+                # Класс стоимости: вопросы к LLM не занимают слоты быстрых ответов
+                admission_class = admission_controller.classes[entry.cost_class or 'llm']
+                if not admission_class.try_acquire():
+                    portal.admission.release()
+                    self._acknowledge_waiting(entry, now)
+                    continue
+                admitted.append((portal, admission_class))
+                # Условный UPDATE: запись получает только один воркер, даже при смене владельца
+                result = db.session.execute(
+                    update(InboxMessage).where(
+                        InboxMessage.id == entry.id,
+                        self._claimable_condition(now)
+                    ).values(
+                        status='processing',
+                        locked_by=self.worker_id,
+                        locked_until=now + timedelta(seconds=self.lease_seconds)
+                    ).execution_options(synchronize_session=False)
+                )
+                if result.rowcount == 1:
+                    claimed.append((entry, portal, admission_class))
+                else:
+                    portal, admission_class = admitted.pop()
+                    portal.admission.release()
+                    admission_class.release()
+            db.session.commit()
+        except Exception:
+            # Захват не состоялся: слоты возвращаются, иначе квоты утекают
+            db.session.rollback()
+            for portal, admission_class in admitted:
+                portal.admission.release()
+                admission_class.release()
+            raise
+        return claimed
+
+    def _bury_unclaimed(self, entry: InboxMessage, now: datetime, error: str):
+        """Перевод незахваченной записи в dead (в транзакции захвата)"""
+        result = db.session.execute(
+            update(InboxMessage).where(
+                InboxMessage.id == entry.id,
+                self._claimable_condition(now)
+            ).values(
+                status='dead', last_error=error, locked_until=None, locked_by=None
+            ).execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 1:
+            self.stats['dead_lettered'] += 1
+            logging.error(f"Inbox entry {entry.id} moved to dead letter: {error}")
+
+    def _cached_context(self, partition: int, conversation_id: int) -> Optional[List[Dict[str, str]]]:
+        with self._lock:
+            contexts = self._contexts.get(partition)
+            if contexts is None or conversation_id not in contexts:
+                return None
+            contexts.move_to_end(conversation_id)
+            return list(contexts[conversation_id])
+
+    def _remember_context(self, partition: int, conversation_id: int, context: List[Dict[str, str]]):
+        with self._lock:
+            if partition not in self.owned:
+                return
+            contexts = self._contexts.setdefault(partition, OrderedDict())
+            contexts[conversation_id] = context[-CONTEXT_MESSAGES:]
+            contexts.move_to_end(conversation_id)
+            while len(contexts) > self.contexts_per_partition:
+                contexts.popitem(last=False)
+
+    def process(self, entry_id: int):
+        """Ответ на сообщение; контекст разговора берется из памяти владельца"""
+        import routes
+
+        entry = db.session.get(InboxMessage, entry_id)
+        incoming = json.loads(entry.payload)
+        conversation = db.session.get(Conversation, entry.conversation_id)
+
+        context = self._cached_context(entry.partition_no, conversation.id)
+        if context is None:
+            self.stats['context_misses'] += 1
+            # Контекст до этого сообщения включительно: следующие сообщения чата еще ждут в inbox
+            context = routes.get_conversation_context(conversation, incoming.get('message_id'))
+        else:
+            self.stats['context_hits'] += 1
+            context.append({'role': 'user', 'content': incoming['text']})
+
+        partition = entry.partition_no
+
+        def take_entry():
+            # Снятие из inbox в транзакции ответа и outbox: ответ не уйдет дважды,
+            # а если запись уже захватил другой воркер, транзакция отменяется
+            result = db.session.execute(
+                delete(InboxMessage).where(
+                    InboxMessage.id == entry_id,
+                    InboxMessage.status == 'processing',
+                    InboxMessage.locked_by == self.worker_id
+                ).execution_options(synchronize_session=False)
+            )
+            if result.rowcount != 1:
+                raise LeaseLostError(entry_id)
+
+        bot_response = routes.answer_user_message(incoming, conversation, context[-CONTEXT_MESSAGES:], take_entry)
+        self._remember_context(partition, conversation.id,
+                               context + [{'role': 'assistant', 'content': bot_response}])
+        self.stats['processed'] += 1
+
+    def _run_entry(self, app, entry_id: int, portal, admission_class):
+        try:
+            with app.app_context():
+                try:
+                    self.process(entry_id)
+                except LeaseLostError:
+                    db.session.rollback()
+                    self.stats['leases_lost'] += 1
+                    logging.warning(f"Inbox entry {entry_id} was taken over by another worker, reply discarded")
+                except UnknownPortalError as e:
+                    # Повторы не помогут: портал отключен после приема сообщения
+                    db.session.rollback()
+                    self._fail(entry_id, str(e), permanent=True)
+                except Exception as e:
+                    db.session.rollback()
+                    self._fail(entry_id, str(e))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            # Освобождаются те же объекты, что захвачены: реестр мог пересоздать контекст портала
+            portal.admission.release()
+            admission_class.release()
+            self._wake.set()
+
+    def _fail(self, entry_id: int, error: str, permanent: bool = False):
+        entry = db.session.get(InboxMessage, entry_id)
+        # Запись, перешедшую к другому воркеру, не трогаем
+        if entry is None or entry.locked_by != self.worker_id:
+            return
+        entry.attempts = (entry.attempts or 0) + 1
+        entry.last_error = error
+        entry.locked_until = None
+        self.stats['failed_attempts'] += 1
+        if permanent or entry.attempts >= self.max_attempts:
+            entry.status = 'dead'
+            self.stats['dead_lettered'] += 1
+            logging.error(f"Inbox entry {entry_id} moved to dead letter: {error}")
+        else:
+            entry.status = 'pending'
+            entry.next_attempt_at = datetime.utcnow() + timedelta(seconds=2 ** entry.attempts)
+            logging.warning(f"Inbox entry {entry_id} failed, will retry: {error}")
+        db.session.commit()
+
+    def run_forever(self, app):
+        """Цикл владельца партиций: отметка о живости, перераспределение, захват"""
+        while not self._stop.is_set():
+            claimed = []
+            try:
+                with app.app_context():
+                    self.rebalance()
+                    capacity = self.threads - self.in_flight
+                    if self.owned and capacity > 0:
+                        claimed = self.claim_batch(capacity)
+            except Exception as e:
+                logging.error(f"Chat affinity dispatcher error: {str(e)}")
+
+            for entry, portal, admission_class in claimed:
+                with self._lock:
+                    self.in_flight += 1
+                self._executor.submit(self._run_entry, app, entry.id, portal, admission_class)
+
+            if not claimed:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def start_background(self, app) -> threading.Thread:
+        """Запуск в процессе воркера (после fork): у каждого воркера свой идентификатор"""
+        if self._thread is not None and self._thread.is_alive():
+            return self._thread
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.members, self.owned, self._contexts, self._heartbeat_at = [], set(), {}, None
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='chat-affinity')
+        self._thread = threading.Thread(target=self.run_forever, args=(app,), name='chat-affinity', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, app=None):
+        """Остановка и выход из числа участников: партиции сразу переходят к остальным"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            # Цикл не должен снова отметиться после выхода из группы
+            self._thread.join(timeout=self.poll_interval * 2 + 5)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if app is None or self.worker_id is None:
+            return
+        try:
+            with app.app_context():
+                db.session.execute(delete(AffinityMember).where(AffinityMember.worker_id == self.worker_id))
+                db.session.commit()
+        except Exception as e:
+            logging.error(f"Failed to leave chat affinity group: {str(e)}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        rows = db.session.execute(
+            select(InboxMessage.status, db.func.count(InboxMessage.id)).group_by(InboxMessage.status)
+        ).all()
+        with self._lock:
+            cached = sum(len(contexts) for contexts in self._contexts.values())
+            return {
+                'enabled': self.enabled,
+                'worker_id': self.worker_id,
+                'partitions': self.partitions,
+                'members': list(self.members),
+                'owned_partitions': sorted(self.owned),
+                'in_flight': self.in_flight,
+                'cached_contexts': cached,
+                'queue': {status: count for status, count in rows},
+                **self.stats,
+            }
+
+
+chat_affinity = ChatAffinityDispatcher()
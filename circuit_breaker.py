@@ -0,0 +1,186 @@
+import os
+import time
+import threading
+from collections import deque
+from typing import Dict, Any, Tuple
+
+
+class CircuitBreaker:
+    """Предохранитель для вызовов внешнего сервиса
+
+    closed: вызовы разрешены, подряд идущие ошибки считаются;
+    open: вызовы сразу отклоняются до истечения open_seconds;
+    half_open: пропускается один пробный вызов, его результат
+    закрывает или снова открывает предохранитель.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, open_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """Можно ли выполнить вызов сейчас"""
+        return self.allow_probe()[0]
+
+    def allow_probe(self) -> Tuple[bool, bool]:
+        """(можно ли выполнить вызов, является ли он пробным вызовом half_open)"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True, False
+
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return False, False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+
+            # half_open: только один пробный вызов одновременно
+            if self._probe_in_flight:
+                self.rejected += 1
+                return False, False
+            self._probe_in_flight = True
+            return True, True
+
+    def abandon_probe(self):
+        """Пробный вызов завершился без результата (отмена, непредвиденная ошибка)
+
+        Иначе флаг пробы останется установленным и предохранитель больше
+        не пропустит ни одного вызова.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+
+    def is_open(self) -> bool:
+        """Отклоняются ли вызовы сейчас (без перехода в half_open)
+
+        Истекшее окно open считается half_open: пробный вызов разрешен,
+        иначе проверка доступности перед вызовом никогда не пропустит пробу.
+        """
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self.opened_at < self.open_seconds
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'rejected': self.rejected,
+            }
+
+
+class LatencyTracker:
+    """Адаптивный таймаут по перцентилю недавних задержек"""
+
+    def __init__(self, window: int = 200, percentile: float = 0.99, multiplier: float = 1.5,
+                 min_timeout: float = 3.0, max_timeout: float = 30.0):
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float) -> float:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        index = min(len(samples) - 1, int(q * len(samples)))
+        return samples[index]
+
+    def timeout(self) -> float:
+        """Таймаут вызова: перцентиль * множитель в пределах [min_timeout, max_timeout]"""
+        with self._lock:
+            enough = len(self._samples) >= 20
+        if not enough:
+            # Пока данных мало, используем верхнюю границу
+            return self.max_timeout
+        return max(self.min_timeout, min(self.max_timeout, self.quantile(self.percentile) * self.multiplier))
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count = len(self._samples)
+        return {
+            'samples': count,
+            'p50': round(self.quantile(0.5), 3),
+            'p95': round(self.quantile(0.95), 3),
+            'p99': round(self.quantile(0.99), 3),
+            'timeout': round(self.timeout(), 3),
+        }
+
+
+class ResilienceRegistry:
+    """Предохранители по model URI и трекеры задержек по (model URI, операция)"""
+
+    def __init__(self):
+        self.failure_threshold = int(os.environ.get('GPT_BREAKER_FAILURES', '5'))
+        self.open_seconds = float(os.environ.get('GPT_BREAKER_OPEN_SECONDS', '30'))
+        self.timeout_percentile = float(os.environ.get('GPT_TIMEOUT_PERCENTILE', '0.99'))
+        self.timeout_multiplier = float(os.environ.get('GPT_TIMEOUT_MULTIPLIER', '1.5'))
+        self.min_timeout = float(os.environ.get('GPT_TIMEOUT_MIN', '3'))
+
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._trackers: Dict[Tuple[str, str], LatencyTracker] = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, model_uri: str) -> CircuitBreaker:
+        with self._lock:
+            if model_uri not in self._breakers:
+                self._breakers[model_uri] = CircuitBreaker(model_uri, self.failure_threshold, self.open_seconds)
+            return self._breakers[model_uri]
+
+    def latency(self, model_uri: str, operation: str, max_timeout: float) -> LatencyTracker:
+        key = (model_uri, operation)
+        with self._lock:
+            if key not in self._trackers:
+                self._trackers[key] = LatencyTracker(
+                    percentile=self.timeout_percentile,
+                    multiplier=self.timeout_multiplier,
+                    min_timeout=self.min_timeout,
+                    max_timeout=max_timeout
+                )
+            return self._trackers[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            breakers = dict(self._breakers)
+            trackers = dict(self._trackers)
+        return {
+            'breakers': {name: breaker.get_stats() for name, breaker in breakers.items()},
+            'latency': {f"{uri} {operation}": tracker.get_stats() for (uri, operation), tracker in trackers.items()},
+        }
+
+
+resilience = ResilienceRegistry()
@@ -0,0 +1,189 @@
+import sys
+import json
+import logging
+
+import click
+from app import app
+from transcript_export import TranscriptExporter, parse_date
+from lifecycle import ConversationLifecycleManager
+from schema import migrate_schema
+from db_routing import replica_reads
+
+
+@app.cli.command('migrate')
+def migrate():
+    """Создание и обновление схемы базы данных"""
+    applied = migrate_schema()
+    click.echo(f"Applied {len(applied)} schema changes")
+    for step in applied:
+        click.echo(f"  {step}")
+
+
+@app.cli.command('export-transcripts')
+@click.option('--format', 'data_format', type=click.Choice(['ndjson', 'csv', 'csv.gz']), default='ndjson')
+@click.option('--date-from', default=None, help='Начало периода (ISO)')
+@click.option('--date-to', default=None, help='Конец периода (ISO, не включительно)')
+@click.option('--status', default=None, help='Статус разговора')
+@click.option('--department', default=None, help='Подразделение пользователя')
+@click.option('--include-archive', is_flag=True, help='Включить архив сообщений')
+@click.option('--output', '-o', default='-', help='Файл для записи, по умолчанию stdout')
+def export_transcripts(data_format, date_from, date_to, status, department, include_archive, output):
+    """Потоковая выгрузка переписки для аналитиков"""
+    exporter = TranscriptExporter(
+        date_from=parse_date(date_from),
+        date_to=parse_date(date_to),
+        status=status,
+        department=department,
+        include_archive=include_archive
+    )
+
+    binary = data_format == 'csv.gz'
+    if output == '-':
+        target = sys.stdout.buffer if binary else sys.stdout
+        close_target = False
+    else:
+        target = open(output, 'wb' if binary else 'w', encoding=None if binary else 'utf-8')
+        close_target = True
+
+    try:
+        with replica_reads():
+            for chunk in exporter.export(data_format):
+                target.write(chunk)
+    finally:
+        if close_target:
+            target.close()
+
+    logging.info(f"Transcript export finished: {output}")
+
+
+@app.cli.command('lifecycle')
+@click.option('--idle-minutes', type=int, default=None, help='Через сколько минут без сообщений закрывать разговор')
+@click.option('--retention-days', type=int, default=None, help='Сколько дней хранить сообщения в рабочей таблице')
+def run_lifecycle(idle_minutes, retention_days):
+    """Закрытие неактивных разговоров и архивирование старых сообщений"""
+    manager = ConversationLifecycleManager()
+    if idle_minutes is not None:
+        manager.idle_minutes = idle_minutes
+    if retention_days is not None:
+        manager.retention_days = retention_days
+
+    click.echo(manager.run())
+
+
+@app.cli.command('outbox-dispatch')
+@click.option('--once', is_flag=True, help='Обработать одну пачку и выйти')
+def outbox_dispatch(once):
+    """Доставка исходящих сообщений и задач из outbox"""
+    from routes import outbox_dispatcher
+    if once:
+        click.echo(f"Processed {outbox_dispatcher.dispatch_batch()} outbox entries")
+        return
+    outbox_dispatcher.run_forever(app)
+
+
+@app.cli.command('prefetch-profiles')
+@click.option('--portal-id', type=int, default=None, help='Портал (по умолчанию — из BITRIX_WEBHOOK_URL)')
+def prefetch_profiles(portal_id):
+    """Загрузка профилей всех пользователей и подразделений из Битрикс24"""
+    from portals import portal_registry
+    portal = portal_registry.get(portal_id)
+    if portal is None:
+        raise click.ClickException(f"Portal {portal_id} is not registered or inactive")
+    click.echo(portal.enricher.prefetch_all())
+
+
+@app.cli.command('warm-caches')
+@click.option('--budget', type=float, default=None, help='Бюджет времени в секундах')
+def warm_caches(budget):
+    """Прогрев кэшей по истории обращений (отчет о том, что успели загрузить)"""
+    from warmup import cache_warmer
+    if budget is not None:
+        cache_warmer.budget = budget
+    click.echo(json.dumps(cache_warmer.run(), ensure_ascii=False))
+
+
+@app.cli.command('add-portal')
+@click.option('--domain', required=True, help='Домен портала, например example.bitrix24.ru')
+@click.option('--webhook-url', required=True, help='Входящий веб-хук REST API портала')
+@click.option('--application-token', default=None, help='auth.application_token из событий портала')
+@click.option('--client-id', default=None, help='CLIENT_ID приложения для imbot.*')
+@click.option('--rate-limit', type=float, default=None, help='Запросов в секунду к REST API')
+@click.option('--max-in-flight', type=int, default=None, help='Одновременных обработок сообщений портала')
+@click.option('--inactive', is_flag=True, help='Отключить портал')
+def add_portal(domain, webhook_url, application_token, client_id, rate_limit, max_in_flight, inactive):
+    """Регистрация или обновление портала Битрикс24"""
+    from app import db
+    from models import Portal
+    domain = domain.lower()
+    portal = Portal.query.filter_by(domain=domain).first()
+    if portal is None:
+        portal = Portal(domain=domain)
+        db.session.add(portal)
+
+    portal.webhook_url = webhook_url.rstrip('/')
+    portal.application_token = application_token
+    portal.client_id = client_id
+    portal.rate_limit = rate_limit
+    portal.max_in_flight = max_in_flight
+    portal.is_active = not inactive
+    db.session.commit()
+    click.echo(f"Portal {portal.id}: {portal.domain} ({'inactive' if inactive else 'active'})")
+
+
+@app.cli.command('summarize-conversations')
+@click.option('--limit', type=int, default=None, help='Максимум разговоров за запуск')
+@click.option('--concurrency', type=int, default=None, help='Число одновременных запросов к YandexGPT')
+@click.option('--rate', type=float, default=None, help='Не больше запросов в секунду')
+def summarize_conversations(limit, concurrency, rate):
+    """Резюме закрытых и эскалированных разговоров (повторный запуск продолжает работу)"""
+    from routes import gpt_client
+    from summarization import ConversationSummarizer
+    if not gpt_client.api_key:
+        raise click.ClickException("YANDEX_GPT_API_KEY is not configured")
+    click.echo(ConversationSummarizer(gpt_client, concurrency, rate).run(limit))
+
+
+@app.cli.command('score-messages')
+@click.option('--limit', type=int, default=None, help='Максимум сообщений за запуск')
+@click.option('--reset', is_flag=True, help='Удалить итоги и пересчитать историю с начала')
+def score_messages(limit, reset):
+    """Тональность и безопасность новых сообщений с записью дневных итогов"""
+    from message_scoring import MessageScoringJob
+    job = MessageScoringJob()
+    if reset:
+        job.reset()
+    click.echo(job.run(limit))
+
+
+@app.cli.command('replay-traffic')
+@click.argument('capture_file')
+@click.option('--target', default='http://127.0.0.1:5000', help='Адрес экземпляра для воспроизведения')
+@click.option('--speed', type=float, default=1.0, help='Ускорение относительно записи; 0 — без пауз')
+@click.option('--concurrency', type=int, default=32, help='Максимум одновременных запросов')
+@click.option('--stub-url', default=None, help='Адрес заглушек (flask replay-stub) для подсчета вызовов LLM')
+@click.option('--output', '-o', default=None, help='Файл для JSON-отчета')
+@click.option('--portal-token', multiple=True, help='домен=application_token портала целевого экземпляра')
+@click.option('--debug-token', envvar='DEBUG_API_TOKEN', default='', help='Токен /api/debug/* целевого экземпляра')
+def replay_traffic(capture_file, target, speed, concurrency, stub_url, output, portal_token, debug_token):
+    """Воспроизведение записанных веб-хуков с отчетом о задержках и кэшах"""
+    from traffic_replay import TrafficReplayer, load_records
+    portal_tokens = dict(item.split('=', 1) for item in portal_token if '=' in item)
+    report = TrafficReplayer(
+        target, speed, concurrency, stub_url, portal_tokens, debug_token
+    ).run(load_records(capture_file))
+    rendered = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as target_file:
+            target_file.write(rendered)
+    click.echo(rendered)
+
+
+@app.cli.command('replay-stub')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', type=int, default=8090)
+@click.option('--llm-latency', type=float, default=1.0, help='Задержка ответа LLM, секунды')
+@click.option('--bitrix-latency', type=float, default=0.05, help='Задержка ответа Битрикс24, секунды')
+def replay_stub(host, port, llm_latency, bitrix_latency):
+    """Заглушки Битрикс24 и LLM для воспроизведения трафика"""
+    from traffic_replay import StubBackends
+    StubBackends(llm_latency, bitrix_latency).serve(host, port)
@@ -0,0 +1,144 @@
+import os
+import json
+import math
+import logging
+import threading
+from collections import deque
+from typing import Dict, Any, List, Optional
+
+
+# Параметры генерации по классам вопросов: модель, длина ответа, температура
+DEFAULT_PLANS = {
+    'yes_no': {'model': 'yandexgpt-lite', 'max_tokens': 200, 'temperature': 0.1},
+    'followup': {'model': 'yandexgpt-lite', 'max_tokens': 400, 'temperature': 0.3},
+    'kb_topic': {'model': 'yandexgpt-lite', 'max_tokens': 600, 'temperature': 0.3},
+    'general': {'model': 'yandexgpt-lite', 'max_tokens': 800, 'temperature': 0.3},
+    'explanation': {'model': 'yandexgpt/latest', 'max_tokens': 1500, 'temperature': 0.3},
+}
+
+YES_NO_MARKERS = (
+    'можно ли', 'нужно ли', 'надо ли', 'есть ли', 'могу ли', 'положен ли',
+    'положена ли', 'будет ли', 'правда ли', 'верно ли', 'обязательно ли'
+)
+EXPLANATION_MARKERS = (
+    'объясни', 'расскажи', 'подробн', 'почему', 'порядок', 'процедур',
+    'в чем разница', 'чем отличается', 'как оформить', 'как рассчитыва'
+)
+
+
+class CompletionPlanner:
+    """Выбор параметров генерации YandexGPT по классу вопроса
+
+    Класс определяется по формулировке, длине сообщения, истории диалога
+    и карте категорий базы знаний. Таблица классов переопределяется
+    через GPT_COMPLETION_PLANS (JSON), фактический расход токенов
+    копится по классам для последующей настройки таблицы.
+    """
+
+    def __init__(self, categories: Optional[Dict[str, List[str]]] = None):
+        self.categories = categories or {}
+        self.short_words = int(os.environ.get('GPT_PLAN_SHORT_WORDS', '12'))
+        self.long_words = int(os.environ.get('GPT_PLAN_LONG_WORDS', '40'))
+        self.plans = self._load_plans(os.environ.get('GPT_COMPLETION_PLANS', ''))
+
+        self._lock = threading.Lock()
+        self._usage: Dict[str, Dict[str, Any]] = {}
+
+    def _load_plans(self, raw: str) -> Dict[str, Dict[str, Any]]:
+        plans = {name: dict(plan) for name, plan in DEFAULT_PLANS.items()}
+        if not raw:
+            return plans
+        try:
+            overrides = json.loads(raw)
+        except ValueError as e:
+            logging.error(f"Invalid GPT_COMPLETION_PLANS, using defaults: {str(e)}")
+            return plans
+        for name, plan in overrides.items():
+            plans.setdefault(name, dict(DEFAULT_PLANS['general'])).update(plan)
+        return plans
+
+    def classify(self, message_text: str, context: Optional[List[Dict]] = None) -> str:
+        """Класс вопроса без обращения к БД и LLM"""
+        text = ' '.join(message_text.lower().split())
+        words = len(text.split())
+
+        if words <= self.short_words and text.startswith(YES_NO_MARKERS):
+            return 'yes_no'
+        if words >= self.long_words or any(marker in text for marker in EXPLANATION_MARKERS):
+            return 'explanation'
+        if context and len(context) >= 2 and words <= self.short_words // 2:
+            return 'followup'
+        if self._has_category(text):
+            return 'kb_topic'
+        return 'general'
+
+    def _has_category(self, text: str) -> bool:
+        return any(keyword in text for keywords in self.categories.values() for keyword in keywords)
+
+    def plan(self, message_text: str, context: Optional[List[Dict]] = None) -> Dict[str, Any]:
+        """Параметры запроса для сообщения: класс, модель, maxTokens, температура"""
+        question_class = self.classify(message_text, context)
+        plan = self.plans.get(question_class) or self.plans['general']
+        return {'question_class': question_class, **plan}
+
+    def record(self, plan: Dict[str, Any], result: Dict, seconds: float):
+        """Учет фактического расхода токенов по ответу API"""
+        usage = result.get('result', {}).get('usage', {})
+        alternatives = result.get('result', {}).get('alternatives') or [{}]
+        input_tokens = int(usage.get('inputTextTokens', 0))
+        completion_tokens = int(usage.get('completionTokens', 0))
+        truncated = alternatives[0].get('status') == 'ALTERNATIVE_STATUS_TRUNCATED_FINAL'
+
+        with self._lock:
+            stats = self._usage.setdefault(plan['question_class'], {
+                'requests': 0, 'input_tokens': 0, 'completion_tokens': 0,
+                'truncated': 0, 'seconds': 0.0, 'samples': deque(maxlen=500),
+            })
+            stats['requests'] += 1
+            stats['input_tokens'] += input_tokens
+            stats['completion_tokens'] += completion_tokens
+            stats['truncated'] += int(truncated)
+            stats['seconds'] += seconds
+            stats['samples'].append(completion_tokens)
+
+        logging.info(
+            "YandexGPT completion",
+            extra={
+                'question_class': plan['question_class'],
+                'model': plan['model'],
+                'max_tokens': plan['max_tokens'],
+                'input_tokens': input_tokens,
+                'completion_tokens': completion_tokens,
+                'truncated': truncated,
+                'duration_ms': round(seconds * 1000, 1),
+            }
+        )
+
+    def _suggest_max_tokens(self, samples: List[int]) -> Optional[int]:
+        """Предлагаемый maxTokens: p95 фактической длины с запасом 25%"""
+        if len(samples) < 20:
+            return None
+        p95 = samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+        return max(100, int(math.ceil(p95 * 1.25 / 50.0)) * 50)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            usage = {name: dict(stats, samples=sorted(stats['samples'])) for name, stats in self._usage.items()}
+
+        classes = {}
+        for name, plan in self.plans.items():
+            stats = usage.get(name)
+            entry = {'plan': plan}
+            if stats:
+                samples = stats.pop('samples')
+                requests = stats['requests']
+                entry.update({
+                    **stats,
+                    'seconds': round(stats['seconds'], 3),
+                    'avg_completion_tokens': round(stats['completion_tokens'] / requests, 1),
+                    'avg_seconds': round(stats['seconds'] / requests, 3),
+                    'truncated_ratio': round(stats['truncated'] / requests, 4),
+                    'suggested_max_tokens': self._suggest_max_tokens(samples),
+                })
+            classes[name] = entry
+        return {'classes': classes}
@@ -0,0 +1,237 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Any, Optional
+
+from flask import g, request, has_app_context, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, func, select, text
+from sqlalchemy.sql import Select
+
+
+REPLICA_BIND = 'replica'
+PRIMARY_COOKIE = 'db_primary_until'
+
+
+class ReplicaRouter:
+    """Маршрутизация чтения на реплику БД
+
+    Реплика подключается как bind 'replica' (DATABASE_REPLICA_URL).
+    На нее уходят только SELECT из маршрутов, помеченных read_replica,
+    и только пока отставание реплики не превышает допустимого.
+    Запись, чтение внутри flush и чтение после собственной записи
+    (в том же запросе и в течение окна по cookie) идут на основную БД.
+    """
+
+    def __init__(self):
+        self.replica_url = os.environ.get('DATABASE_REPLICA_URL', '')
+        self.max_staleness = float(os.environ.get('REPLICA_MAX_STALENESS_SECONDS', '5'))
+        self.lag_check_interval = float(os.environ.get('REPLICA_LAG_CHECK_SECONDS', '2'))
+
+        self.db = None
+        self.app = None
+        self._lag: Optional[float] = None
+        self._lag_checked_at = 0.0
+        self._lag_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {'replica': 0, 'primary': 0, 'stale_fallbacks': 0, 'sticky_primary': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replica_url)
+
+    def configure(self, app):
+        """Добавление bind реплики в конфигурацию до db.init_app"""
+        if self.enabled:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds[REPLICA_BIND] = self.replica_url
+            app.config['SQLALCHEMY_BINDS'] = binds
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        app.after_request(self._remember_write)
+
+    def _count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    # ==== Выбор подключения ====
+
+    def should_use_replica(self, session, clause) -> bool:
+        if not self.enabled or not has_app_context() or not g.get('db_read_replica'):
+            return False
+        if session._flushing or not isinstance(clause, Select):
+            return False
+        if g.get('db_wrote') or self._primary_requested():
+            self._count('sticky_primary')
+            return False
+
+        lag = self.replica_lag()
+        if lag is None or lag > self.max_staleness:
+            self._count('stale_fallbacks')
+            return False
+
+        self._count('replica')
+        return True
+
+    def _primary_requested(self) -> bool:
+        """Недавняя запись этого клиента: читаем с основной БД до конца окна"""
+        if not has_request_context():
+            return False
+        try:
+            return float(request.cookies.get(PRIMARY_COOKIE, '0')) > time.time()
+        except ValueError:
+            return False
+
+    def _remember_write(self, response):
+        if g.get('db_wrote') and self.enabled:
+            response.set_cookie(
+                PRIMARY_COOKIE,
+                str(time.time() + self.max_staleness),
+                max_age=int(self.max_staleness) + 1,
+                httponly=True,
+                samesite='Lax'
+            )
+        return response
+
+    # ==== Отставание реплики ====
+
+    def replica_lag(self) -> Optional[float]:
+        """Отставание реплики в секундах (кэшируется); None, если реплика недоступна"""
+        now = time.monotonic()
+        if now - self._lag_checked_at < self.lag_check_interval:
+            return self._lag
+
+        if not self._lag_lock.acquire(blocking=False):
+            # Проверку уже выполняет другой поток
+            return self._lag
+        try:
+            self._lag = self._measure_lag()
+            self._lag_checked_at = time.monotonic()
+        finally:
+            self._lag_lock.release()
+        return self._lag
+
+    def _measure_lag(self) -> Optional[float]:
+        replica = self.db.engines[REPLICA_BIND]
+        try:
+            if replica.dialect.name == 'postgresql':
+                return self._measure_lag_by_wal(replica)
+            return self._measure_lag_by_messages(replica)
+        except Exception as e:
+            logging.warning(f"Replica lag check failed: {str(e)}")
+            return None
+
+    def _measure_lag_by_wal(self, replica) -> Optional[float]:
+        """Отставание по WAL: позиция основной БД против примененной на реплике
+
+        Совпадение полученного и примененного LSN на самой реплике ничего не
+        говорит, если приемник WAL отключен или завис, поэтому позиция
+        сравнивается с pg_current_wal_lsn() основной БД, а время последней
+        примененной транзакции учитывается только при живом потоке репликации.
+        None (неизвестно) отправляет чтение на основную БД.
+        """
+        with self.db.engine.connect() as connection:
+            primary_lsn = connection.execute(text("SELECT pg_current_wal_lsn()::text")).scalar()
+
+        with replica.connect() as connection:
+            row = connection.execute(text(
+                "SELECT pg_last_wal_replay_lsn() >= CAST(:primary_lsn AS pg_lsn), "
+                "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), "
+                "EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming' "
+                "AND last_msg_receipt_time > now() - make_interval(secs => :receipt_window))"
+            ), {'primary_lsn': primary_lsn, 'receipt_window': self.max_staleness}).one()
+        caught_up, replay_age, streaming = row
+
+        # NULL: реплика не в режиме восстановления — отставание неизвестно
+        if caught_up is None:
+            return None
+        # Реплика применила весь WAL, записанный на основной БД к моменту проверки
+        if caught_up:
+            return 0.0
+        if not streaming or replay_age is None:
+            return None
+        return max(0.0, float(replay_age))
+
+    def _measure_lag_by_messages(self, replica) -> float:
+        """Отставание по времени последнего сообщения на основной БД и реплике"""
+        from models import Message
+
+        latest = select(func.max(Message.timestamp))
+        with self.db.engine.connect() as connection:
+            primary_latest = connection.execute(latest).scalar()
+        with replica.connect() as connection:
+            replica_latest = connection.execute(latest).scalar()
+
+        if primary_latest is None:
+            return 0.0
+        if replica_latest is None:
+            return float('inf')
+        return max(0.0, (primary_latest - replica_latest).total_seconds())
+
+    # ==== Статистика ====
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Использование пула соединений по каждому bind"""
+        pools = {}
+        for bind_key, engine in self.db.engines.items():
+            pool = engine.pool
+            stats = {'class': type(pool).__name__, 'status': pool.status()}
+            for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+                if hasattr(pool, name):
+                    stats[name] = getattr(pool, name)()
+            pools[bind_key or 'primary'] = stats
+        return pools
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            routed = dict(self.stats)
+        return {
+            'enabled': self.enabled,
+            'max_staleness_seconds': self.max_staleness,
+            'replica_lag_seconds': self._lag,
+            'routed': routed,
+            'pools': self.get_pool_stats(),
+        }
+
+
+replica_router = ReplicaRouter()
+
+
+class RoutingSession(Session):
+    """Сессия Flask-SQLAlchemy с чтением с реплики по правилам ReplicaRouter"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and replica_router.should_use_replica(self, clause):
+            return replica_router.db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_write(session, flush_context):
+    if has_app_context():
+        g.db_wrote = True
+
+
+def read_replica(view):
+    """Маршрут только для чтения: SELECT могут выполняться на реплике"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def replica_reads():
+    """Чтение с реплики вне HTTP-запроса (CLI-выгрузки)"""
+    previous = g.get('db_read_replica')
+    g.db_read_replica = True
+    try:
+        yield
+    finally:
+        g.db_read_replica = previous
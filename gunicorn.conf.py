@@ -0,0 +1,45 @@
+# Приложение и клиенты инициализируются один раз в мастере до fork,
+# воркеры получают их готовыми через copy-on-write.
+preload_app = True
+
+
+def when_ready(server):
+    from startup import LazyService
+    from message_classifier import message_classifier
+    LazyService.warm_all()
+    message_classifier.reload()
+
+    # Прогрев кэшей до fork: воркеры стартуют с готовыми кэшами
+    from app import app
+    from warmup import cache_warmer
+    with app.app_context():
+        cache_warmer.run()
+
+
+def post_fork(server, worker):
+    # Соединения пула не должны разделяться между процессами
+    from app import app, db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+    from portals import portal_registry
+    portal_registry.close_connections()
+
+    import os
+    if os.environ.get('OUTBOX_DISPATCHER', 'inprocess') == 'inprocess':
+        import routes
+        routes.outbox_dispatcher.start_background(app)
+
+    # Воркер участвует в распределении партиций чатов со своим идентификатором
+    from chat_affinity import chat_affinity
+    if chat_affinity.enabled:
+        chat_affinity.start_background(app)
+
+
+def worker_exit(server, worker):
+    # Уход из группы сразу передает партиции воркера остальным, не дожидаясь TTL
+    from app import app
+    from chat_affinity import chat_affinity
+    if chat_affinity.enabled:
+        chat_affinity.stop(app)
@@ -32,8 +32,35 @@ function askChatGPT($messageText) {
     return $result['choices'][0]['message']['content'] ?? 'Ошибка генерации ответа.';
 }
 
+// ==== Портал-отправитель: адрес веб-хука выбирается по домену события ====
+// BITRIX_PORTALS — JSON {"домен": {"webhook_url": "...", "application_token": "..."}},
+// без него используется единственный портал из BITRIX_WEBHOOK_URL
+function portalWebhookUrl($auth) {
+    $portals = json_decode(getenv("BITRIX_PORTALS") ?: "{}", true) ?: [];
+    $domain = strtolower($auth['domain'] ?? '');
+
+    if (isset($portals[$domain])) {
+        $portal = $portals[$domain];
+        $token = $portal['application_token'] ?? '';
+        if ($token !== '' && !hash_equals($token, (string)($auth['application_token'] ?? ''))) {
+            return null;
+        }
+        return rtrim($portal['webhook_url'], '/');
+    }
+
+    $default = getenv("BITRIX_WEBHOOK_URL");
+    return ($default && !$portals) ? rtrim($default, '/') : null;
+}
+
 // ==== Обработка входящих сообщений от Bitrix24 ====
 if ($data['event'] === "ONIMBOTMESSAGEADD") {
+    $webhookUrl = portalWebhookUrl($data['auth'] ?? []);
+    if (!$webhookUrl) {
+        http_response_code(403);
+        echo json_encode(["error" => "Unknown portal"]);
+        exit;
+    }
+
     $message = $data['data']['PARAMS']['MESSAGE'];
     $dialogId = $data['data']['PARAMS']['DIALOG_ID'];
     $botId = $data['data']['BOT_ID'];
@@ -46,7 +73,7 @@ if ($data['event'] === "ONIMBOTMESSAGEADD") {
         "MESSAGE" => $reply
     ];
 
-    $url = "https://tdroks.bitrix24.ru/rest/1/n70eln7e90vnou3d/imbot.message.add.json";
+    $url = $webhookUrl . "/imbot.message.add.json";
 
     $ch = curl_init($url);
     curl_setopt($ch, CURLOPT_POSTFIELDS, json_encode($payload));
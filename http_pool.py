@@ -0,0 +1,34 @@
+import os
+from typing import Dict, Optional
+
+import httpx
+
+
+_async_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def get_async_client(name: str = 'default', max_connections: Optional[int] = None) -> httpx.AsyncClient:
+    """Асинхронный HTTP-клиент процесса с пулом соединений
+
+    Пул 'default' общий для LLM и портала по умолчанию; каждый дополнительный
+    портал Битрикс24 получает свой именованный пул, поэтому медленный или
+    перегруженный портал не занимает соединения остальных.
+    """
+    client = _async_clients.get(name)
+    if client is None:
+        connections = max_connections or int(os.environ.get('HTTP_MAX_CONNECTIONS', '200'))
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=connections,
+                max_keepalive_connections=min(connections, int(os.environ.get('HTTP_MAX_KEEPALIVE', '50'))),
+            ),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+        )
+        _async_clients[name] = client
+    return client
+
+
+async def close_async_client():
+    while _async_clients:
+        _, client = _async_clients.popitem()
+        await client.aclose()
@@ -0,0 +1,244 @@
+import io
+import csv
+import json
+import logging
+from datetime import datetime
+from typing import Iterable, Iterator, Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import select, text
+from app import db
+from models import KnowledgeBaseArticle
+
+
+ARTICLE_FIELDS = ['external_id', 'portal_id', 'title', 'content', 'category', 'tags', 'is_active']
+
+
+class KnowledgeBaseTransfer:
+    """Потоковый импорт и экспорт статей базы знаний
+
+    Импорт читает входной поток построчно и вставляет статьи пачками
+    с upsert по (portal_id, external_id), экспорт читает таблицу серверным
+    курсором. Память не зависит от размера файла.
+    """
+
+    def __init__(self, chunk_size: int = 1000):
+        self.chunk_size = chunk_size
+
+    # ==== Импорт ====
+
+    def import_ndjson(self, stream: io.IOBase, portal_id: Optional[int] = None) -> Dict[str, int]:
+        """Импорт статей из NDJSON (одна статья в строке)
+
+        portal_id — портал для строк без своего portal_id (None — общие статьи).
+        """
+        return self._import_rows(self._iter_ndjson(stream), portal_id)
+
+    def import_csv(self, stream: io.IOBase, portal_id: Optional[int] = None) -> Dict[str, int]:
+        """Импорт статей из CSV с заголовком"""
+        return self._import_rows(csv.DictReader(self._as_text(stream)), portal_id)
+
+    def _as_text(self, stream: io.IOBase) -> io.TextIOBase:
+        if isinstance(stream, io.TextIOBase):
+            return stream
+        return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+    def _iter_ndjson(self, stream: io.IOBase) -> Iterator[Dict[str, Any]]:
+        for line_number, line in enumerate(self._as_text(stream), start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                logging.error(f"Invalid NDJSON at line {line_number}: {str(e)}")
+                yield {}
+
+    def _normalize_row(self, row: Dict[str, Any], portal_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Приведение строки импорта к полям модели"""
+        title = (row.get('title') or '').strip()
+        content = row.get('content') or ''
+        category = (row.get('category') or '').strip()
+        if not all([title, content, category]):
+            return None
+
+        # Пустое значение в CSV — статья по умолчанию импорта
+        if row.get('portal_id') not in (None, ''):
+            try:
+                portal_id = int(row['portal_id'])
+            except (TypeError, ValueError):
+                return None
+
+        tags = row.get('tags') or ''
+        if isinstance(tags, list):
+            tags = ', '.join(tags)
+
+        is_active = row.get('is_active', True)
+        if isinstance(is_active, str):
+            is_active = is_active.strip().lower() not in ('0', 'false', 'no', '')
+
+        now = datetime.utcnow()
+        return {
+            # Стабильный ключ: внешний идентификатор, иначе заголовок
+            'external_id': str(row.get('external_id') or title)[:255],
+            'portal_id': portal_id,
+            'title': title[:255],
+            'content': content,
+            'category': category[:100],
+            'tags': tags[:500],
+            'is_active': bool(is_active),
+            'created_at': now,
+            'updated_at': now,
+            'usage_count': 0,
+        }
+
+    def _import_rows(self, rows: Iterable[Dict[str, Any]], portal_id: Optional[int] = None) -> Dict[str, int]:
+        stats = {'processed': 0, 'upserted': 0, 'skipped': 0, 'chunks': 0}
+        chunk: Dict[Tuple[Optional[int], str], Dict[str, Any]] = {}
+
+        try:
+            for row in rows:
+                stats['processed'] += 1
+                values = self._normalize_row(row, portal_id)
+                if values is None:
+                    stats['skipped'] += 1
+                    continue
+
+                # Повтор ключа внутри пачки: побеждает последняя строка
+                chunk[(values['portal_id'], values['external_id'])] = values
+                if len(chunk) >= self.chunk_size:
+                    stats['upserted'] += self._upsert_chunk(list(chunk.values()))
+                    stats['chunks'] += 1
+                    chunk = {}
+
+            if chunk:
+                stats['upserted'] += self._upsert_chunk(list(chunk.values()))
+                stats['chunks'] += 1
+
+        except Exception as e:
+            logging.error(f"Error importing knowledge base articles: {str(e)}")
+            db.session.rollback()
+            raise
+
+        self._refresh_statistics()
+        logging.info(f"Knowledge base import finished: {stats}")
+        return stats
+
+    def _upsert_chunk(self, values: List[Dict[str, Any]]) -> int:
+        """Вставка пачки с обновлением существующих статей по (portal_id, external_id)"""
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            return self._upsert_chunk_generic(values)
+
+        # Общие статьи и статьи порталов уникальны по разным частичным индексам
+        shared = [value for value in values if value['portal_id'] is None]
+        own = [value for value in values if value['portal_id'] is not None]
+        if shared:
+            self._execute_upsert(insert, shared, [KnowledgeBaseArticle.external_id],
+                                 KnowledgeBaseArticle.portal_id.is_(None))
+        if own:
+            self._execute_upsert(insert, own, [KnowledgeBaseArticle.portal_id, KnowledgeBaseArticle.external_id],
+                                 KnowledgeBaseArticle.portal_id.is_not(None))
+        db.session.commit()
+        return len(values)
+
+    def _execute_upsert(self, insert, values: List[Dict[str, Any]], index_elements, index_where):
+        statement = insert(KnowledgeBaseArticle).values(values)
+        statement = statement.on_conflict_do_update(
+            index_elements=index_elements,
+            index_where=index_where,
+            set_={
+                'title': statement.excluded.title,
+                'content': statement.excluded.content,
+                'category': statement.excluded.category,
+                'tags': statement.excluded.tags,
+                'is_active': statement.excluded.is_active,
+                'updated_at': statement.excluded.updated_at,
+            }
+        )
+        db.session.execute(statement)
+
+    def _upsert_chunk_generic(self, values: List[Dict[str, Any]]) -> int:
+        """Upsert для СУБД без ON CONFLICT: один SELECT на пачку"""
+        keys = [value['external_id'] for value in values]
+        existing = {
+            (article.portal_id, article.external_id): article
+            for article in KnowledgeBaseArticle.query.filter(
+                KnowledgeBaseArticle.external_id.in_(keys)
+            )
+        }
+
+        new_rows = []
+        for value in values:
+            article = existing.get((value['portal_id'], value['external_id']))
+            if article:
+                for field in ('title', 'content', 'category', 'tags', 'is_active', 'updated_at'):
+                    setattr(article, field, value[field])
+            else:
+                new_rows.append(value)
+
+        if new_rows:
+            db.session.execute(KnowledgeBaseArticle.__table__.insert(), new_rows)
+        db.session.commit()
+        return len(values)
+
+    def _refresh_statistics(self):
+        """Однократное обновление статистики планировщика после массовой загрузки"""
+        try:
+            if db.engine.dialect.name in ('postgresql', 'sqlite'):
+                db.session.execute(text(f"ANALYZE {KnowledgeBaseArticle.__tablename__}"))
+                db.session.commit()
+        except Exception as e:
+            logging.warning(f"Failed to analyze knowledge base table: {str(e)}")
+            db.session.rollback()
+
+    # ==== Экспорт ====
+
+    def _iter_articles(self, include_inactive: bool = False,
+                       portal_id: Optional[int] = None) -> Iterator[KnowledgeBaseArticle]:
+        """Чтение статей серверным курсором пачками по chunk_size (portal_id — только статьи портала)"""
+        statement = select(KnowledgeBaseArticle).order_by(KnowledgeBaseArticle.id)
+        if not include_inactive:
+            statement = statement.where(KnowledgeBaseArticle.is_active == True)
+        if portal_id is not None:
+            statement = statement.where(KnowledgeBaseArticle.portal_id == portal_id)
+
+        result = db.session.execute(statement.execution_options(yield_per=self.chunk_size))
+        for article in result.scalars():
+            yield article
+            # Не даем identity map расти вместе с выгрузкой
+            db.session.expunge(article)
+
+    def _article_row(self, article: KnowledgeBaseArticle) -> Dict[str, Any]:
+        return {
+            'external_id': article.external_id or str(article.id),
+            'portal_id': article.portal_id,
+            'title': article.title,
+            'content': article.content,
+            'category': article.category,
+            'tags': article.tags or '',
+            'is_active': article.is_active,
+        }
+
+    def export_ndjson(self, include_inactive: bool = False, portal_id: Optional[int] = None) -> Iterator[str]:
+        """Потоковый экспорт статей в NDJSON"""
+        for article in self._iter_articles(include_inactive, portal_id):
+            yield json.dumps(self._article_row(article), ensure_ascii=False) + '\n'
+
+    def export_csv(self, include_inactive: bool = False, portal_id: Optional[int] = None) -> Iterator[str]:
+        """Потоковый экспорт статей в CSV"""
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=ARTICLE_FIELDS)
+        writer.writeheader()
+
+        for count, article in enumerate(self._iter_articles(include_inactive, portal_id), start=1):
+            writer.writerow(self._article_row(article))
+            if count % 100 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+
+        yield buffer.getvalue()
@@ -1,93 +1,105 @@
 import logging
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
+from sqlalchemy import or_, update
 from app import db
 from models import KnowledgeBaseArticle
+from lexicons import CATEGORY_KEYWORDS
+from message_classifier import message_classifier
 
 
 class KnowledgeBaseManager:
     """Менеджер для работы с базой знаний"""
     
     def __init__(self):
-        self.categories = {
-            'отпуск': ['отпуск', 'отгул', 'выходной', 'отдых', 'vacation'],
-            'больничный': ['больничный', 'болезнь', 'медицина', 'здоровье', 'лечение'],
-            'зарплата': ['зарплата', 'оплата', 'деньги', 'премия', 'бонус'],
-            'документы': ['документ', 'справка', 'заявление', 'бумаги'],
-            'рабочее время': ['время', 'график', 'смена', 'опоздание', 'переработка'],
-            'льготы': ['льгота', 'компенсация', 'дополнительные выплаты', 'соцпакет'],
-            'обучение': ['обучение', 'курсы', 'тренинг', 'развитие', 'навыки'],
-            'оборудование': ['компьютер', 'техника', 'оборудование', 'ноутбук', 'телефон'],
-            'офис': ['офис', 'рабочее место', 'парковка', 'столовая', 'кухня'],
-            'коллеги': ['коллеги', 'команда', 'сотрудники', 'руководитель', 'начальник']
-        }
+        self.categories = CATEGORY_KEYWORDS
     
-    def search_knowledge_base(self, query: str) -> Optional[str]:
-        """Поиск в базе знаний по запросу"""
+    def _portal_scope(self, portal_id: Optional[int]):
+        """Статьи, видимые порталу: общие (portal_id = NULL) и собственные"""
+        if portal_id is None:
+            return KnowledgeBaseArticle.portal_id.is_(None)
+        return or_(KnowledgeBaseArticle.portal_id.is_(None), KnowledgeBaseArticle.portal_id == portal_id)
+    
+    def search_knowledge_base(self, query: str, classification: Optional[Dict] = None,
+                              portal_id: Optional[int] = None) -> Optional[str]:
+        """Поиск в базе знаний по запросу (classification — результат message_classifier)"""
         try:
-            query_lower = query.lower()
-            
-            # Сначала ищем точные совпадения в заголовках
-            exact_match = KnowledgeBaseArticle.query.filter(
-                KnowledgeBaseArticle.is_active == True,
-                KnowledgeBaseArticle.title.ilike(f'%{query}%')
-            ).first()
-            
-            if exact_match:
-                exact_match.usage_count += 1
-                db.session.commit()
-                return self._format_article_response(exact_match)
-            
-            # Ищем по ключевым словам в категориях
-            relevant_category = self._find_relevant_category(query_lower)
-            if relevant_category:
-                articles = KnowledgeBaseArticle.query.filter(
-                    KnowledgeBaseArticle.is_active == True,
-                    KnowledgeBaseArticle.category == relevant_category
-                ).order_by(KnowledgeBaseArticle.usage_count.desc()).limit(3).all()
-                
-                if articles:
-                    # Возвращаем самую популярную статью из категории
-                    best_article = articles[0]
-                    best_article.usage_count += 1
-                    db.session.commit()
-                    return self._format_article_response(best_article)
-            
-            # Ищем по содержимому статей
-            content_match = KnowledgeBaseArticle.query.filter(
-                KnowledgeBaseArticle.is_active == True,
-                KnowledgeBaseArticle.content.ilike(f'%{query}%')
-            ).order_by(KnowledgeBaseArticle.usage_count.desc()).first()
-            
-            if content_match:
-                content_match.usage_count += 1
-                db.session.commit()
-                return self._format_article_response(content_match)
-            
-            # Ищем по тегам
-            tag_match = KnowledgeBaseArticle.query.filter(
-                KnowledgeBaseArticle.is_active == True,
-                KnowledgeBaseArticle.tags.ilike(f'%{query}%')
-            ).order_by(KnowledgeBaseArticle.usage_count.desc()).first()
-            
-            if tag_match:
-                tag_match.usage_count += 1
-                db.session.commit()
-                return self._format_article_response(tag_match)
-            
+            found = self.find_article_answer(query, classification, portal_id)
+            if found:
+                self.record_usage(found[0])
+                return found[1]
             return None
             
         except Exception as e:
             logging.error(f"Error searching knowledge base: {str(e)}")
             return None
     
-    def _find_relevant_category(self, query: str) -> Optional[str]:
-        """Поиск релевантной категории по ключевым словам"""
-        for category, keywords in self.categories.items():
-            for keyword in keywords:
-                if keyword in query:
-                    return category
+    def find_article_answer(self, query: str, classification: Optional[Dict] = None,
+                            portal_id: Optional[int] = None) -> Optional[Tuple[int, str]]:
+        """Подходящая статья и текст ответа без учета использования (для кэша готовых ответов)"""
+        query_lower = query.lower()
+        scope = self._portal_scope(portal_id)
+        
+        # Сначала ищем точные совпадения в заголовках
+        exact_match = KnowledgeBaseArticle.query.filter(
+            KnowledgeBaseArticle.is_active == True,
+            scope,
+            KnowledgeBaseArticle.title.ilike(f'%{query}%')
+        ).first()
+        
+        if exact_match:
+            return exact_match.id, self._format_article_response(exact_match)
+        
+        # Ищем по ключевым словам в категориях
+        if classification is not None:
+            relevant_category = classification['category']
+        else:
+            relevant_category = self._find_relevant_category(query_lower)
+        if relevant_category:
+            # Возвращаем самую популярную статью из категории
+            best_article = KnowledgeBaseArticle.query.filter(
+                KnowledgeBaseArticle.is_active == True,
+                scope,
+                KnowledgeBaseArticle.category == relevant_category
+            ).order_by(KnowledgeBaseArticle.usage_count.desc()).first()
+            
+            if best_article:
+                return best_article.id, self._format_article_response(best_article)
+        
+        # Ищем по содержимому статей
+        content_match = KnowledgeBaseArticle.query.filter(
+            KnowledgeBaseArticle.is_active == True,
+            scope,
+            KnowledgeBaseArticle.content.ilike(f'%{query}%')
+        ).order_by(KnowledgeBaseArticle.usage_count.desc()).first()
+        
+        if content_match:
+            return content_match.id, self._format_article_response(content_match)
+        
+        # Ищем по тегам
+        tag_match = KnowledgeBaseArticle.query.filter(
+            KnowledgeBaseArticle.is_active == True,
+            scope,
+            KnowledgeBaseArticle.tags.ilike(f'%{query}%')
+        ).order_by(KnowledgeBaseArticle.usage_count.desc()).first()
+        
+        if tag_match:
+            return tag_match.id, self._format_article_response(tag_match)
+        
         return None
     
+    def record_usage(self, article_id: int):
+        """Учет использования статьи одним UPDATE, без загрузки строки"""
+        db.session.execute(
+            update(KnowledgeBaseArticle).where(KnowledgeBaseArticle.id == article_id).values(
+                usage_count=KnowledgeBaseArticle.usage_count + 1
+            )
+        )
+        db.session.commit()
+    
+    def _find_relevant_category(self, query: str) -> Optional[str]:
+        """Поиск релевантной категории по ключевым словам (с учетом словоформ)"""
+        return message_classifier.classify(query)['category']
+    
     def _format_article_response(self, article: KnowledgeBaseArticle) -> str:
         """Форматирование ответа из статьи базы знаний"""
         response = f"📋 **{article.title}**\n\n"
@@ -221,14 +233,23 @@ class KnowledgeBaseManager:
                 }
             ]
             
-            for article_data in default_articles:
-                existing = KnowledgeBaseArticle.query.filter_by(
-                    title=article_data['title']
-                ).first()
-                
-                if not existing:
-                    article = KnowledgeBaseArticle(**article_data)
-                    db.session.add(article)
+            # Один запрос на проверку существующих статей вместо запроса на каждую
+            titles = [article_data['title'] for article_data in default_articles]
+            existing_titles = set()
+            for title, external_id in db.session.query(
+                KnowledgeBaseArticle.title, KnowledgeBaseArticle.external_id
+            ).filter(
+                KnowledgeBaseArticle.portal_id.is_(None),
+                or_(KnowledgeBaseArticle.title.in_(titles), KnowledgeBaseArticle.external_id.in_(titles))
+            ):
+                existing_titles.update((title, external_id))
+            
+            # Ключ импорта — заголовок, как у импорта без external_id
+            db.session.add_all([
+                KnowledgeBaseArticle(external_id=article_data['title'], **article_data)
+                for article_data in default_articles
+                if article_data['title'] not in existing_titles
+            ])
             
             db.session.commit()
             logging.info("Default knowledge base articles created")
@@ -0,0 +1,23 @@
+# Словари для правил без LLM: категории базы знаний, тональность и проверка безопасности
+
+CATEGORY_KEYWORDS = {
+    'отпуск': ['отпуск', 'отгул', 'выходной', 'отдых', 'vacation'],
+    'больничный': ['больничный', 'болезнь', 'медицина', 'здоровье', 'лечение'],
+    'зарплата': ['зарплата', 'оплата', 'деньги', 'премия', 'бонус'],
+    'документы': ['документ', 'справка', 'заявление', 'бумаги'],
+    'рабочее время': ['время', 'график', 'смена', 'опоздание', 'переработка'],
+    'льготы': ['льгота', 'компенсация', 'дополнительные выплаты', 'соцпакет'],
+    'обучение': ['обучение', 'курсы', 'тренинг', 'развитие', 'навыки'],
+    'оборудование': ['компьютер', 'техника', 'оборудование', 'ноутбук', 'телефон'],
+    'офис': ['офис', 'рабочее место', 'парковка', 'столовая', 'кухня'],
+    'коллеги': ['коллеги', 'команда', 'сотрудники', 'руководитель', 'начальник']
+}
+
+POSITIVE_WORDS = ['спасибо', 'хорошо', 'отлично', 'понятно', 'помогли']
+
+NEGATIVE_WORDS = ['плохо', 'не понятно', 'ошибка', 'проблема', 'не работает']
+
+FORBIDDEN_WORDS = [
+    'пароль', 'password', 'логин', 'login',
+    'конфиденциально', 'секретно', 'зарплата других'
+]
@@ -0,0 +1,128 @@
+import os
+import zlib
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import func, select, delete, update
+from app import db
+from models import Conversation, Message, MessageArchive
+
+
+class ConversationLifecycleManager:
+    """Жизненный цикл разговоров и архивирование истории сообщений
+
+    Закрывает разговоры без активности дольше заданного времени и переносит
+    сообщения закрытых разговоров старше срока хранения в сжатый архив,
+    чтобы рабочие таблицы оставались небольшими.
+    """
+
+    def __init__(self):
+        self.idle_minutes = int(os.environ.get('CONVERSATION_IDLE_MINUTES', '60'))
+        self.retention_days = int(os.environ.get('MESSAGE_RETENTION_DAYS', '90'))
+        self.batch_size = int(os.environ.get('LIFECYCLE_BATCH_SIZE', '1000'))
+
+    def close_idle_conversations(self, now: Optional[datetime] = None) -> int:
+        """Закрытие разговоров без сообщений дольше idle_minutes"""
+        try:
+            now = now or datetime.utcnow()
+            idle_before = now - timedelta(minutes=self.idle_minutes)
+
+            last_activity = func.coalesce(func.max(Message.timestamp), Conversation.started_at)
+            idle_query = select(
+                Conversation.id,
+                last_activity.label('last_activity')
+            ).outerjoin(
+                Message, Message.conversation_id == Conversation.id
+            ).where(
+                Conversation.status == 'active'
+            ).group_by(
+                Conversation.id, Conversation.started_at
+            ).having(
+                last_activity < idle_before
+            ).limit(self.batch_size)
+
+            closed = 0
+            while True:
+                rows = db.session.execute(idle_query).all()
+                if not rows:
+                    break
+
+                db.session.execute(update(Conversation), [
+                    {'id': row.id, 'status': 'closed', 'ended_at': row.last_activity}
+                    for row in rows
+                ])
+                db.session.commit()
+                closed += len(rows)
+
+                if len(rows) < self.batch_size:
+                    break
+
+            if closed:
+                logging.info(f"Closed {closed} idle conversations")
+            return closed
+
+        except Exception as e:
+            logging.error(f"Error closing idle conversations: {str(e)}")
+            db.session.rollback()
+            return 0
+
+    def archive_old_messages(self, now: Optional[datetime] = None) -> int:
+        """Перенос сообщений закрытых разговоров старше retention_days в архив"""
+        try:
+            now = now or datetime.utcnow()
+            archive_before = now - timedelta(days=self.retention_days)
+
+            candidates = select(Message).join(
+                Conversation, Message.conversation_id == Conversation.id
+            ).where(
+                Conversation.status != 'active',
+                Message.timestamp < archive_before
+            ).order_by(Message.id).limit(self.batch_size)
+
+            archived = 0
+            while True:
+                messages = db.session.execute(candidates).scalars().all()
+                if not messages:
+                    break
+
+                db.session.execute(MessageArchive.__table__.insert(), [
+                    {
+                        'id': message.id,
+                        'conversation_id': message.conversation_id,
+                        'message_type': message.message_type,
+                        'content_compressed': zlib.compress(message.content.encode('utf-8')),
+                        'timestamp': message.timestamp,
+                        'processed_by_gpt': message.processed_by_gpt,
+                        'response_time': message.response_time,
+                        'knowledge_base_used': message.knowledge_base_used,
+                        'archived_at': now,
+                    }
+                    for message in messages
+                ])
+                db.session.execute(
+                    delete(Message).where(Message.id.in_([message.id for message in messages]))
+                )
+                # Вставка в архив и удаление выполняются в одной транзакции
+                db.session.commit()
+                db.session.expunge_all()
+                archived += len(messages)
+
+                if len(messages) < self.batch_size:
+                    break
+
+            if archived:
+                logging.info(f"Archived {archived} messages older than {archive_before.isoformat()}")
+            return archived
+
+        except Exception as e:
+            logging.error(f"Error archiving messages: {str(e)}")
+            db.session.rollback()
+            return 0
+
+    def run(self) -> Dict[str, int]:
+        """Полный цикл обслуживания"""
+        return {
+            'closed_conversations': self.close_idle_conversations(),
+            'archived_messages': self.archive_old_messages(),
+        }
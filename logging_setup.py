@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional
+
+
+# Стандартные атрибуты LogRecord, которые не нужно дублировать в extra
+_RESERVED_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """Форматирование записей лога в одну строку JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'thread': record.threadName,
+        }
+
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith('_'):
+                data[key] = value
+
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не блокирует поток запроса при переполнении очереди
+
+    Записи, не поместившиеся в очередь, отбрасываются и учитываются в счетчике.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Форматирование сообщения откладывается до фонового потока:
+        # в очередь уходит исходная запись с аргументами
+        return record
+
+
+class PayloadSampler:
+    """Выборочное логирование полных тел запросов"""
+
+    def __init__(self, rate: Optional[float] = None):
+        if rate is None:
+            rate = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', '0.01'))
+        self.rate = max(0.0, min(1.0, rate))
+
+    def should_log(self) -> bool:
+        return self.rate > 0 and random.random() < self.rate
+
+
+class LoggingPipeline:
+    """Неблокирующий конвейер логирования через очередь и фоновый поток"""
+
+    def __init__(self):
+        self.level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+        self.queue_size = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+        self.json_format = os.environ.get('LOG_FORMAT', 'json').lower() == 'json'
+
+        self.queue_handler: Optional[DroppingQueueHandler] = None
+        self.listener: Optional[logging.handlers.QueueListener] = None
+        self._hooks_registered = False
+
+    def configure(self):
+        """Замена обработчиков корневого логгера на очередь с фоновым слушателем"""
+        if self.listener is not None:
+            return
+
+        log_queue = queue.Queue(maxsize=self.queue_size)
+        self.queue_handler = DroppingQueueHandler(log_queue)
+
+        stream_handler = logging.StreamHandler(sys.stderr)
+        if self.json_format:
+            stream_handler.setFormatter(JSONFormatter())
+        else:
+            stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.queue_handler)
+        root.setLevel(self.level)
+
+        self.listener = logging.handlers.QueueListener(
+            log_queue, stream_handler, respect_handler_level=True
+        )
+        self.listener.start()
+
+        if not self._hooks_registered:
+            atexit.register(self.stop)
+            # Поток слушателя не переживает fork (gunicorn с preload_app),
+            # поэтому в дочернем процессе конвейер создается заново
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+            self._hooks_registered = True
+
+    def _reset_after_fork(self):
+        if self.listener is None:
+            return
+        self.listener = None
+        self.queue_handler = None
+        self.configure()
+
+    def stop(self):
+        """Остановка фонового потока с дозаписью очереди"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика конвейера: заполненность очереди и отброшенные записи"""
+        if self.queue_handler is None:
+            return {'enabled': False}
+        return {
+            'enabled': True,
+            'level': self.level,
+            'queue_size': self.queue_handler.queue.qsize(),
+            'queue_capacity': self.queue_size,
+            'dropped_records': self.queue_handler.dropped,
+        }
+
+
+logging_pipeline = LoggingPipeline()
+payload_sampler = PayloadSampler()
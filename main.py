@@ -1,4 +1,11 @@
-from app import app
+from app import create_app
+
+app = create_app()
 
 if __name__ == '__main__':
+    from schema import migrate_schema
+    from warmup import cache_warmer
+    with app.app_context():
+        migrate_schema()
+        cache_warmer.run()
     app.run(host='0.0.0.0', port=5000, debug=True)
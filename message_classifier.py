@@ -0,0 +1,252 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+
+from flask import has_app_context
+from lexicons import CATEGORY_KEYWORDS, POSITIVE_WORDS, NEGATIVE_WORDS, FORBIDDEN_WORDS
+
+
+TOKEN_PATTERN = re.compile(r'[a-zа-яё0-9]+')
+
+# Окончания русских словоформ, самые длинные первыми
+ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'ией', 'иям', 'ием', 'иях', 'ого', 'его', 'ему', 'ому',
+    'ими', 'ыми', 'ой', 'ей', 'ий', 'ый', 'ая', 'яя', 'ое', 'ее', 'ие', 'ые',
+    'ам', 'ям', 'ах', 'ях', 'ом', 'ем', 'ов', 'ев', 'ую', 'юю', 'ию', 'ью',
+    'ия', 'ья', 'ии', 'ьи', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й'
+], key=len, reverse=True)
+MIN_STEM = 3
+
+
+def normalize_word(word: str) -> str:
+    """Приведение слова к основе: нижний регистр, ё→е, отбрасывание окончания"""
+    word = word.lower().replace('ё', 'е')
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Основы слов сообщения в исходном порядке"""
+    return [normalize_word(token) for token in TOKEN_PATTERN.findall(text.lower())]
+
+
+class CompiledLexicon:
+    """Все словари, сведенные в один индекс фраз по основам слов
+
+    Ключ индекса — кортеж основ (фраза из нескольких слов — несколько
+    основ), значение — список (вид, значение) для категорий, тональности,
+    запрещенных слов и триггеров предопределенных ответов.
+    """
+
+    def __init__(self, categories: Dict[str, List[str]], positive: List[str], negative: List[str],
+                 forbidden: List[str], triggers: List[Tuple[int, int, List[str]]]):
+        self.category_order = list(categories)
+        self.response_priority: Dict[int, Tuple[int, int]] = {}
+        self.index: Dict[Tuple[str, ...], List[Tuple[str, Any]]] = {}
+
+        for order, keywords in enumerate(categories.values()):
+            for keyword in keywords:
+                self._add(keyword, ('category', order))
+        for word in positive:
+            self._add(word, ('positive', word))
+        for word in negative:
+            self._add(word, ('negative', word))
+        for word in forbidden:
+            self._add(word, ('forbidden', word))
+        for response_id, priority, keywords in triggers:
+            self.response_priority[response_id] = (-priority, response_id)
+            for keyword in keywords:
+                self._add(keyword, ('response', response_id))
+
+        self.max_phrase = max((len(phrase) for phrase in self.index), default=1)
+        # Для пакетной оценки истории триггеры ответов не нужны
+        self.scoring_index = {
+            phrase: scoring for phrase, entries in self.index.items()
+            if (scoring := [entry for entry in entries if entry[0] != 'response'])
+        }
+
+    def _add(self, phrase: str, entry: Tuple[str, Any]):
+        key = tuple(tokenize(phrase))
+        if key:
+            self.index.setdefault(key, []).append(entry)
+
+    def _match(self, tokens: List[str], index: Dict[Tuple[str, ...], List[Tuple[str, Any]]]):
+        category_order = None
+        positive, negative, forbidden, responses = set(), set(), set(), set()
+
+        # Один проход по словам: на каждой позиции проверяются фразы длиной до max_phrase
+        for start in range(len(tokens)):
+            for length in range(1, min(self.max_phrase, len(tokens) - start) + 1):
+                for kind, value in index.get(tuple(tokens[start:start + length]), ()):
+                    if kind == 'category':
+                        if category_order is None or value < category_order:
+                            category_order = value
+                    elif kind == 'positive':
+                        positive.add(value)
+                    elif kind == 'negative':
+                        negative.add(value)
+                    elif kind == 'forbidden':
+                        forbidden.add(value)
+                    else:
+                        responses.add(value)
+
+        if len(positive) > len(negative):
+            sentiment = 'positive'
+        elif len(negative) > len(positive):
+            sentiment = 'negative'
+        else:
+            sentiment = 'neutral'
+        category = self.category_order[category_order] if category_order is not None else None
+        return category, sentiment, forbidden, responses
+
+    def classify(self, text: str) -> Dict[str, Any]:
+        tokens = tokenize(text)
+        category, sentiment, forbidden, responses = self._match(tokens, self.index)
+        return {
+            'category': category,
+            'unsafe': bool(forbidden),
+            'safety_flags': sorted(forbidden),
+            'sentiment': sentiment,
+            'response_ids': sorted(responses, key=self.response_priority.__getitem__),
+            'tokens': len(tokens),
+        }
+
+    def score_batch(self, texts: List[str]) -> List[Tuple[str, bool, Optional[str]]]:
+        """(тональность, небезопасно, категория) для пачки текстов
+
+        Правила те же, что в classify, но основы слов кэшируются на всю пачку
+        (в истории сообщений слова повторяются), а поиск идет по индексу
+        без триггеров ответов.
+        """
+        stems: Dict[str, str] = {}
+        results = []
+        for text in texts:
+            tokens = []
+            for word in TOKEN_PATTERN.findall(text.lower()):
+                stem = stems.get(word)
+                if stem is None:
+                    stem = stems[word] = normalize_word(word)
+                tokens.append(stem)
+            category, sentiment, forbidden, _ = self._match(tokens, self.scoring_index)
+            results.append((sentiment, bool(forbidden), category))
+        return results
+
+
+class MessageClassifier:
+    """Единый классификатор входящих сообщений с горячей перезагрузкой
+
+    Словари берутся из lexicons.py, файла LEXICON_CONFIG_PATH (JSON с ключами
+    categories, positive, negative, forbidden) и триггеров активных
+    BotResponse. Не чаще раза в LEXICON_RELOAD_SECONDS источники
+    перечитываются в фоне; новый индекс подменяет старый целиком, поэтому
+    классификация не блокируется.
+    """
+
+    def __init__(self):
+        self.config_path = os.environ.get('LEXICON_CONFIG_PATH', '')
+        self.reload_interval = float(os.environ.get('LEXICON_RELOAD_SECONDS', '60'))
+
+        self.app = None
+        self._compiled: Optional[CompiledLexicon] = None
+        self._fingerprint = None
+        self._checked_at = 0.0
+        self._reload_lock = threading.Lock()
+        self.stats = {'classified': 0, 'reloads': 0}
+
+    def init_app(self, app):
+        self.app = app
+
+    def _load_config(self) -> Dict[str, Any]:
+        config = {
+            'categories': CATEGORY_KEYWORDS,
+            'positive': POSITIVE_WORDS,
+            'negative': NEGATIVE_WORDS,
+            'forbidden': FORBIDDEN_WORDS,
+        }
+        if self.config_path and os.path.exists(self.config_path):
+            with open(self.config_path, encoding='utf-8') as config_file:
+                overrides = json.load(config_file)
+            config.update({key: value for key, value in overrides.items() if key in config})
+        return config
+
+    def _load_triggers(self) -> List[Tuple[int, int, List[str]]]:
+        from models import BotResponse
+
+        rows = BotResponse.query.with_entities(
+            BotResponse.id, BotResponse.priority, BotResponse.trigger_keywords
+        ).filter_by(is_active=True).all()
+        return [
+            (response_id, priority or 0, [keyword.strip() for keyword in keywords.split(',') if keyword.strip()])
+            for response_id, priority, keywords in rows
+        ]
+
+    def reload(self, force: bool = False) -> bool:
+        """Перечитывание источников; True, если индекс пересобран"""
+        with self._reload_lock:
+            self._checked_at = time.monotonic()
+            try:
+                config = self._load_config()
+                if has_app_context() or self.app is None:
+                    triggers = self._load_triggers()
+                else:
+                    with self.app.app_context():
+                        triggers = self._load_triggers()
+            except Exception as e:
+                logging.error(f"Failed to load classifier lexicons: {str(e)}")
+                if self._compiled is None:
+                    # Без триггеров классификатор все равно определяет категорию и тональность
+                    self._compiled = CompiledLexicon(
+                        CATEGORY_KEYWORDS, POSITIVE_WORDS, NEGATIVE_WORDS, FORBIDDEN_WORDS, []
+                    )
+                return False
+
+            fingerprint = json.dumps([config, triggers], ensure_ascii=False, sort_keys=True)
+            if not force and fingerprint == self._fingerprint:
+                return False
+
+            self._compiled = CompiledLexicon(
+                config['categories'], config['positive'], config['negative'], config['forbidden'], triggers
+            )
+            self._fingerprint = fingerprint
+            self.stats['reloads'] += 1
+            logging.info(f"Message classifier rebuilt: {len(self._compiled.index)} phrases")
+            return True
+
+    def _reload_in_background(self):
+        if self._reload_lock.locked():
+            return
+        self._checked_at = time.monotonic()
+        threading.Thread(target=self.reload, name='classifier-reload', daemon=True).start()
+
+    @property
+    def lexicon(self) -> CompiledLexicon:
+        """Текущий индекс словарей (для пакетной оценки истории тем же способом)"""
+        if self._compiled is None:
+            self.reload()
+        elif time.monotonic() - self._checked_at >= self.reload_interval:
+            self._reload_in_background()
+        return self._compiled
+
+    def classify(self, text: str) -> Dict[str, Any]:
+        """Категория, флаги безопасности, тональность и кандидаты ответов за один проход"""
+        lexicon = self.lexicon
+        self.stats['classified'] += 1
+        return lexicon.classify(text)
+
+    def get_stats(self) -> Dict[str, Any]:
+        compiled = self._compiled
+        return {
+            **self.stats,
+            'phrases': len(compiled.index) if compiled else 0,
+            'responses': len(compiled.response_priority) if compiled else 0,
+            'config_path': self.config_path or None,
+        }
+
+
+message_classifier = MessageClassifier()
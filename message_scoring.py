@@ -0,0 +1,183 @@
+import os
+import time
+import zlib
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import select
+from app import db
+from models import Message, MessageArchive, MessageScoreDaily, ScoringWatermark
+from message_classifier import CompiledLexicon, message_classifier
+
+
+WATERMARK_NAME = 'message_scores'
+
+
+class MessageScorer:
+    """Пакетная оценка тональности, безопасности и категории сообщений
+
+    Использует тот же CompiledLexicon, что и живая классификация
+    (message_classifier), поэтому дневные итоги считаются по тем же
+    основам слов и словарям, включая LEXICON_CONFIG_PATH. Без явного
+    словаря каждая пачка берет текущий индекс классификатора, так что
+    горячая перезагрузка словарей сразу учитывается и в итогах.
+    """
+
+    def __init__(self, lexicon: Optional[CompiledLexicon] = None):
+        self._lexicon = lexicon
+
+    @property
+    def lexicon(self) -> CompiledLexicon:
+        return self._lexicon or message_classifier.lexicon
+
+    def score(self, texts: List[str]) -> List[Tuple[str, bool, str]]:
+        """(тональность, небезопасно, категория) для каждого текста пачки"""
+        return [
+            (sentiment, unsafe, category or '')
+            for sentiment, unsafe, category in self.lexicon.score_batch(texts)
+        ]
+
+
+class MessageScoringJob:
+    """Инкрементальная оценка истории сообщений с записью дневных итогов
+
+    Сообщения пользователей (рабочая таблица и архив) читаются пачками
+    по id после водяного знака; итоги пачки и новый водяной знак
+    фиксируются одной транзакцией, поэтому повторный запуск продолжает
+    с места остановки и не учитывает сообщения дважды.
+    """
+
+    def __init__(self, lexicon: Optional[CompiledLexicon] = None, chunk_size: Optional[int] = None):
+        self.scorer = MessageScorer(lexicon)
+        self.chunk_size = chunk_size or int(os.environ.get('SCORING_CHUNK_SIZE', '5000'))
+        # Недавние сообщения пропускаются: параллельные транзакции могут еще не зафиксировать меньшие id
+        self.settle_seconds = int(os.environ.get('SCORING_SETTLE_SECONDS', '60'))
+
+    def _watermark(self) -> ScoringWatermark:
+        watermark = db.session.get(ScoringWatermark, WATERMARK_NAME)
+        if watermark is None:
+            watermark = ScoringWatermark(name=WATERMARK_NAME, last_message_id=0)
+            db.session.add(watermark)
+            db.session.commit()
+        return watermark
+
+    def _next_chunk(self, after_id: int, settled_before: datetime) -> List[Tuple[int, datetime, str]]:
+        """Следующие сообщения пользователей по id из обеих таблиц (без повторов id)"""
+        rows: Dict[int, Tuple[int, datetime, str]] = {}
+        cutoff = None
+        sources = (
+            (Message, Message.content, False),
+            (MessageArchive, MessageArchive.content_compressed, True),
+        )
+        for model, content_column, compressed in sources:
+            batch = db.session.execute(
+                select(model.id, model.timestamp, content_column).where(
+                    model.id > after_id,
+                    model.message_type == 'user',
+                    model.timestamp < settled_before
+                ).order_by(model.id).limit(self.chunk_size)
+            ).all()
+            # Полная пачка: дальше ее последнего id в этой таблице данных не читали
+            if len(batch) == self.chunk_size:
+                cutoff = batch[-1][0] if cutoff is None else min(cutoff, batch[-1][0])
+            for message_id, timestamp, content in batch:
+                if compressed:
+                    content = zlib.decompress(content).decode('utf-8')
+                # Сообщение, перенесенное в архив между двумя чтениями, попадает в обе выборки
+                rows.setdefault(message_id, (message_id, timestamp, content or ''))
+
+        merged = sorted(rows.values(), key=lambda row: row[0])
+        if cutoff is not None:
+            merged = [row for row in merged if row[0] <= cutoff]
+        return merged
+
+    def _rollup(self, rows: List[Tuple[int, datetime, str]]) -> Dict[Tuple, Dict[str, int]]:
+        totals: Dict[Tuple, Dict[str, int]] = {}
+        scores = self.scorer.score([content for _, _, content in rows])
+        for (_, timestamp, _), (sentiment, unsafe, category) in zip(rows, scores):
+            key = (timestamp.date(), category)
+            bucket = totals.setdefault(key, {'messages': 0, 'positive': 0, 'negative': 0, 'neutral': 0, 'unsafe': 0})
+            bucket['messages'] += 1
+            bucket[sentiment] += 1
+            bucket['unsafe'] += int(unsafe)
+        return totals
+
+    def _apply_rollup(self, totals: Dict[Tuple, Dict[str, int]]):
+        """Прибавление итогов пачки к дневным строкам (без фиксации транзакции)"""
+        values = [{'day': day, 'category': category, **counts} for (day, category), counts in totals.items()]
+        if not values:
+            return
+
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            return self._apply_rollup_generic(values)
+
+        statement = insert(MessageScoreDaily).values(values)
+        table = MessageScoreDaily.__table__
+        statement = statement.on_conflict_do_update(
+            index_elements=[MessageScoreDaily.day, MessageScoreDaily.category],
+            set_={
+                field: table.c[field] + statement.excluded[field]
+                for field in ('messages', 'positive', 'negative', 'neutral', 'unsafe')
+            }
+        )
+        db.session.execute(statement)
+
+    def _apply_rollup_generic(self, values: List[Dict[str, Any]]):
+        """Для СУБД без ON CONFLICT: один SELECT по дням пачки"""
+        existing = {
+            (row.day, row.category): row
+            for row in MessageScoreDaily.query.filter(
+                MessageScoreDaily.day.in_({value['day'] for value in values})
+            )
+        }
+        for value in values:
+            row = existing.get((value['day'], value['category']))
+            if row is None:
+                db.session.add(MessageScoreDaily(**value))
+                continue
+            for field in ('messages', 'positive', 'negative', 'neutral', 'unsafe'):
+                setattr(row, field, (getattr(row, field) or 0) + value[field])
+
+    def run(self, limit: Optional[int] = None) -> Dict[str, Any]:
+        """Оценка новых сообщений после водяного знака"""
+        stats = {'messages': 0, 'chunks': 0}
+        started = time.monotonic()
+        settled_before = datetime.utcnow() - timedelta(seconds=self.settle_seconds)
+
+        try:
+            watermark = self._watermark()
+            while limit is None or stats['messages'] < limit:
+                rows = self._next_chunk(watermark.last_message_id, settled_before)
+                if not rows:
+                    break
+
+                self._apply_rollup(self._rollup(rows))
+                watermark.last_message_id = rows[-1][0]
+                watermark.updated_at = datetime.utcnow()
+                db.session.commit()
+
+                stats['messages'] += len(rows)
+                stats['chunks'] += 1
+        except Exception as e:
+            logging.error(f"Error scoring messages: {str(e)}")
+            db.session.rollback()
+            raise
+
+        elapsed = time.monotonic() - started
+        stats['seconds'] = round(elapsed, 2)
+        stats['per_second'] = round(stats['messages'] / elapsed, 1) if elapsed else 0.0
+        stats['watermark'] = watermark.last_message_id
+        logging.info(f"Message scoring finished: {stats}")
+        return stats
+
+    def reset(self):
+        """Пересчет с начала: удаление итогов и водяного знака"""
+        MessageScoreDaily.query.delete()
+        ScoringWatermark.query.filter_by(name=WATERMARK_NAME).delete()
+        db.session.commit()
@@ -1,11 +1,30 @@
+import zlib
 from datetime import datetime
 from app import db
 
 
+class Portal(db.Model):
+    """Портал Битрикс24, обслуживаемый развертыванием (арендатор)
+
+    Данные портала по умолчанию, настроенного переменными BITRIX_*,
+    хранятся с portal_id = NULL.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    domain = db.Column(db.String(255), unique=True, nullable=False)  # example.bitrix24.ru
+    application_token = db.Column(db.String(255), unique=True)  # auth.application_token из событий
+    webhook_url = db.Column(db.String(500))  # входящий веб-хук REST API портала
+    client_id = db.Column(db.String(255))  # CLIENT_ID приложения для imbot.*
+    rate_limit = db.Column(db.Float)  # запросов в секунду к REST API, NULL — по умолчанию
+    max_in_flight = db.Column(db.Integer)  # одновременных обработок, NULL — по умолчанию
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
 class User(db.Model):
     """Модель пользователя Битрикс24"""
     id = db.Column(db.Integer, primary_key=True)
-    bitrix_user_id = db.Column(db.String(50), unique=True, nullable=False)
+    portal_id = db.Column(db.Integer, db.ForeignKey('portal.id'), index=True)
+    bitrix_user_id = db.Column(db.String(50), nullable=False)  # уникален в пределах портала
     name = db.Column(db.String(255), nullable=False)
     email = db.Column(db.String(255))
     department = db.Column(db.String(255))
@@ -15,19 +34,36 @@ class User(db.Model):
     
     conversations = db.relationship('Conversation', backref='user', lazy=True)
 
+    __table_args__ = (
+        # NULL в portal_id не участвует в уникальности, поэтому портал по умолчанию — отдельным индексом
+        db.Index('ux_user_shared_bitrix_user_id', 'bitrix_user_id', unique=True,
+                 postgresql_where=db.text('portal_id IS NULL'), sqlite_where=db.text('portal_id IS NULL')),
+        db.Index('ux_user_tenant_bitrix_user_id', 'portal_id', 'bitrix_user_id', unique=True,
+                 postgresql_where=db.text('portal_id IS NOT NULL'), sqlite_where=db.text('portal_id IS NOT NULL')),
+    )
+
 
 class Conversation(db.Model):
     """Модель разговора с ботом"""
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    portal_id = db.Column(db.Integer, db.ForeignKey('portal.id'), index=True)
     chat_id = db.Column(db.String(100), nullable=False)
     started_at = db.Column(db.DateTime, default=datetime.utcnow)
     ended_at = db.Column(db.DateTime)
     status = db.Column(db.String(20), default='active')  # active, closed, escalated
     escalated_to_human = db.Column(db.Boolean, default=False)
+    summary = db.Column(db.Text)  # краткое резюме завершенного разговора
+    summarized_at = db.Column(db.DateTime)
     
     messages = db.relationship('Message', backref='conversation', lazy=True, cascade='all, delete-orphan')
 
+    __table_args__ = (
+        db.Index('ix_conversation_started_at_id', 'started_at', 'id'),
+        db.Index('ix_conversation_user_chat_status', 'user_id', 'chat_id', 'status'),
+        db.Index('ix_conversation_status_summarized_id', 'status', 'summarized_at', 'id'),
+    )
+
 
 class Message(db.Model):
     """Модель сообщения в разговоре"""
@@ -40,10 +76,85 @@ class Message(db.Model):
     response_time = db.Column(db.Float)  # время ответа в секундах
     knowledge_base_used = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        db.Index('ix_message_conversation_timestamp_id', 'conversation_id', 'timestamp', 'id'),
+    )
+
+
+class MessageArchive(db.Model):
+    """Архив старых сообщений со сжатым содержимым"""
+    id = db.Column(db.Integer, primary_key=True)  # совпадает с исходным Message.id
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False, index=True)
+    message_type = db.Column(db.String(20), nullable=False)
+    content_compressed = db.Column(db.LargeBinary, nullable=False)  # zlib
+    timestamp = db.Column(db.DateTime, index=True)
+    processed_by_gpt = db.Column(db.Boolean, default=False)
+    response_time = db.Column(db.Float)
+    knowledge_base_used = db.Column(db.Boolean, default=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @property
+    def content(self):
+        """Распакованный текст сообщения"""
+        return zlib.decompress(self.content_compressed).decode('utf-8')
+
+
+class OutboxMessage(db.Model):
+    """Исходящее сообщение или задача для Битрикс24 (transactional outbox)"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # message, task
+    portal_id = db.Column(db.Integer, db.ForeignKey('portal.id'))  # через какой портал доставлять
+    dialog_id = db.Column(db.String(100), nullable=False)  # ключ упорядочивания
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    status = db.Column(db.String(20), default='pending')  # pending, sending, sent, dead
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_outbox_status_dialog_id', 'status', 'dialog_id', 'id'),
+    )
+
+
+class InboxMessage(db.Model):
+    """Входящее сообщение, ожидающее обработки владельцем партиции чата"""
+    id = db.Column(db.Integer, primary_key=True)
+    portal_id = db.Column(db.Integer, db.ForeignKey('portal.id'))
+    partition_no = db.Column(db.Integer, nullable=False)  # хеш чата по модулю CHAT_PARTITIONS
+    dialog_id = db.Column(db.String(100), nullable=False)  # ключ упорядочивания
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON разобранного веб-хука
+    cost_class = db.Column(db.String(20), default='llm')  # класс допуска AdmissionController: kb, llm
+    acknowledged = db.Column(db.Boolean, default=False)  # отправлено подтверждение о долгом ожидании
+    status = db.Column(db.String(20), default='pending')  # pending, processing, dead
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(150))  # воркер, захвативший запись
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_inbox_partition_status_id', 'partition_no', 'status', 'id'),
+        db.Index('ix_inbox_dialog_status_id', 'dialog_id', 'status', 'id'),
+    )
+
+
+class AffinityMember(db.Model):
+    """Живой воркер, участвующий в распределении партиций чатов"""
+    worker_id = db.Column(db.String(150), primary_key=True)  # хост:pid:суффикс
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    heartbeat_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 
 class KnowledgeBaseArticle(db.Model):
     """Модель статьи базы знаний"""
     id = db.Column(db.Integer, primary_key=True)
+    external_id = db.Column(db.String(255))  # стабильный ключ для импорта, уникален в пределах портала
+    portal_id = db.Column(db.Integer, db.ForeignKey('portal.id'), index=True)  # NULL — общая для всех порталов
     title = db.Column(db.String(255), nullable=False)
     content = db.Column(db.Text, nullable=False)
     category = db.Column(db.String(100), nullable=False)
@@ -52,6 +163,15 @@ class KnowledgeBaseArticle(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
     usage_count = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        db.Index('ix_kb_article_updated_at_id', 'updated_at', 'id'),
+        # NULL в portal_id не участвует в уникальности, поэтому общие статьи — отдельным индексом
+        db.Index('ux_kb_article_shared_external_id', 'external_id', unique=True,
+                 postgresql_where=db.text('portal_id IS NULL'), sqlite_where=db.text('portal_id IS NULL')),
+        db.Index('ux_kb_article_portal_external_id', 'portal_id', 'external_id', unique=True,
+                 postgresql_where=db.text('portal_id IS NOT NULL'), sqlite_where=db.text('portal_id IS NOT NULL')),
+    )
     
     def get_tags_list(self):
         """Возвращает список тегов"""
@@ -61,6 +181,7 @@ class KnowledgeBaseArticle(db.Model):
 class BotResponse(db.Model):
     """Модель предопределенных ответов бота"""
     id = db.Column(db.Integer, primary_key=True)
+    portal_id = db.Column(db.Integer, db.ForeignKey('portal.id'))  # NULL — общий для всех порталов
     trigger_keywords = db.Column(db.String(500), nullable=False)  # ключевые слова для активации
     response_text = db.Column(db.Text, nullable=False)
     category = db.Column(db.String(100), nullable=False)
@@ -81,3 +202,26 @@ class Analytics(db.Model):
     knowledge_base_hits = db.Column(db.Integer, default=0)
     most_common_category = db.Column(db.String(100))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class MessageScoreDaily(db.Model):
+    """Дневные итоги тональности и безопасности сообщений пользователей по категориям"""
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    category = db.Column(db.String(100), nullable=False, default='')  # '' — без категории
+    messages = db.Column(db.Integer, default=0)
+    positive = db.Column(db.Integer, default=0)
+    negative = db.Column(db.Integer, default=0)
+    neutral = db.Column(db.Integer, default=0)
+    unsafe = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'category', name='ux_message_score_daily_day_category'),
+    )
+
+
+class ScoringWatermark(db.Model):
+    """Последнее обработанное сообщение для инкрементальных пакетных задач"""
+    name = db.Column(db.String(50), primary_key=True)
+    last_message_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
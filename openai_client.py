@@ -1,6 +1,8 @@
 import os
 import openai
 
+from single_flight import llm_single_flight, prompt_key
+
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 def ask_chatgpt(message):
@@ -16,3 +18,34 @@ def ask_chatgpt(message):
         return response['choices'][0]['message']['content']
     except Exception as e:
         return f"❗ Ошибка: {str(e)}"
+
+
+async def aask_chatgpt(message, http_client=None):
+    try:
+        if http_client is None:
+            from http_pool import get_async_client
+            http_client = get_async_client()
+
+        payload = {
+            "model": "gpt-4",
+            "messages": [
+                {"role": "system", "content": "Ты — корпоративный помощник. Отвечай понятно и лаконично."},
+                {"role": "user", "content": message}
+            ],
+            "temperature": 0.7
+        }
+
+        async def complete():
+            response = await http_client.post(
+                os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions"),
+                headers={"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}"},
+                json=payload,
+                timeout=60
+            )
+            response.raise_for_status()
+            return response.json()['choices'][0]['message']['content']
+
+        # Запрос без истории разговора: одинаковые одновременные вопросы объединяются
+        return await llm_single_flight.ado(prompt_key(payload), complete)
+    except Exception as e:
+        return f"❗ Ошибка: {str(e)}"
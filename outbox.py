@@ -0,0 +1,307 @@
+import os
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+from sqlalchemy import and_, or_, exists, func, select, update
+from sqlalchemy.orm import aliased
+from app import db
+from models import OutboxMessage
+
+
+def enqueue_message(dialog_id: str, message: str, portal_id: Optional[int] = None) -> OutboxMessage:
+    """Добавление исходящего сообщения в outbox
+
+    Запись только добавляется в сессию: фиксируется вызывающим кодом
+    в той же транзакции, что и сообщение бота.
+    """
+    entry = OutboxMessage(
+        kind='message',
+        portal_id=portal_id,
+        dialog_id=str(dialog_id),
+        payload=json.dumps({'message': message}, ensure_ascii=False)
+    )
+    db.session.add(entry)
+    return entry
+
+
+def enqueue_task(dialog_id: str, title: str, description: str, responsible_id: str,
+                 portal_id: Optional[int] = None) -> OutboxMessage:
+    """Добавление задачи эскалации в outbox (без commit)"""
+    entry = OutboxMessage(
+        kind='task',
+        portal_id=portal_id,
+        dialog_id=str(dialog_id),
+        payload=json.dumps({
+            'title': title,
+            'description': description,
+            'responsible_id': responsible_id
+        }, ensure_ascii=False)
+    )
+    db.session.add(entry)
+    return entry
+
+
+class OutboxDispatcher:
+    """Доставка записей outbox в Битрикс24
+
+    За один проход берется только первая недоставленная запись каждого диалога,
+    поэтому порядок внутри диалога сохраняется, а разные диалоги обрабатываются
+    параллельно. Записи захватываются с арендой (locked_until), так что несколько
+    диспетчеров не отправляют одно и то же, а зависшие записи подбираются повторно.
+
+    Записи доставляются через клиент своего портала; если лимит частоты
+    портала исчерпан, запись откладывается до появления свободного запроса,
+    не задерживая доставку на другие порталы.
+    """
+
+    def __init__(self, bitrix_client, portal_registry=None):
+        self.bitrix_client = bitrix_client
+        self.portal_registry = portal_registry
+        self.batch_size = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+        self.max_attempts = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+        self.base_backoff = float(os.environ.get('OUTBOX_BACKOFF_SECONDS', '2'))
+        self.lease_seconds = int(os.environ.get('OUTBOX_LEASE_SECONDS', '60'))
+        self.poll_interval = float(os.environ.get('OUTBOX_POLL_INTERVAL', '0.5'))
+
+        self._stats_lock = threading.Lock()
+        self._stats = {'sent': 0, 'failed_attempts': 0, 'dead_lettered': 0, 'throttled': 0, 'leases_lost': 0}
+        self._stop = threading.Event()
+
+    def _claimable_condition(self, now: datetime):
+        return or_(
+            and_(OutboxMessage.status == 'pending', OutboxMessage.next_attempt_at <= now),
+            and_(OutboxMessage.status == 'sending', OutboxMessage.locked_until < now)
+        )
+
+    def claim_batch(self) -> List[OutboxMessage]:
+        """Захват первых недоставленных записей по каждому диалогу"""
+        now = datetime.utcnow()
+        earlier = aliased(OutboxMessage)
+
+        statement = select(OutboxMessage).where(
+            self._claimable_condition(now),
+            ~exists().where(
+                earlier.dialog_id == OutboxMessage.dialog_id,
+                earlier.portal_id.is_not_distinct_from(OutboxMessage.portal_id),
+                earlier.id < OutboxMessage.id,
+                earlier.status.in_(['pending', 'sending'])
+            )
+        ).order_by(OutboxMessage.id).limit(self.batch_size)
+
+        if db.engine.dialect.name == 'postgresql':
+            statement = statement.with_for_update(skip_locked=True)
+
+        candidates = db.session.execute(statement).scalars().all()
+        entries = []
+        for entry in candidates:
+            # Условный UPDATE: без блокировок строк (SQLite) запись получает только один диспетчер
+            result = db.session.execute(
+                update(OutboxMessage).where(
+                    OutboxMessage.id == entry.id,
+                    self._claimable_condition(now)
+                ).values(
+                    status='sending',
+                    locked_until=now + timedelta(seconds=self.lease_seconds)
+                ).execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 1:
+                entries.append(entry)
+        # После commit атрибуты записей перечитываются из БД
+        db.session.commit()
+        return entries
+
+    def renew_lease(self, entry: OutboxMessage) -> bool:
+        """Продление аренды перед отправкой записи
+
+        Пачка отправляется последовательно и может идти дольше аренды;
+        False — аренда уже истекла и запись захватил другой диспетчер.
+        """
+        result = db.session.execute(
+            update(OutboxMessage).where(
+                OutboxMessage.id == entry.id,
+                OutboxMessage.status == 'sending',
+                OutboxMessage.locked_until == entry.locked_until
+            ).values(
+                locked_until=datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+            ).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    def _client_for(self, entry: OutboxMessage):
+        if entry.portal_id is None or self.portal_registry is None:
+            return self.bitrix_client
+        portal = self.portal_registry.get(entry.portal_id)
+        return portal.client if portal is not None else None
+
+    def _deliver(self, entry: OutboxMessage, client) -> Optional[str]:
+        """Отправка записи; возвращает текст ошибки или None"""
+        if client is None:
+            return f"portal {entry.portal_id} is not active"
+        payload = json.loads(entry.payload)
+
+        if entry.kind == 'message':
+            if client.send_message(entry.dialog_id, payload['message']):
+                return None
+            return 'send_message failed'
+
+        if entry.kind == 'task':
+            task_id = client.create_task(
+                payload['title'], payload['description'], payload['responsible_id']
+            )
+            return None if task_id else 'create_task failed'
+
+        return f"unknown outbox kind: {entry.kind}"
+
+    def dispatch_batch(self) -> int:
+        """Один проход диспетчера; возвращает число обработанных записей"""
+        try:
+            entries = self.claim_batch()
+        except Exception as e:
+            logging.error(f"Error claiming outbox batch: {str(e)}")
+            db.session.rollback()
+            return 0
+
+        for entry in entries:
+            if not self.renew_lease(entry):
+                self._increment('leases_lost')
+                logging.warning(f"Outbox entry {entry.id} lease expired mid-batch, left to its new owner")
+                continue
+
+            client = self._client_for(entry)
+            delay = client.throttle_delay() if client is not None else 0.0
+            if delay > 0:
+                # Лимит портала исчерпан: запись возвращается в очередь без попытки
+                entry.status = 'pending'
+                entry.locked_until = None
+                entry.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+                self._increment('throttled')
+                db.session.commit()
+                continue
+
+            try:
+                error = self._deliver(entry, client)
+            except Exception as e:
+                error = str(e)
+
+            now = datetime.utcnow()
+            entry.locked_until = None
+            if error is None:
+                entry.status = 'sent'
+                entry.sent_at = now
+                self._increment('sent')
+            else:
+                entry.attempts = (entry.attempts or 0) + 1
+                entry.last_error = error
+                self._increment('failed_attempts')
+                if entry.attempts >= self.max_attempts:
+                    entry.status = 'dead'
+                    self._increment('dead_lettered')
+                    logging.error(f"Outbox entry {entry.id} moved to dead letter: {error}")
+                else:
+                    entry.status = 'pending'
+                    backoff = self.base_backoff * (2 ** (entry.attempts - 1))
+                    entry.next_attempt_at = now + timedelta(seconds=backoff)
+                    logging.warning(f"Outbox entry {entry.id} failed, retry in {backoff:.0f}s: {error}")
+            db.session.commit()
+
+        return len(entries)
+
+    def _increment(self, key: str):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def run_forever(self, app):
+        """Цикл диспетчера: пачки без паузы, пока есть работа, иначе ожидание"""
+        while not self._stop.is_set():
+            try:
+                with app.app_context():
+                    processed = self.dispatch_batch()
+            except Exception as e:
+                logging.error(f"Outbox dispatcher error: {str(e)}")
+                processed = 0
+            if not processed:
+                self._stop.wait(self.poll_interval)
+
+    def start_background(self, app) -> threading.Thread:
+        """Запуск диспетчера в фоновом потоке процесса"""
+        self._stop.clear()
+        thread = threading.Thread(target=self.run_forever, args=(app,), name='outbox-dispatcher', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики outbox: очередь, возраст старейшей записи, мертвые записи"""
+        rows = db.session.query(
+            OutboxMessage.status, func.count(OutboxMessage.id), func.min(OutboxMessage.created_at)
+        ).filter(
+            OutboxMessage.status.in_(['pending', 'sending', 'dead'])
+        ).group_by(OutboxMessage.status).all()
+
+        by_status = {status: {'count': count, 'oldest': oldest} for status, count, oldest in rows}
+        oldest_pending = [
+            by_status[status]['oldest'] for status in ('pending', 'sending')
+            if status in by_status and by_status[status]['oldest']
+        ]
+        lag_seconds = (datetime.utcnow() - min(oldest_pending)).total_seconds() if oldest_pending else 0.0
+
+        with self._stats_lock:
+            process_stats = dict(self._stats)
+
+        return {
+            'pending': by_status.get('pending', {}).get('count', 0),
+            'in_flight': by_status.get('sending', {}).get('count', 0),
+            'dead': by_status.get('dead', {}).get('count', 0),
+            'lag_seconds': round(lag_seconds, 2),
+            'process': process_stats,
+        }
+
+    def _superseded_condition(self):
+        """Мертвая запись, после которой в ее диалоге уже доставлено более позднее сообщение"""
+        later = aliased(OutboxMessage)
+        return exists().where(
+            later.dialog_id == OutboxMessage.dialog_id,
+            later.portal_id.is_not_distinct_from(OutboxMessage.portal_id),
+            later.id > OutboxMessage.id,
+            later.status == 'sent'
+        )
+
+    def retry_dead(self) -> Dict[str, Any]:
+        """Возврат мертвых записей в очередь без нарушения порядка диалога
+
+        Повторно отправляются только записи, после которых в диалоге еще
+        ничего не доставлено. Остальные пришли бы пользователю не по порядку:
+        они остаются мертвыми и возвращаются списком для ручного разбора.
+        """
+        result = db.session.execute(
+            update(OutboxMessage).where(
+                OutboxMessage.status == 'dead',
+                ~self._superseded_condition()
+            ).values(
+                status='pending', attempts=0, next_attempt_at=datetime.utcnow()
+            ).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+        superseded = OutboxMessage.query.filter(
+            OutboxMessage.status == 'dead',
+            self._superseded_condition()
+        ).order_by(OutboxMessage.id).all()
+
+        return {
+            'requeued': result.rowcount,
+            'superseded': [{
+                'id': entry.id,
+                'kind': entry.kind,
+                'portal_id': entry.portal_id,
+                'dialog_id': entry.dialog_id,
+                'last_error': entry.last_error,
+                'created_at': entry.created_at.isoformat() if entry.created_at else None,
+            } for entry in superseded],
+        }
@@ -0,0 +1,63 @@
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Tuple, List, Any
+
+from sqlalchemy import and_, or_
+
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursorError(ValueError):
+    """Некорректный курсор пагинации"""
+
+
+def encode_cursor(timestamp: datetime, row_id: int) -> str:
+    """Кодирование позиции (timestamp, id) в непрозрачный курсор"""
+    raw = json.dumps([timestamp.isoformat() if timestamp else None, row_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], int]:
+    """Декодирование курсора в позицию (timestamp, id)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, row_id = json.loads(raw)
+        return (datetime.fromisoformat(timestamp) if timestamp else None), int(row_id)
+    except Exception as e:
+        raise InvalidCursorError(f"Invalid cursor: {cursor}") from e
+
+
+def parse_page_size(value: Optional[int]) -> int:
+    """Ограничение размера страницы разумными пределами"""
+    if not value or value < 1:
+        return DEFAULT_PAGE_SIZE
+    return min(value, MAX_PAGE_SIZE)
+
+
+def keyset_filter(timestamp_column, id_column, cursor: Optional[str]):
+    """Условие для выборки строк после курсора при сортировке (timestamp, id) DESC"""
+    if not cursor:
+        return None
+    timestamp, row_id = decode_cursor(cursor)
+    return or_(
+        timestamp_column < timestamp,
+        and_(timestamp_column == timestamp, id_column < row_id)
+    )
+
+
+def keyset_page(query, timestamp_column, id_column, cursor: Optional[str], limit: int) -> Tuple[List[Any], bool]:
+    """Выборка одной страницы по ключу (timestamp, id) DESC
+
+    Запрашивается limit + 1 строка, чтобы узнать, есть ли следующая страница,
+    без отдельного COUNT.
+    """
+    condition = keyset_filter(timestamp_column, id_column, cursor)
+    if condition is not None:
+        query = query.filter(condition)
+
+    rows = query.order_by(timestamp_column.desc(), id_column.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    return rows[:limit], has_more
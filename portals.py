@@ -0,0 +1,304 @@
+import os
+import time
+import hmac
+import asyncio
+import logging
+import threading
+from typing import Dict, Any, Optional, Tuple
+from urllib.parse import urlparse
+
+from flask import has_app_context
+from admission import AdmissionClass
+from bitrix_client import BitrixClient
+
+
+DEFAULT_PORTAL_KEY = 'default'
+
+
+class UnknownPortalError(Exception):
+    """Событие пришло от незарегистрированного портала или с чужим application_token"""
+
+
+class TokenBucket:
+    """Ограничение частоты запросов к REST API портала
+
+    Запас burst запросов пополняется со скоростью rate в секунду, как
+    лимит самого Битрикс24. Ожидание резервируется под блокировкой,
+    а спит вызывающий поток (или корутина) уже без нее.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.stats = {'acquired': 0, 'throttled': 0}
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def _reserve(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            self.stats['acquired'] += 1
+            if self._tokens >= 0:
+                return 0.0
+            self.stats['throttled'] += 1
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def delay(self) -> float:
+        """Время до появления свободного запроса (без резервирования)"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refill(time.monotonic())
+            return {'rate': self.rate, 'burst': self.burst, 'tokens': round(self._tokens, 2), **self.stats}
+
+
+class PortalContext:
+    """Ресурсы одного портала: учетные данные, пул соединений, лимиты и квоты
+
+    Квота одновременных обработок (admission) и квота отложенных сообщений
+    берутся до общих классов AdmissionController, поэтому всплеск на одном
+    портале упирается в собственные лимиты и не занимает слоты остальных.
+    """
+
+    def __init__(self, key: str, portal_id: Optional[int], domain: str, client: BitrixClient,
+                 application_token: str = '', client_id: str = '',
+                 max_in_flight: int = 16, queue_limit: int = 32, deferred_limit: int = 100, app=None):
+        self.key = key
+        self.portal_id = portal_id
+        self.domain = domain
+        self.client = client
+        self.application_token = application_token
+        self.client_id = client_id
+        self.app = app
+
+        self.admission = AdmissionClass(f'portal:{key}', max_in_flight, queue_limit)
+        self.deferred_limit = deferred_limit
+        self.deferred_pending = 0
+        self.deferred_rejected = 0
+        self._lock = threading.Lock()
+        self._enricher = None
+
+    @property
+    def enricher(self):
+        """Обогащение профилей через REST API этого портала (создается при первом обращении)"""
+        if self._enricher is None:
+            with self._lock:
+                if self._enricher is None:
+                    from profile_enrichment import ProfileEnricher
+                    self._enricher = ProfileEnricher(self.client, self.app, self.portal_id)
+        return self._enricher
+
+    def reserve_deferred(self) -> bool:
+        with self._lock:
+            if self.deferred_pending >= self.deferred_limit:
+                self.deferred_rejected += 1
+                return False
+            self.deferred_pending += 1
+            return True
+
+    def finish_deferred(self):
+        with self._lock:
+            self.deferred_pending -= 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        limiter = self.client.rate_limiter
+        with self._lock:
+            deferred = {'pending': self.deferred_pending, 'rejected': self.deferred_rejected, 'limit': self.deferred_limit}
+        return {
+            'portal_id': self.portal_id,
+            'domain': self.domain,
+            'admission': self.admission.get_stats(),
+            'deferred': deferred,
+            'rate_limit': limiter.get_stats() if limiter is not None else None,
+            'profiles': self._enricher.get_stats() if self._enricher is not None else None,
+        }
+
+
+class PortalRegistry:
+    """Реестр порталов Битрикс24, обслуживаемых одним развертыванием
+
+    Портал события определяется по auth.application_token, затем по
+    auth.domain. Порталы хранятся в таблице Portal и перечитываются не
+    чаще раза в PORTAL_RELOAD_SECONDS; контексты порталов, настройки
+    которых не изменились, сохраняются вместе с пулами и счетчиками.
+    Портал по умолчанию (portal_id = NULL) настраивается прежними
+    переменными BITRIX_* и принимает события без auth.
+    """
+
+    def __init__(self):
+        self.reload_interval = float(os.environ.get('PORTAL_RELOAD_SECONDS', '30'))
+        self.allow_default = os.environ.get('PORTAL_ALLOW_DEFAULT', 'true').lower() == 'true'
+        self.rate_limit = float(os.environ.get('BITRIX_RATE_PER_SECOND', '2'))
+        self.rate_burst = int(os.environ.get('BITRIX_RATE_BURST', '50'))
+        self.max_in_flight = int(os.environ.get('PORTAL_MAX_IN_FLIGHT', '16'))
+        self.queue_limit = int(os.environ.get('PORTAL_QUEUE_LIMIT', '32'))
+        self.deferred_limit = int(os.environ.get('PORTAL_DEFERRED_LIMIT', '100'))
+
+        self.app = None
+        self._default: Optional[PortalContext] = None
+        self._portals: Dict[int, PortalContext] = {}
+        self._settings: Dict[int, Tuple] = {}
+        self._by_token: Dict[str, PortalContext] = {}
+        self._by_domain: Dict[str, PortalContext] = {}
+        self._checked_at: Optional[float] = None
+        self._reload_lock = threading.Lock()
+        self.stats = {'resolved': 0, 'rejected': 0, 'reloads': 0}
+
+    def init_app(self, app):
+        self.app = app
+
+    @property
+    def default(self) -> PortalContext:
+        """Портал из переменных окружения (BITRIX_WEBHOOK_URL, BITRIX_CLIENT_ID)"""
+        if self._default is None:
+            with self._reload_lock:
+                if self._default is None:
+                    client = BitrixClient(rate_limiter=TokenBucket(self.rate_limit, self.rate_burst))
+                    self._default = PortalContext(
+                        DEFAULT_PORTAL_KEY, None,
+                        (urlparse(client.webhook_url or client.base_url).hostname or '').lower(),
+                        client,
+                        application_token=os.environ.get('BITRIX_APPLICATION_TOKEN', ''),
+                        client_id=os.environ.get('BITRIX_CLIENT_ID', ''),
+                        max_in_flight=self.max_in_flight, queue_limit=self.queue_limit,
+                        deferred_limit=self.deferred_limit, app=self.app
+                    )
+        return self._default
+
+    def _build(self, portal) -> PortalContext:
+        client = BitrixClient(
+            webhook_url=portal.webhook_url or '',
+            access_token='',
+            base_url=f"https://{portal.domain}",
+            rate_limiter=TokenBucket(portal.rate_limit or self.rate_limit, self.rate_burst),
+            pool_name=f"portal-{portal.id}"
+        )
+        return PortalContext(
+            str(portal.id), portal.id, portal.domain.lower(), client,
+            application_token=portal.application_token or '',
+            client_id=portal.client_id or '',
+            max_in_flight=portal.max_in_flight or self.max_in_flight,
+            queue_limit=self.queue_limit, deferred_limit=self.deferred_limit, app=self.app
+        )
+
+    def _load_portals(self):
+        from models import Portal
+        return Portal.query.filter_by(is_active=True).all()
+
+    def reload(self) -> bool:
+        """Перечитывание таблицы Portal; True, если набор порталов изменился"""
+        with self._reload_lock:
+            self._checked_at = time.monotonic()
+            try:
+                if has_app_context() or self.app is None:
+                    rows = self._load_portals()
+                else:
+                    with self.app.app_context():
+                        rows = self._load_portals()
+            except Exception as e:
+                logging.error(f"Failed to load portals: {str(e)}")
+                return False
+
+            portals, settings = {}, {}
+            for row in rows:
+                key = (row.domain, row.application_token, row.webhook_url, row.client_id, row.rate_limit, row.max_in_flight)
+                settings[row.id] = key
+                # Неизменившийся портал сохраняет пул соединений, лимиты и счетчики
+                portals[row.id] = self._portals[row.id] if self._settings.get(row.id) == key else self._build(row)
+
+            changed = settings != self._settings
+            self._portals, self._settings = portals, settings
+            self._by_token = {context.application_token: context for context in portals.values() if context.application_token}
+            self._by_domain = {context.domain: context for context in portals.values()}
+            if changed:
+                self.stats['reloads'] += 1
+                logging.info(f"Portal registry reloaded: {len(portals)} portals")
+            return changed
+
+    def _ensure_fresh(self):
+        # Ошибка загрузки тоже откладывает следующую попытку на интервал
+        if self._checked_at is None or time.monotonic() - self._checked_at >= self.reload_interval:
+            self.reload()
+
+    def resolve(self, data: Dict[str, Any]) -> PortalContext:
+        """Портал, от которого пришло событие; UnknownPortalError, если он не обслуживается"""
+        self._ensure_fresh()
+        auth = data.get('auth') or {}
+        token = auth.get('application_token') or ''
+        domain = (auth.get('domain') or data.get('domain') or '').lower()
+
+        context = self._by_token.get(token) if token else None
+        if context is None and domain:
+            context = self._by_domain.get(domain)
+            if context is None and domain == self.default.domain:
+                context = self.default
+        elif context is None and self.allow_default:
+            context = self.default
+
+        # Токен, если он задан для портала, подтверждает, что событие пришло от него
+        if context is None or (context.application_token and
+                               not hmac.compare_digest(context.application_token, token)):
+            self.stats['rejected'] += 1
+            raise UnknownPortalError(domain or 'no portal in event')
+
+        self.stats['resolved'] += 1
+        return context
+
+    def get(self, portal_id: Optional[int], refresh: bool = True) -> Optional[PortalContext]:
+        """Контекст портала по id (None — портал по умолчанию)
+
+        refresh=False не обращается к БД — для вызовов из цикла событий.
+        """
+        if portal_id is None:
+            return self.default
+        if refresh:
+            self._ensure_fresh()
+        return self._portals.get(portal_id)
+
+    def require(self, portal_id: Optional[int], refresh: bool = True) -> PortalContext:
+        """Контекст портала для обработки сообщения; UnknownPortalError, если портал
+        отключен или удален после приема события
+        """
+        context = self.get(portal_id, refresh)
+        if context is None:
+            raise UnknownPortalError(f"portal {portal_id} is no longer served")
+        return context
+
+    def close_connections(self):
+        """Закрытие HTTP-соединений, открытых до fork (например, при прогреве в мастере)"""
+        for context in [self.default] + list(self._portals.values()):
+            context.client.session.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        contexts = [self.default] + list(self._portals.values())
+        return {
+            **self.stats,
+            'allow_default': self.allow_default,
+            'portals': {context.key: context.get_stats() for context in contexts},
+        }
+
+
+portal_registry = PortalRegistry()
@@ -0,0 +1,223 @@
+import os
+import time
+import queue
+import logging
+import threading
+from typing import Dict, Any, Optional, List
+
+from sqlalchemy import update
+from app import db
+from models import User
+from ttl_cache import TTLCache
+
+
+class ProfileEnricher:
+    """Обогащение пользователей профилями из Битрикс24
+
+    Профили пользователей и названия подразделений берутся из TTL-кэша
+    (устаревшие записи отдаются сразу и обновляются в фоне, отсутствующие
+    кэшируются отрицательно). Запись в таблицу User выполняет фоновый поток,
+    поэтому обработка сообщений не ждет ни API, ни БД.
+    """
+
+    def __init__(self, bitrix_client, app, portal_id: Optional[int] = None):
+        self.bitrix_client = bitrix_client
+        self.app = app
+        # Идентификаторы пользователей уникальны только в пределах портала
+        self.portal_id = portal_id
+        ttl = float(os.environ.get('PROFILE_CACHE_TTL', '21600'))
+        negative_ttl = float(os.environ.get('PROFILE_NEGATIVE_TTL', '600'))
+        self.users = TTLCache(maxsize=50000, ttl=ttl, stale_ttl=ttl, negative_ttl=negative_ttl)
+        self.departments = TTLCache(maxsize=5000, ttl=ttl, stale_ttl=ttl, negative_ttl=negative_ttl)
+
+        self.batch_size = int(os.environ.get('PROFILE_WRITE_BATCH', '100'))
+        self._queue: queue.Queue = queue.Queue(maxsize=int(os.environ.get('PROFILE_QUEUE_SIZE', '10000')))
+        self._refreshing = set()
+        # Каждый пользователь ставится в очередь не чаще раза за время жизни кэша
+        self._recently_enqueued = TTLCache(maxsize=50000, ttl=ttl, stale_ttl=0)
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+        self.stats = {'enqueued': 0, 'dropped': 0, 'written': 0, 'api_calls': 0}
+
+    # ==== Кэш профилей ====
+
+    def _fetch_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        self.stats['api_calls'] += 1
+        return self.bitrix_client.get_user_info(user_id)
+
+    def _fetch_department(self, department_id: str) -> Optional[Dict[str, Any]]:
+        self.stats['api_calls'] += 1
+        return self.bitrix_client.get_department_info(department_id)
+
+    def _refresh_in_background(self, cache: TTLCache, key: str, fetch):
+        with self._lock:
+            if (id(cache), key) in self._refreshing:
+                return
+            self._refreshing.add((id(cache), key))
+
+        def refresh():
+            try:
+                cache.set(key, fetch(key))
+            finally:
+                with self._lock:
+                    self._refreshing.discard((id(cache), key))
+
+        threading.Thread(target=refresh, name='profile-refresh', daemon=True).start()
+
+    def _cached(self, cache: TTLCache, key: str, fetch) -> Optional[Dict[str, Any]]:
+        found, value, stale = cache.lookup(key)
+        if found:
+            if stale:
+                self._refresh_in_background(cache, key, fetch)
+            return value
+        value = fetch(key)
+        cache.set(key, value)
+        return value
+
+    def get_user_profile(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return self._cached(self.users, str(user_id), self._fetch_user)
+
+    def get_department_name(self, department_id: str) -> Optional[str]:
+        department = self._cached(self.departments, str(department_id), self._fetch_department)
+        return department.get('NAME') if department else None
+
+    def build_user_fields(self, profile: Dict[str, Any]) -> Dict[str, Any]:
+        """Поля модели User из профиля Битрикс24"""
+        name = ' '.join(part for part in [profile.get('NAME'), profile.get('LAST_NAME')] if part)
+        fields = {
+            'name': name or None,
+            'email': profile.get('EMAIL') or None,
+            'position': profile.get('WORK_POSITION') or None,
+            'is_active': profile.get('ACTIVE', True) not in (False, 'N'),
+        }
+
+        departments = profile.get('UF_DEPARTMENT') or []
+        if departments:
+            fields['department'] = self.get_department_name(departments[0])
+
+        return {key: value for key, value in fields.items() if value is not None}
+
+    # ==== Асинхронная запись в User ====
+
+    def enrich_async(self, bitrix_user_id: str):
+        """Постановка пользователя в очередь на обогащение без ожидания"""
+        bitrix_user_id = str(bitrix_user_id)
+        if self._recently_enqueued.get(bitrix_user_id):
+            return
+        self._recently_enqueued.set(bitrix_user_id, True)
+
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(bitrix_user_id)
+            self.stats['enqueued'] += 1
+        except queue.Full:
+            self.stats['dropped'] += 1
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='profile-enricher', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            user_ids = [self._queue.get()]
+            while len(user_ids) < self.batch_size:
+                try:
+                    user_ids.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                updates = []
+                for user_id in dict.fromkeys(user_ids):
+                    profile = self.get_user_profile(user_id)
+                    if profile:
+                        updates.append((user_id, self.build_user_fields(profile)))
+                with self.app.app_context():
+                    self._write_users(updates)
+            except Exception as e:
+                logging.error(f"Error enriching user profiles: {str(e)}")
+
+    def _write_users(self, updates: List):
+        if not updates:
+            return
+        try:
+            for bitrix_user_id, fields in updates:
+                if fields:
+                    db.session.execute(
+                        update(User).where(
+                            User.portal_id == self.portal_id,
+                            User.bitrix_user_id == bitrix_user_id
+                        ).values(**fields)
+                    )
+            db.session.commit()
+            self.stats['written'] += len(updates)
+        except Exception as e:
+            logging.error(f"Error writing enriched profiles: {str(e)}")
+            db.session.rollback()
+
+    # ==== Массовая предзагрузка ====
+
+    def prefetch_all(self) -> Dict[str, int]:
+        """Загрузка всех подразделений и пользователей постранично"""
+        departments = 0
+        for department in self._iter_pages('department.get'):
+            self.departments.set(str(department['ID']), department)
+            departments += 1
+
+        users = 0
+        updates = []
+        for profile in self._iter_pages('user.get', {'FILTER': {'ACTIVE': True}}):
+            user_id = str(profile['ID'])
+            self.users.set(user_id, profile)
+            updates.append((user_id, self.build_user_fields(profile)))
+            users += 1
+            if len(updates) >= self.batch_size:
+                self._write_users(updates)
+                updates = []
+        self._write_users(updates)
+
+        logging.info(f"Prefetched {users} user and {departments} department profiles")
+        return {'users': users, 'departments': departments}
+
+    def prefetch_users(self, user_ids: List[str], deadline: Optional[float] = None) -> int:
+        """Загрузка профилей выбранных пользователей в кэш по 50 за запрос (прогрев после деплоя)
+
+        deadline — значение time.monotonic(), после которого загрузка прекращается.
+        """
+        loaded = 0
+        for start in range(0, len(user_ids), 50):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            chunk = [str(user_id) for user_id in user_ids[start:start + 50]]
+            page = self.bitrix_client.list_page('user.get', 0, {'FILTER': {'ID': chunk}})
+            self.stats['api_calls'] += 1
+            if page is None:
+                break
+            for profile in page[0]:
+                self.users.set(str(profile['ID']), profile)
+                # Подразделение тоже попадает в кэш
+                self.build_user_fields(profile)
+                loaded += 1
+        return loaded
+
+    def _iter_pages(self, method: str, params: Optional[Dict[str, Any]] = None):
+        start = 0
+        while start is not None:
+            page = self.bitrix_client.list_page(method, start, params)
+            self.stats['api_calls'] += 1
+            if page is None:
+                return
+            items, start = page
+            yield from items
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'users_cache': self.users.get_stats(),
+            'departments_cache': self.departments.get_stats(),
+            'queue_size': self._queue.qsize(),
+            **self.stats,
+        }
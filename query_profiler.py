@@ -0,0 +1,153 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Any
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryProfiler:
+    """Профилировщик SQL-запросов в рамках HTTP-запроса
+
+    Считает количество запросов и суммарное время работы с БД,
+    помечает повторяющиеся одинаковые запросы как вероятный N+1
+    и логирует медленные запросы.
+    """
+
+    _literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+    _whitespace_re = re.compile(r'\s+')
+
+    def __init__(self, app=None):
+        self.enabled = os.environ.get('SQL_PROFILING_ENABLED', 'false').lower() == 'true'
+        self.slow_query_ms = float(os.environ.get('SQL_SLOW_QUERY_MS', '200'))
+        self.n_plus_one_threshold = int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD', '5'))
+
+        self._lock = threading.Lock()
+        self._endpoints: Dict[str, Dict[str, Any]] = defaultdict(lambda: {
+            'requests': 0,
+            'queries': 0,
+            'db_time_ms': 0.0,
+            'max_queries': 0,
+            'n_plus_one': Counter(),
+        })
+        self._listening = False
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Подключение профилировщика к приложению и событиям движка"""
+        if not self.enabled:
+            return
+
+        if not self._listening:
+            # Слушаем класс Engine, чтобы охватить все движки и bind'ы
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+            self._listening = True
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.extensions['query_profiler'] = self
+
+    def _normalize(self, statement: str) -> str:
+        """Приведение запроса к шаблону без литералов"""
+        statement = self._literal_re.sub('?', statement)
+        return self._whitespace_re.sub(' ', statement).strip()
+
+    def _start_request(self):
+        g.sql_profile = {
+            'queries': 0,
+            'db_time_ms': 0.0,
+            'statements': Counter(),
+        }
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start_times = conn.info.get('query_start_time')
+        if not start_times:
+            return
+        elapsed_ms = (time.perf_counter() - start_times.pop()) * 1000
+
+        if elapsed_ms >= self.slow_query_ms:
+            logging.warning("Slow query (%.1f ms): %s", elapsed_ms, statement)
+
+        if not has_request_context():
+            return
+        profile = g.get('sql_profile')
+        if profile is None:
+            return
+
+        profile['queries'] += 1
+        profile['db_time_ms'] += elapsed_ms
+        profile['statements'][self._normalize(statement)] += 1
+
+    def _finish_request(self, response):
+        profile = g.get('sql_profile')
+        if profile is None:
+            return response
+
+        repeated = {
+            statement: count
+            for statement, count in profile['statements'].items()
+            if count >= self.n_plus_one_threshold
+        }
+        endpoint = request.endpoint or request.path
+
+        for statement, count in repeated.items():
+            logging.warning(
+                "Possible N+1 in %s: statement executed %d times: %s",
+                endpoint, count, statement
+            )
+
+        with self._lock:
+            stats = self._endpoints[endpoint]
+            stats['requests'] += 1
+            stats['queries'] += profile['queries']
+            stats['db_time_ms'] += profile['db_time_ms']
+            stats['max_queries'] = max(stats['max_queries'], profile['queries'])
+            for statement, count in repeated.items():
+                stats['n_plus_one'][statement] += count
+
+        # Обработчик подключается только при SQL_PROFILING_ENABLED=true: заголовки включает тот же флаг
+        response.headers['X-DB-Query-Count'] = str(profile['queries'])
+        response.headers['X-DB-Time-Ms'] = f"{profile['db_time_ms']:.1f}"
+        if repeated:
+            response.headers['X-DB-N-Plus-One'] = str(len(repeated))
+
+        return response
+
+    def get_report(self) -> Dict[str, Any]:
+        """Агрегированный отчет по эндпоинтам"""
+        with self._lock:
+            report = {}
+            for endpoint, stats in self._endpoints.items():
+                requests_count = stats['requests'] or 1
+                report[endpoint] = {
+                    'requests': stats['requests'],
+                    'total_queries': stats['queries'],
+                    'avg_queries': round(stats['queries'] / requests_count, 2),
+                    'max_queries': stats['max_queries'],
+                    'total_db_time_ms': round(stats['db_time_ms'], 2),
+                    'avg_db_time_ms': round(stats['db_time_ms'] / requests_count, 2),
+                    'n_plus_one': [
+                        {'statement': statement, 'executions': count}
+                        for statement, count in stats['n_plus_one'].most_common(10)
+                    ],
+                }
+            return report
+
+    def reset(self):
+        """Сброс накопленной статистики"""
+        with self._lock:
+            self._endpoints.clear()
+
+
+query_profiler = QueryProfiler()
@@ -0,0 +1,126 @@
+import os
+import asyncio
+import logging
+import threading
+from typing import Callable, Awaitable, List, Optional
+
+
+HOLDING_RESPONSE = "⏳ Готовлю подробный ответ, это займет несколько секунд."
+
+
+class ReplySettings:
+    """Параметры индикатора набора и промежуточных ответов"""
+
+    def __init__(self):
+        self.typing_enabled = os.environ.get('REPLY_TYPING_ENABLED', 'true').lower() == 'true'
+        self.typing_refresh = float(os.environ.get('REPLY_TYPING_REFRESH_SECONDS', '4'))
+        self.interim_deadline = float(os.environ.get('REPLY_INTERIM_DEADLINE_SECONDS', '3'))
+
+
+reply_settings = ReplySettings()
+
+
+def build_interim_response(similar_questions: List[str]) -> str:
+    """Промежуточный ответ: сообщение об ожидании и похожие частые вопросы"""
+    response = HOLDING_RESPONSE
+    if similar_questions:
+        response += "\n\nПока можно посмотреть похожие вопросы:\n" + "\n".join(
+            f"• {question}" for question in similar_questions
+        )
+    return response
+
+
+class TypingIndicator:
+    """Фоновое обновление статуса «печатает» на время подготовки ответа"""
+
+    def __init__(self, send_typing: Callable[[str], bool], chat_id: str, interval: float):
+        self.send_typing = send_typing
+        self.chat_id = chat_id
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.send_typing(self.chat_id)
+            except Exception as e:
+                logging.warning(f"Failed to refresh typing status: {str(e)}")
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if reply_settings.typing_enabled:
+            self._thread = threading.Thread(target=self._run, name='typing-indicator', daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        return False
+
+
+class DeadlineReply:
+    """Отправка промежуточного ответа, если полный не готов к сроку
+
+    send_interim вызывается из фонового таймера не более одного раза
+    и только если полный ответ еще не зафиксирован.
+    """
+
+    def __init__(self, deadline: float, send_interim: Callable[[], None]):
+        self.deadline = deadline
+        self.send_interim = send_interim
+        self.interim_sent = False
+        self._finished = False
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    def _fire(self):
+        with self._lock:
+            if self._finished:
+                return
+            try:
+                self.send_interim()
+                self.interim_sent = True
+            except Exception as e:
+                logging.warning(f"Failed to send interim reply: {str(e)}")
+
+    def __enter__(self):
+        if self.deadline > 0:
+            self._timer = threading.Timer(self.deadline, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Блокировка гарантирует, что промежуточный ответ либо уже записан,
+        # либо не будет записан после полного
+        with self._lock:
+            self._finished = True
+        if self._timer is not None:
+            self._timer.cancel()
+        return False
+
+
+async def keep_typing(send_typing: Callable[[str], Awaitable[bool]], chat_id: str, interval: float):
+    """Асинхронное обновление статуса «печатает» до отмены задачи"""
+    while True:
+        try:
+            await send_typing(chat_id)
+        except Exception as e:
+            logging.warning(f"Failed to refresh typing status: {str(e)}")
+        await asyncio.sleep(interval)
+
+
+async def with_deadline(work: Awaitable, deadline: float, send_interim: Callable[[], Awaitable[None]]):
+    """Ожидание результата с промежуточным ответом по истечении срока"""
+    task = asyncio.ensure_future(work)
+    if deadline <= 0:
+        return await task
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), deadline)
+    except asyncio.TimeoutError:
+        try:
+            await send_interim()
+        except Exception as e:
+            logging.warning(f"Failed to send interim reply: {str(e)}")
+        return await task
@@ -1,22 +1,68 @@
 import os
+import hmac
+import time
 import json
 import logging
 from datetime import datetime, date, timedelta
-from flask import render_template, request, jsonify, redirect, url_for, flash
+from flask import render_template, request, jsonify, redirect, url_for, flash, Response, stream_with_context
 from app import app, db
-from models import User, Conversation, Message, KnowledgeBaseArticle, BotResponse, Analytics
-from bitrix_client import BitrixClient
+from models import User, Conversation, Message, KnowledgeBaseArticle, BotResponse, Analytics, MessageScoreDaily
 from yandex_gpt_client import YandexGPTClient
 from knowledge_base import KnowledgeBaseManager
-from sqlalchemy import func, desc
+from query_profiler import query_profiler
+from kb_transfer import KnowledgeBaseTransfer
+from transcript_export import TranscriptExporter, EXPORT_MIMETYPES, parse_date
+from lifecycle import ConversationLifecycleManager
+from logging_setup import logging_pipeline, payload_sampler
+from startup import lazy_service, startup_report
+from outbox import OutboxDispatcher, enqueue_message, enqueue_task
+from circuit_breaker import resilience
+from single_flight import llm_single_flight
+from admission import admission_controller, ACKNOWLEDGEMENT_RESPONSE, OVERLOADED_RESPONSE
+from reply_pipeline import TypingIndicator, DeadlineReply, reply_settings, build_interim_response
+from completion_planner import CompletionPlanner
+from db_routing import read_replica, replica_router
+from message_classifier import message_classifier
+from traffic_capture import traffic_capture
+from portals import portal_registry, UnknownPortalError
+from answer_cache import answer_cache
+from warmup import cache_warmer
+from chat_affinity import chat_affinity, partition_for, rendezvous_owner
+from sqlalchemy import func, desc, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, joinedload
+from pagination import keyset_page, encode_cursor, parse_page_size, InvalidCursorError
 
-# Инициализация клиентов
-bitrix_client = BitrixClient()
-gpt_client = YandexGPTClient()
-kb_manager = KnowledgeBaseManager()
+PROCESSING_ERROR_RESPONSE = "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже или обратитесь к HR-специалисту."
+
+# Инициализация клиентов (создаются при первом обращении или в мастере gunicorn)
+bitrix_client = lazy_service('bitrix_client', lambda: portal_registry.default.client)
+kb_manager = lazy_service('kb_manager', KnowledgeBaseManager)
+gpt_client = lazy_service('gpt_client', lambda: YandexGPTClient(CompletionPlanner(kb_manager.categories)))
+kb_transfer = lazy_service('kb_transfer', KnowledgeBaseTransfer)
+lifecycle_manager = lazy_service('lifecycle_manager', ConversationLifecycleManager)
+outbox_dispatcher = lazy_service('outbox_dispatcher', lambda: OutboxDispatcher(bitrix_client, portal_registry))
+profile_enricher = lazy_service('profile_enricher', lambda: portal_registry.default.enricher)
+
+# Отладочные эндпоинты раскрывают SQL и внутреннее состояние: выключены по умолчанию
+DEBUG_ENDPOINTS_ENABLED = os.environ.get('DEBUG_ENDPOINTS_ENABLED', 'false').lower() == 'true'
+DEBUG_API_TOKEN = os.environ.get('DEBUG_API_TOKEN', '')
+
+
+@app.before_request
+def protect_debug_endpoints():
+    """/api/debug/* доступны только при DEBUG_ENDPOINTS_ENABLED и с заголовком X-Debug-Token"""
+    if not request.path.startswith('/api/debug/'):
+        return None
+    if not DEBUG_ENDPOINTS_ENABLED:
+        return jsonify({'error': 'Not found'}), 404
+    if DEBUG_API_TOKEN and not hmac.compare_digest(request.headers.get('X-Debug-Token', ''), DEBUG_API_TOKEN):
+        return jsonify({'error': 'Forbidden'}), 403
+    return None
 
 
 @app.route('/')
+@read_replica
 def index():
     """Главная страница с обзором статистики"""
     # Получаем статистику за последние 7 дней
@@ -61,127 +107,377 @@ def bitrix_webhook():
             logging.error("No data received in webhook")
             return jsonify({'error': 'No data received'}), 400
         
-        # Логируем полученные данные
-        logging.info(f"Received webhook data: {data}")
+        log_webhook_payload(data)
         
-        # Извлекаем информацию о сообщении
-        message_text = data.get('message', {}).get('text', '')
-        user_id = data.get('user', {}).get('id')
-        chat_id = data.get('chat', {}).get('id')
-        user_name = data.get('user', {}).get('name', 'Неизвестный пользователь')
+        # Портал-отправитель определяет учетные данные, квоты и область базы знаний
+        try:
+            portal = portal_registry.resolve(data)
+        except UnknownPortalError as e:
+            logging.warning(f"Webhook from unknown portal rejected: {str(e)}")
+            return jsonify({'error': 'Unknown portal'}), 403
         
-        if not all([message_text, user_id, chat_id]):
+        # Извлекаем информацию о сообщении
+        incoming = parse_webhook_message(data, portal.portal_id)
+        if not incoming:
             logging.error("Missing required fields in webhook data")
             return jsonify({'error': 'Missing required fields'}), 400
         
-        # Найти или создать пользователя
-        user = User.query.filter_by(bitrix_user_id=str(user_id)).first()
-        if not user:
-            user = User(
-                bitrix_user_id=str(user_id),
-                name=user_name,
-                email=data.get('user', {}).get('email', ''),
-                department=data.get('user', {}).get('department', ''),
-                position=data.get('user', {}).get('position', '')
-            )
-            db.session.add(user)
-            db.session.commit()
-        
-        # Найти или создать разговор
-        conversation = Conversation.query.filter_by(
-            user_id=user.id,
-            chat_id=str(chat_id),
-            status='active'
-        ).first()
+        cost_class = admission_controller.classify(incoming['classification'])
+        conversation = store_user_message(incoming)
         
-        if not conversation:
-            conversation = Conversation(
-                user_id=user.id,
-                chat_id=str(chat_id)
-            )
-            db.session.add(conversation)
+        # Сообщение обработает воркер, владеющий партицией чата
+        if chat_affinity.enabled:
+            chat_affinity.enqueue(incoming, conversation.id, cost_class)
             db.session.commit()
+            return jsonify({'status': 'queued'}), 202
         
-        # Сохранить сообщение пользователя
-        user_message = Message(
-            conversation_id=conversation.id,
-            message_type='user',
-            content=message_text
-        )
-        db.session.add(user_message)
-        db.session.commit()
+        # Сначала квота портала: всплеск на одном портале не занимает общие слоты.
+        # Обе квоты ждут в пределах одного latency_target, а не по очереди
+        deadline = time.monotonic() + admission_controller.latency_target
+        if not portal.admission.acquire(admission_controller.latency_target):
+            return defer_user_message(incoming, conversation.id, cost_class)
         
-        # Обработать сообщение и получить ответ
-        start_time = datetime.utcnow()
-        bot_response = process_user_message(message_text, conversation)
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        
-        # Сохранить ответ бота
-        bot_message = Message(
-            conversation_id=conversation.id,
-            message_type='bot',
-            content=bot_response,
-            processed_by_gpt=True,
-            response_time=response_time
-        )
-        db.session.add(bot_message)
-        db.session.commit()
-        
-        # Отправить ответ в Битрикс24
-        bitrix_client.send_message(chat_id, bot_response)
+        try:
+            # При перегрузке отвечаем подтверждением и обрабатываем сообщение отложенно
+            if not admission_controller.acquire(cost_class, max(0.0, deadline - time.monotonic())):
+                return defer_user_message(incoming, conversation.id, cost_class)
+            
+            try:
+                answer_user_message(incoming, conversation)
+            finally:
+                admission_controller.release(cost_class)
+        finally:
+            portal.admission.release()
         
         return jsonify({'status': 'success'}), 200
         
+    except UnknownPortalError as e:
+        # Портал отключили между приемом события и обработкой
+        logging.warning(f"Webhook for portal that is no longer served: {str(e)}")
+        return jsonify({'error': 'Unknown portal'}), 403
+        
     except Exception as e:
         logging.error(f"Error processing webhook: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
 
-def process_user_message(message_text, conversation):
+def answer_user_message(incoming, conversation, context=None, before_commit=None):
+    """Подготовка ответа и сохранение его вместе с записью outbox
+
+    Пока ответ готовится, бот показывает статус «печатает»; если ответ
+    не готов к сроку, пользователь получает промежуточное сообщение.
+    context — уже известный контекст разговора (из памяти владельца чата),
+    before_commit — действие в транзакции ответа (см. store_bot_message).
+    """
+    chat_id = incoming['chat_id']
+    portal_id = incoming.get('portal_id')
+    portal = portal_registry.require(portal_id)
+    
+    def send_interim():
+        with app.app_context():
+            enqueue_message(chat_id, get_interim_response(incoming['text']), portal_id)
+            db.session.commit()
+    
+    # Обработать сообщение и получить ответ
+    start_time = datetime.utcnow()
+    with TypingIndicator(portal.client.set_bot_typing, chat_id, reply_settings.typing_refresh), \
+            DeadlineReply(reply_settings.interim_deadline, send_interim):
+        bot_response = process_user_message(incoming['text'], conversation, incoming.get('classification'), context)
+    response_time = (datetime.utcnow() - start_time).total_seconds()
+    
+    # Ответ уходит в Битрикс24 через outbox, записанный в той же транзакции
+    store_bot_message(conversation.id, incoming['chat_id'], bot_response, response_time, portal_id, before_commit)
+    return bot_response
+
+
+def defer_user_message(incoming, conversation_id, cost_class):
+    """Немедленное подтверждение пользователю и отложенная обработка сообщения"""
+    portal_id = incoming.get('portal_id')
+    portal = portal_registry.require(portal_id)
+    enqueue_message(incoming['chat_id'], ACKNOWLEDGEMENT_RESPONSE, portal_id)
+    db.session.commit()
+    
+    def job():
+        try:
+            with app.app_context():
+                admission_class = admission_controller.classes[cost_class]
+                admission_class.acquire_blocking()
+                try:
+                    answer_user_message(incoming, db.session.get(Conversation, conversation_id))
+                finally:
+                    admission_class.release()
+        finally:
+            portal.finish_deferred()
+    
+    # Квота портала ограничивает его долю общей очереди отложенных сообщений
+    accepted = portal.reserve_deferred()
+    if accepted and not admission_controller.defer(job):
+        portal.finish_deferred()
+        accepted = False
+    
+    if not accepted:
+        logging.warning("Deferred queue is full, message in chat %s was not processed", incoming['chat_id'])
+        enqueue_message(incoming['chat_id'], OVERLOADED_RESPONSE, portal_id)
+        db.session.commit()
+    
+    return jsonify({'status': 'accepted'}), 202
+
+
+def log_webhook_payload(data):
+    """Логирование входящего веб-хука и запись для воспроизведения (TRAFFIC_CAPTURE_PATH)"""
+    traffic_capture.record('/webhook/bitrix', data)
+    
+    # Полное тело запроса логируем выборочно, чтобы не тратить время потока на форматирование
+    if payload_sampler.should_log():
+        logging.info("Received webhook data: %s", data, extra={'sampled_payload': True})
+    else:
+        logging.debug("Received webhook for chat %s", data.get('chat', {}).get('id'))
+
+
+def parse_webhook_message(data, portal_id=None):
+    """Извлечение полей сообщения из тела веб-хука"""
+    user_data = data.get('user', {})
+    incoming = {
+        'portal_id': portal_id,
+        'text': data.get('message', {}).get('text', ''),
+        'user_id': user_data.get('id'),
+        'chat_id': data.get('chat', {}).get('id'),
+        'user_name': user_data.get('name', 'Неизвестный пользователь'),
+        'email': user_data.get('email', ''),
+        'department': user_data.get('department', ''),
+        'position': user_data.get('position', '')
+    }
+    
+    if not all([incoming['text'], incoming['user_id'], incoming['chat_id']]):
+        return None
+    
+    # Категория, тональность, флаги безопасности и триггеры — за один проход по тексту
+    incoming['classification'] = message_classifier.classify(incoming['text'])
+    return incoming
+
+
+def store_user_message(incoming):
+    """Сохранение пользователя, разговора и входящего сообщения
+
+    Идентификатор сохраненного сообщения записывается в incoming['message_id'].
+    """
+    portal_id = incoming.get('portal_id')
+    
+    # Найти или создать пользователя (идентификаторы уникальны в пределах портала)
+    user = User.query.filter_by(portal_id=portal_id, bitrix_user_id=str(incoming['user_id'])).first()
+    if not user:
+        user = User(
+            portal_id=portal_id,
+            bitrix_user_id=str(incoming['user_id']),
+            name=incoming['user_name'],
+            email=incoming['email'],
+            department=incoming['department'],
+            position=incoming['position']
+        )
+        db.session.add(user)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Первое сообщение пользователя пришло одновременно в другой поток: берем его запись
+            db.session.rollback()
+            user = User.query.filter_by(portal_id=portal_id, bitrix_user_id=str(incoming['user_id'])).one()
+    
+    # Профиль и подразделение подтягиваются из Битрикс24 портала в фоне (если портал еще обслуживается)
+    portal = portal_registry.get(portal_id)
+    if portal is not None:
+        portal.enricher.enrich_async(user.bitrix_user_id)
+    
+    # Найти или создать разговор
+    conversation = Conversation.query.filter_by(
+        user_id=user.id,
+        chat_id=str(incoming['chat_id']),
+        status='active'
+    ).first()
+    
+    if not conversation:
+        conversation = Conversation(
+            user_id=user.id,
+            portal_id=portal_id,
+            chat_id=str(incoming['chat_id'])
+        )
+        db.session.add(conversation)
+        db.session.commit()
+    
+    # Сохранить сообщение пользователя
+    user_message = Message(
+        conversation_id=conversation.id,
+        message_type='user',
+        content=incoming['text']
+    )
+    db.session.add(user_message)
+    db.session.commit()
+    incoming['message_id'] = user_message.id
+    
+    return conversation
+
+
+def store_bot_message(conversation_id, chat_id, bot_response, response_time, portal_id=None, before_commit=None):
+    """Сохранение ответа бота вместе с записью outbox на отправку
+
+    before_commit выполняется в той же транзакции (например, снятие
+    сообщения из inbox) и может отменить ее исключением.
+    """
+    bot_message = Message(
+        conversation_id=conversation_id,
+        message_type='bot',
+        content=bot_response,
+        processed_by_gpt=True,
+        response_time=response_time
+    )
+    db.session.add(bot_message)
+    enqueue_message(chat_id, bot_response, portal_id)
+    if before_commit is not None:
+        before_commit()
+    db.session.commit()
+    return bot_message
+
+
+def escalate_conversation(conversation, reason=''):
+    """Эскалация разговора на HR-специалиста
+
+    Статус разговора и задача для Битрикс24 фиксируются одной транзакцией,
+    задача создается диспетчером outbox.
+    """
+    conversation.status = 'escalated'
+    conversation.escalated_to_human = True
+    
+    user = conversation.user
+    description = f"Сотрудник: {user.name}"
+    if user.department:
+        description += f" ({user.department})"
+    description += f"\nЧат: {conversation.chat_id}"
+    if reason:
+        description += f"\nПричина: {reason}"
+    
+    enqueue_task(
+        conversation.chat_id,
+        f"Обращение сотрудника {user.name} к HR",
+        description,
+        os.environ.get('BITRIX_HR_RESPONSIBLE_ID', '1'),
+        portal_id=conversation.portal_id
+    )
+    db.session.commit()
+
+
+def find_prepared_response(message_text, classification=None, portal_id=None):
+    """Поиск готового ответа в базе знаний и среди предопределенных ответов портала
+
+    Найденный ответ (и его отсутствие) кэшируется в answer_cache;
+    счетчики использования ведутся и для ответов из кэша.
+    """
+    found, answer = answer_cache.lookup(message_text, portal_id)
+    if not found:
+        try:
+            answer = resolve_prepared_answer(message_text, classification, portal_id)
+        except Exception as e:
+            logging.error(f"Error searching prepared responses: {str(e)}")
+            db.session.rollback()
+            return None
+        answer_cache.store(message_text, portal_id, answer)
+    
+    if answer is None:
+        return None
+    
+    kind, source_id, response_text = answer
+    if kind == 'article':
+        kb_manager.record_usage(source_id)
+    else:
+        db.session.execute(
+            update(BotResponse).where(BotResponse.id == source_id).values(usage_count=BotResponse.usage_count + 1)
+        )
+        db.session.commit()
+    return response_text
+
+
+def resolve_prepared_answer(message_text, classification=None, portal_id=None):
+    """Готовый ответ без учета использования: ('article' | 'response', id, текст) или None"""
+    if classification is None:
+        classification = message_classifier.classify(message_text)
+    
+    # Сначала проверяем базу знаний
+    article = kb_manager.find_article_answer(message_text, classification, portal_id)
+    if article:
+        return ('article',) + article
+    
+    # Проверяем предопределенные ответы
+    response = find_predefined_response(classification, portal_id)
+    if response:
+        return ('response',) + response
+    return None
+
+
+def warm_prepared_response(message_text, portal_id=None):
+    """Заполнение кэша готовых ответов без учета использования (прогрев после деплоя)"""
+    answer = resolve_prepared_answer(message_text, None, portal_id)
+    answer_cache.store(message_text, portal_id, answer, warmed=True)
+    return answer is not None
+
+
+def process_user_message(message_text, conversation, classification=None, context=None):
     """Обработка сообщения пользователя и генерация ответа"""
     try:
-        # Сначала проверяем базу знаний
-        kb_response = kb_manager.search_knowledge_base(message_text)
-        if kb_response:
-            return kb_response
+        prepared_response = find_prepared_response(message_text, classification, conversation.portal_id)
+        if prepared_response:
+            return prepared_response
         
-        # Проверяем предопределенные ответы
-        bot_response = get_predefined_response(message_text)
-        if bot_response:
-            return bot_response
+        if context is None:
+            context = get_conversation_context(conversation)
+        
+        # Пока модель из плана ответа недоступна, не ждем таймаута, а сразу отвечаем подсказками
+        if not gpt_client.is_available(message_text, context):
+            return get_fallback_response(message_text)
         
         # Если ничего не найдено, обращаемся к YandexGPT
-        context = get_conversation_context(conversation)
         gpt_response = gpt_client.generate_response(message_text, context)
         
         return gpt_response
         
     except Exception as e:
         logging.error(f"Error processing message: {str(e)}")
-        return "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже или обратитесь к HR-специалисту."
+        return PROCESSING_ERROR_RESPONSE
 
 
-def get_predefined_response(message_text):
-    """Поиск предопределенного ответа по ключевым словам"""
-    message_lower = message_text.lower()
-    
-    responses = BotResponse.query.filter_by(is_active=True).order_by(desc(BotResponse.priority)).all()
-    
-    for response in responses:
-        keywords = [kw.strip().lower() for kw in response.trigger_keywords.split(',')]
-        if any(keyword in message_lower for keyword in keywords):
-            response.usage_count += 1
-            db.session.commit()
-            return response.response_text
+def get_interim_response(message_text):
+    """Промежуточный ответ на время генерации полного"""
+    return build_interim_response(kb_manager.search_similar_questions(message_text))
+
+
+def get_fallback_response(message_text):
+    """Ответ без YandexGPT: похожие частые вопросы и контакт HR"""
+    similar_questions = kb_manager.search_similar_questions(message_text)
+    response = "Сейчас я не могу подготовить подробный ответ."
+    if similar_questions:
+        response += "\n\nВозможно, вас интересует:\n" + "\n".join(f"• {question}" for question in similar_questions)
+    response += "\n\n💡 Вы также можете обратиться к HR-специалисту."
+    return response
+
+
+def find_predefined_response(classification, portal_id=None):
+    """Предопределенный ответ по ключевым словам (общие и ответы портала): (id, текст) или None"""
+    # Кандидаты уже упорядочены по приоритету; загружается только выбранный ответ
+    for response_id in classification['response_ids']:
+        response = db.session.get(BotResponse, response_id)
+        if response and response.is_active and response.portal_id in (None, portal_id):
+            return response.id, response.response_text
     
     return None
 
 
-def get_conversation_context(conversation):
-    """Получение контекста разговора для YandexGPT"""
-    recent_messages = Message.query.filter_by(
-        conversation_id=conversation.id
-    ).order_by(desc(Message.timestamp)).limit(10).all()
+def get_conversation_context(conversation, up_to_message_id=None):
+    """Получение контекста разговора для YandexGPT
+
+    up_to_message_id ограничивает контекст сообщением, на которое готовится
+    ответ: более поздние, еще не отвеченные сообщения в него не попадают.
+    """
+    query = Message.query.filter_by(conversation_id=conversation.id)
+    if up_to_message_id is not None:
+        query = query.filter(Message.id <= up_to_message_id)
+    recent_messages = query.order_by(desc(Message.timestamp)).limit(10).all()
     
     context = []
     for msg in reversed(recent_messages):
@@ -192,6 +488,7 @@ def get_conversation_context(conversation):
 
 
 @app.route('/admin')
+@read_replica
 def admin():
     """Админ-панель"""
     # Статистика для админ-панели
@@ -199,7 +496,9 @@ def admin():
     total_responses = BotResponse.query.filter_by(is_active=True).count()
     active_conversations = Conversation.query.filter_by(status='active').count()
     
-    recent_conversations = Conversation.query.order_by(desc(Conversation.started_at)).limit(10).all()
+    recent_conversations = Conversation.query.options(
+        joinedload(Conversation.user)
+    ).order_by(desc(Conversation.started_at)).limit(10).all()
     
     return render_template('admin.html',
                          total_articles=total_articles,
@@ -209,6 +508,7 @@ def admin():
 
 
 @app.route('/analytics')
+@read_replica
 def analytics():
     """Страница аналитики"""
     # Данные для графиков за последние 30 дней
@@ -237,13 +537,20 @@ def analytics():
         func.sum(KnowledgeBaseArticle.usage_count).label('usage')
     ).group_by(KnowledgeBaseArticle.category).order_by(desc('usage')).limit(10).all()
     
+    # Тональность и безопасность по дням и категориям (итоги flask score-messages)
+    score_rows = MessageScoreDaily.query.filter(
+        MessageScoreDaily.day >= thirty_days_ago
+    ).order_by(MessageScoreDaily.day, MessageScoreDaily.category).all()
+    
     return render_template('analytics.html',
                          daily_messages=daily_messages,
                          daily_response_time=daily_response_time,
-                         category_stats=category_stats)
+                         category_stats=category_stats,
+                         sentiment_stats=score_rows)
 
 
 @app.route('/knowledge-base')
+@read_replica
 def knowledge_base():
     """Управление базой знаний"""
     page = request.args.get('page', 1, type=int)
@@ -280,17 +587,25 @@ def create_article():
         data = request.get_json()
         
         article = KnowledgeBaseArticle(
+            # Ключ импорта по умолчанию — заголовок, как и при импорте без external_id (kb_transfer)
+            external_id=str(data.get('external_id') or data['title'].strip())[:255],
             title=data['title'],
             content=data['content'],
             category=data['category'],
-            tags=data.get('tags', '')
+            tags=data.get('tags', ''),
+            portal_id=data.get('portal_id')
         )
         
         db.session.add(article)
         db.session.commit()
+        answer_cache.clear()
         
         return jsonify({'status': 'success', 'id': article.id}), 201
         
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Article with this external_id already exists'}), 409
+
     except Exception as e:
         logging.error(f"Error creating article: {str(e)}")
         return jsonify({'error': 'Failed to create article'}), 500
@@ -310,6 +625,7 @@ def update_article(article_id):
         article.updated_at = datetime.utcnow()
         
         db.session.commit()
+        answer_cache.clear()
         
         return jsonify({'status': 'success'}), 200
         
@@ -325,6 +641,7 @@ def delete_article(article_id):
         article = KnowledgeBaseArticle.query.get_or_404(article_id)
         article.is_active = False
         db.session.commit()
+        answer_cache.clear()
         
         return jsonify({'status': 'success'}), 200
         
@@ -333,6 +650,276 @@ def delete_article(article_id):
         return jsonify({'error': 'Failed to delete article'}), 500
 
 
+def serialize_message(message):
+    """Сериализация сообщения для JSON API"""
+    return {
+        'id': message.id,
+        'conversation_id': message.conversation_id,
+        'message_type': message.message_type,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat() if message.timestamp else None,
+        'processed_by_gpt': message.processed_by_gpt,
+        'response_time': message.response_time,
+        'knowledge_base_used': message.knowledge_base_used
+    }
+
+
+def serialize_article(article):
+    """Сериализация статьи базы знаний для JSON API"""
+    return {
+        'id': article.id,
+        'title': article.title,
+        'content': article.content,
+        'category': article.category,
+        'portal_id': article.portal_id,
+        'tags': article.get_tags_list(),
+        'is_active': article.is_active,
+        'usage_count': article.usage_count,
+        'created_at': article.created_at.isoformat() if article.created_at else None,
+        'updated_at': article.updated_at.isoformat() if article.updated_at else None
+    }
+
+
+@app.route('/api/conversations', methods=['GET'])
+@read_replica
+def list_conversations():
+    """Список разговоров с keyset-пагинацией по (started_at, id)"""
+    limit = parse_page_size(request.args.get('limit', type=int))
+    cursor = request.args.get('cursor')
+    status = request.args.get('status', '')
+
+    # Последнее сообщение подтягивается тем же запросом через коррелированный подзапрос
+    latest_message = aliased(Message)
+    latest_id = select(func.max(Message.id)).where(
+        Message.conversation_id == Conversation.id
+    ).correlate(Conversation).scalar_subquery()
+
+    query = db.session.query(Conversation, latest_message).options(
+        joinedload(Conversation.user)
+    ).outerjoin(latest_message, latest_message.id == latest_id)
+
+    if status:
+        query = query.filter(Conversation.status == status)
+
+    try:
+        rows, has_more = keyset_page(query, Conversation.started_at, Conversation.id, cursor, limit)
+    except InvalidCursorError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    items = []
+    for conversation, last_message in rows:
+        items.append({
+            'id': conversation.id,
+            'chat_id': conversation.chat_id,
+            'portal_id': conversation.portal_id,
+            'status': conversation.status,
+            'escalated_to_human': conversation.escalated_to_human,
+            'started_at': conversation.started_at.isoformat() if conversation.started_at else None,
+            'ended_at': conversation.ended_at.isoformat() if conversation.ended_at else None,
+            'summary': conversation.summary,
+            'user': {
+                'id': conversation.user.id,
+                'bitrix_user_id': conversation.user.bitrix_user_id,
+                'name': conversation.user.name,
+                'department': conversation.user.department
+            },
+            'last_message': serialize_message(last_message) if last_message else None
+        })
+
+    next_cursor = None
+    if has_more and rows:
+        last_conversation = rows[-1][0]
+        next_cursor = encode_cursor(last_conversation.started_at, last_conversation.id)
+
+    return jsonify({'items': items, 'next_cursor': next_cursor}), 200
+
+
+@app.route('/api/conversations/<int:conversation_id>/messages', methods=['GET'])
+@read_replica
+def list_conversation_messages(conversation_id):
+    """Сообщения разговора с keyset-пагинацией по (timestamp, id)"""
+    limit = parse_page_size(request.args.get('limit', type=int))
+    cursor = request.args.get('cursor')
+
+    query = Message.query.filter(Message.conversation_id == conversation_id)
+
+    try:
+        messages, has_more = keyset_page(query, Message.timestamp, Message.id, cursor, limit)
+    except InvalidCursorError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    if not messages and not cursor and db.session.get(Conversation, conversation_id) is None:
+        return jsonify({'error': 'Conversation not found'}), 404
+
+    next_cursor = None
+    if has_more and messages:
+        next_cursor = encode_cursor(messages[-1].timestamp, messages[-1].id)
+
+    return jsonify({
+        'items': [serialize_message(message) for message in messages],
+        'next_cursor': next_cursor
+    }), 200
+
+
+@app.route('/api/knowledge-base', methods=['GET'])
+@read_replica
+def list_articles():
+    """Статьи базы знаний с keyset-пагинацией по (updated_at, id)"""
+    limit = parse_page_size(request.args.get('limit', type=int))
+    cursor = request.args.get('cursor')
+    category = request.args.get('category', '')
+    search = request.args.get('search', '')
+
+    query = KnowledgeBaseArticle.query.filter(KnowledgeBaseArticle.is_active == True)
+
+    if category:
+        query = query.filter(KnowledgeBaseArticle.category == category)
+
+    if search:
+        query = query.filter(KnowledgeBaseArticle.title.contains(search))
+
+    try:
+        articles, has_more = keyset_page(
+            query, KnowledgeBaseArticle.updated_at, KnowledgeBaseArticle.id, cursor, limit
+        )
+    except InvalidCursorError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    next_cursor = None
+    if has_more and articles:
+        next_cursor = encode_cursor(articles[-1].updated_at, articles[-1].id)
+
+    return jsonify({
+        'items': [serialize_article(article) for article in articles],
+        'next_cursor': next_cursor
+    }), 200
+
+
+@app.route('/api/knowledge-base/import', methods=['POST'])
+def import_articles():
+    """Массовый импорт статей из NDJSON или CSV (?portal_id= — портал для строк без portal_id)"""
+    data_format = request.args.get('format', 'ndjson')
+    portal_id = request.args.get('portal_id', type=int)
+    if data_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'Unsupported format'}), 400
+
+    try:
+        if data_format == 'csv':
+            stats = kb_transfer.import_csv(request.stream, portal_id)
+        else:
+            stats = kb_transfer.import_ndjson(request.stream, portal_id)
+        answer_cache.clear()
+
+        return jsonify({'status': 'success', **stats}), 200
+
+    except Exception as e:
+        logging.error(f"Error importing articles: {str(e)}")
+        return jsonify({'error': 'Failed to import articles'}), 500
+
+
+@app.route('/api/knowledge-base/export', methods=['GET'])
+@read_replica
+def export_articles():
+    """Потоковый экспорт статей в NDJSON или CSV"""
+    data_format = request.args.get('format', 'ndjson')
+    include_inactive = request.args.get('include_inactive', 'false').lower() == 'true'
+    portal_id = request.args.get('portal_id', type=int)
+
+    if data_format == 'csv':
+        body = kb_transfer.export_csv(include_inactive, portal_id)
+        mimetype = 'text/csv'
+    elif data_format == 'ndjson':
+        body = kb_transfer.export_ndjson(include_inactive, portal_id)
+        mimetype = 'application/x-ndjson'
+    else:
+        return jsonify({'error': 'Unsupported format'}), 400
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=knowledge_base.{data_format}'}
+    )
+
+
+@app.route('/api/export/transcripts', methods=['GET'])
+@read_replica
+def export_transcripts():
+    """Потоковая выгрузка переписки в NDJSON, CSV или CSV.gz"""
+    data_format = request.args.get('format', 'ndjson')
+    if data_format not in EXPORT_MIMETYPES:
+        return jsonify({'error': 'Unsupported format'}), 400
+
+    try:
+        exporter = TranscriptExporter(
+            date_from=parse_date(request.args.get('date_from')),
+            date_to=parse_date(request.args.get('date_to')),
+            status=request.args.get('status') or None,
+            department=request.args.get('department') or None,
+            include_archive=request.args.get('include_archive', 'false').lower() == 'true'
+        )
+    except ValueError:
+        return jsonify({'error': 'Invalid date filter'}), 400
+
+    return Response(
+        stream_with_context(exporter.export(data_format)),
+        mimetype=EXPORT_MIMETYPES[data_format],
+        headers={'Content-Disposition': f'attachment; filename=transcripts.{data_format}'}
+    )
+
+
+@app.route('/api/conversations/<int:conversation_id>/escalate', methods=['POST'])
+def escalate(conversation_id):
+    """Передача разговора HR-специалисту"""
+    try:
+        conversation = Conversation.query.get_or_404(conversation_id)
+        data = request.get_json(silent=True) or {}
+        escalate_conversation(conversation, data.get('reason', ''))
+        
+        return jsonify({'status': 'success'}), 200
+        
+    except Exception as e:
+        logging.error(f"Error escalating conversation: {str(e)}")
+        db.session.rollback()
+        return jsonify({'error': 'Failed to escalate conversation'}), 500
+
+
+@app.route('/api/outbox/stats', methods=['GET'])
+def outbox_stats():
+    """Метрики outbox: размер очереди, задержка доставки, мертвые записи"""
+    return jsonify(outbox_dispatcher.get_stats()), 200
+
+
+@app.route('/api/outbox/retry-dead', methods=['POST'])
+def outbox_retry_dead():
+    """Повторная отправка мертвых записей outbox
+
+    Записи, после которых в диалоге уже доставлены более поздние сообщения,
+    не переотправляются и возвращаются в superseded для ручного разбора.
+    """
+    return jsonify({'status': 'success', **outbox_dispatcher.retry_dead()}), 200
+
+
+@app.route('/api/analytics/sentiment', methods=['GET'])
+@read_replica
+def sentiment_rollups():
+    """Дневные итоги тональности и безопасности сообщений по категориям"""
+    days = min(request.args.get('days', 30, type=int), 366)
+    since = date.today() - timedelta(days=days)
+    rows = MessageScoreDaily.query.filter(
+        MessageScoreDaily.day >= since
+    ).order_by(MessageScoreDaily.day, MessageScoreDaily.category).all()
+
+    return jsonify([{
+        'day': row.day.isoformat(),
+        'category': row.category or None,
+        'messages': row.messages,
+        'positive': row.positive,
+        'negative': row.negative,
+        'neutral': row.neutral,
+        'unsafe': row.unsafe
+    } for row in rows]), 200
+
+
 @app.route('/api/bot-responses', methods=['POST'])
 def create_bot_response():
     """Создание нового предопределенного ответа"""
@@ -343,11 +930,14 @@ def create_bot_response():
             trigger_keywords=data['keywords'],
             response_text=data['response'],
             category=data['category'],
-            priority=data.get('priority', 0)
+            priority=data.get('priority', 0),
+            portal_id=data.get('portal_id')
         )
         
         db.session.add(response)
         db.session.commit()
+        message_classifier.reload()
+        answer_cache.clear()
         
         return jsonify({'status': 'success', 'id': response.id}), 201
         
@@ -356,6 +946,133 @@ def create_bot_response():
         return jsonify({'error': 'Failed to create response'}), 500
 
 
+@app.route('/api/maintenance/lifecycle', methods=['POST'])
+def run_lifecycle():
+    """Закрытие неактивных разговоров и архивирование старых сообщений (для cron)"""
+    try:
+        result = lifecycle_manager.run()
+        return jsonify({'status': 'success', **result}), 200
+
+    except Exception as e:
+        logging.error(f"Error running lifecycle job: {str(e)}")
+        return jsonify({'error': 'Failed to run lifecycle job'}), 500
+
+
+@app.route('/api/debug/query-stats', methods=['GET'])
+def query_stats():
+    """Агрегированная статистика SQL-запросов по эндпоинтам"""
+    return jsonify({
+        'slow_query_ms': query_profiler.slow_query_ms,
+        'n_plus_one_threshold': query_profiler.n_plus_one_threshold,
+        'endpoints': query_profiler.get_report()
+    }), 200
+
+
+@app.route('/api/health/ready', methods=['GET'])
+def readiness():
+    """Проба готовности: 503, пока процесс не завершил прогрев кэшей"""
+    ready = startup_report.ready_at is not None and cache_warmer.finished
+    return jsonify({'ready': ready, 'warmup': cache_warmer.get_stats()}), 200 if ready else 503
+
+
+@app.route('/api/debug/answer-cache', methods=['GET'])
+def answer_cache_stats():
+    """Попадания в кэш готовых ответов и результат прогрева"""
+    return jsonify({'cache': answer_cache.get_stats(), 'warmup': cache_warmer.get_stats()}), 200
+
+
+@app.route('/api/debug/startup', methods=['GET'])
+def startup_stats():
+    """Время холодного старта процесса и первого запроса"""
+    return jsonify(startup_report.get_report()), 200
+
+
+@app.route('/api/debug/llm-resilience', methods=['GET'])
+def llm_resilience_stats():
+    """Состояние предохранителей и адаптивных таймаутов YandexGPT"""
+    return jsonify(resilience.get_stats()), 200
+
+
+@app.route('/api/debug/single-flight', methods=['GET'])
+def single_flight_stats():
+    """Статистика объединения одинаковых запросов к LLM (только без контекста разговора)"""
+    return jsonify(llm_single_flight.get_stats()), 200
+
+
+@app.route('/api/debug/admission', methods=['GET'])
+def admission_stats():
+    """Очереди, допущенные и отклоненные сообщения по классам стоимости"""
+    return jsonify(admission_controller.get_stats()), 200
+
+
+@app.route('/api/debug/completion-plans', methods=['GET'])
+def completion_plan_stats():
+    """Таблица классов вопросов и фактический расход токенов по классам"""
+    return jsonify(gpt_client.planner.get_stats()), 200
+
+
+@app.route('/api/debug/classifier', methods=['GET'])
+def classifier_stats():
+    """Состояние единого классификатора; ?text= показывает разбор сообщения"""
+    text = request.args.get('text')
+    if text:
+        return jsonify(message_classifier.classify(text)), 200
+    return jsonify(message_classifier.get_stats()), 200
+
+
+@app.route('/api/debug/traffic-capture', methods=['GET'])
+def traffic_capture_stats():
+    """Состояние записи входящего трафика"""
+    return jsonify(traffic_capture.get_stats()), 200
+
+
+@app.route('/api/debug/profiles', methods=['GET'])
+def profile_stats():
+    """Состояние кэша профилей пользователей и подразделений"""
+    return jsonify(profile_enricher.get_stats()), 200
+
+
+@app.route('/api/debug/portals', methods=['GET'])
+def portal_stats():
+    """Порталы: квоты допуска, лимиты частоты REST API и кэши профилей по порталам"""
+    return jsonify(portal_registry.get_stats()), 200
+
+
+@app.route('/api/debug/chat-affinity', methods=['GET'])
+def chat_affinity_stats():
+    """Партиции чатов этого воркера и очередь inbox; ?chat_id= — партиция и владелец чата"""
+    stats = chat_affinity.get_stats()
+    chat_id = request.args.get('chat_id')
+    if chat_id:
+        portal_id = request.args.get('portal_id', type=int)
+        partition = partition_for(chat_id, portal_id, chat_affinity.partitions)
+        stats['chat'] = {
+            'chat_id': chat_id,
+            'partition': partition,
+            'owner': rendezvous_owner(partition, stats['members']),
+        }
+    return jsonify(stats), 200
+
+
+@app.route('/api/debug/db-routing', methods=['GET'])
+def db_routing_stats():
+    """Маршрутизация чтения на реплику и использование пулов по bind"""
+    return jsonify(replica_router.get_stats()), 200
+
+
+@app.route('/api/debug/logging-stats', methods=['GET'])
+def logging_stats():
+    """Состояние очереди логирования и количество отброшенных записей"""
+    return jsonify(logging_pipeline.get_stats()), 200
+
+
+@app.route('/api/debug/query-stats', methods=['DELETE'])
+def reset_query_stats():
+    """Сброс статистики SQL-запросов"""
+    query_profiler.reset()
+    return jsonify({'status': 'success'}), 200
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('base.html'), 404
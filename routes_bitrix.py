@@ -1,32 +1,40 @@
 from fastapi import APIRouter, Request
-import httpx
-import os
-from openai_client import ask_chatgpt
+from fastapi.responses import JSONResponse
+import logging
+import anyio
+from openai_client import aask_chatgpt
+from traffic_capture import traffic_capture
+from portals import portal_registry, UnknownPortalError
+from admission import admission_controller, OVERLOADED_RESPONSE
 
 router = APIRouter()
 
 @router.post("/bitrix-handler")
 async def handle_bitrix_event(request: Request):
     data = await request.json()
+    traffic_capture.record("/bitrix-handler", data)
     if data.get("event") == "ONIMBOTMESSAGEADD":
+        # Ответ уходит через учетные данные, пул и лимит того портала, откуда пришло событие
+        try:
+            portal = await anyio.to_thread.run_sync(portal_registry.resolve, data)
+        except UnknownPortalError as e:
+            logging.warning(f"Bitrix event from unknown portal rejected: {str(e)}")
+            return JSONResponse({"error": "Unknown portal"}, status_code=403)
+
         message = data["data"]["PARAMS"]["MESSAGE"]
         dialog_id = data["data"]["PARAMS"]["DIALOG_ID"]
         bot_id = data["data"]["BOT_ID"]
 
-        answer = ask_chatgpt(message)
-
-        payload = {
-            "BOT_ID": bot_id,
-            "DIALOG_ID": dialog_id,
-            "CLIENT_ID": os.getenv("BITRIX_CLIENT_ID"),
-            "MESSAGE": answer
-        }
+        # Квота портала: всплеск на одном портале не занимает LLM для остальных
+        if await portal.admission.aacquire(admission_controller.latency_target):
+            try:
+                # Запрос к LLM не блокирует цикл событий
+                answer = await aask_chatgpt(message)
+            finally:
+                portal.admission.arelease()
+        else:
+            answer = OVERLOADED_RESPONSE
 
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                os.getenv("BITRIX_WEBHOOK_URL") + "imbot.message.add.json",
-                json=payload,
-                headers={"Content-Type": "application/json"}
-            )
+        await portal.client.asend_bot_message(bot_id, dialog_id, answer, portal.client_id)
 
     return {"result": "ok"}
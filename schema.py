@@ -0,0 +1,136 @@
+import logging
+from typing import List
+
+from sqlalchemy import inspect, text
+from app import db
+
+
+# Ограничения, замененные составными; снимаются там, где СУБД это позволяет
+LEGACY_UNIQUE_CONSTRAINTS = [
+    # bitrix_user_id уникален в пределах портала (ux_user_shared_/ux_user_tenant_bitrix_user_id)
+    ('user', 'user_bitrix_user_id_key'),
+    # external_id уникален в пределах портала (ux_kb_article_*_external_id)
+    ('knowledge_base_article', 'knowledge_base_article_external_id_key'),
+]
+
+# Индексы прежних версий, замененные составными
+LEGACY_INDEXES = [
+    'ux_knowledge_base_article_external_id',
+    # Обычный индекс не ограничивал пользователей портала по умолчанию (portal_id IS NULL)
+    'ux_user_portal_bitrix_user_id',
+]
+
+
+def merge_duplicate_users(connection) -> List[str]:
+    """Слияние дублей пользователей портала по умолчанию перед созданием уникального индекса
+
+    Дубли могли появиться, пока bitrix_user_id при portal_id IS NULL не был
+    уникален; разговоры переносятся на самую раннюю запись.
+    """
+    duplicates = connection.execute(text(
+        'SELECT bitrix_user_id, MIN(id) FROM "user" WHERE portal_id IS NULL '
+        'GROUP BY bitrix_user_id HAVING COUNT(*) > 1'
+    )).all()
+    for bitrix_user_id, keep_id in duplicates:
+        params = {'bitrix_user_id': bitrix_user_id, 'keep_id': keep_id}
+        connection.execute(text(
+            'UPDATE conversation SET user_id = :keep_id WHERE user_id IN ('
+            'SELECT id FROM "user" WHERE portal_id IS NULL AND bitrix_user_id = :bitrix_user_id AND id <> :keep_id)'
+        ), params)
+        connection.execute(text(
+            'DELETE FROM "user" WHERE portal_id IS NULL AND bitrix_user_id = :bitrix_user_id AND id <> :keep_id'
+        ), params)
+    return [f"merge duplicate users ({len(duplicates)} bitrix_user_id)"] if duplicates else []
+
+
+def backfill_article_external_ids(connection) -> List[str]:
+    """Ключ импорта для статей, созданных до его появления
+
+    Импорт без external_id использует заголовок, поэтому им же заполняются
+    старые статьи; повтор заголовка в портале получает id статьи.
+    """
+    missing = connection.execute(text(
+        'SELECT id, portal_id, title FROM knowledge_base_article WHERE external_id IS NULL ORDER BY id'
+    )).all()
+    if not missing:
+        return []
+    taken = {tuple(row) for row in connection.execute(text(
+        'SELECT portal_id, external_id FROM knowledge_base_article WHERE external_id IS NOT NULL'
+    ))}
+
+    for article_id, portal_id, title in missing:
+        key = (title or '')[:255]
+        if not key or (portal_id, key) in taken:
+            key = str(article_id)
+        taken.add((portal_id, key))
+        connection.execute(
+            text('UPDATE knowledge_base_article SET external_id = :key WHERE id = :id'),
+            {'key': key, 'id': article_id}
+        )
+    return [f"backfill knowledge_base_article.external_id ({len(missing)} rows)"]
+
+
+# Заполнение данных после добавления столбцов и до создания индексов таблицы
+BACKFILLS = {
+    'knowledge_base_article': backfill_article_external_ids,
+    'user': merge_duplicate_users,
+}
+
+
+def migrate_schema() -> List[str]:
+    """Явный шаг миграции схемы
+
+    Создает отсутствующие таблицы, добавляет новые столбцы и индексы
+    в существующие таблицы. Выполняется при деплое, а не при импорте приложения.
+    """
+    import models  # noqa: F401
+
+    applied = []
+    db.create_all()
+
+    engine = db.engine
+    inspector = inspect(engine)
+
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                applied.append(f"add column {table.name}.{column.name}")
+
+                if column.unique:
+                    index_name = f"ux_{table.name}_{column.name}"
+                    connection.execute(text(
+                        f'CREATE UNIQUE INDEX "{index_name}" ON "{table.name}" ("{column.name}")'
+                    ))
+                    applied.append(f"create unique index {index_name}")
+
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index_name in LEGACY_INDEXES:
+                if index_name in existing_indexes:
+                    connection.execute(text(f'DROP INDEX "{index_name}"'))
+                    applied.append(f"drop index {index_name}")
+
+            if table.name in BACKFILLS:
+                applied.extend(BACKFILLS[table.name](connection))
+
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection, checkfirst=True)
+                    applied.append(f"create index {index.name}")
+
+        # В SQLite ограничение столбца снимается только пересозданием таблицы
+        if engine.dialect.name == 'postgresql':
+            for table_name, constraint_name in LEGACY_UNIQUE_CONSTRAINTS:
+                existing = {constraint['name'] for constraint in inspector.get_unique_constraints(table_name)}
+                if constraint_name in existing:
+                    connection.execute(text(f'ALTER TABLE "{table_name}" DROP CONSTRAINT "{constraint_name}"'))
+                    applied.append(f"drop constraint {constraint_name}")
+
+    for step in applied:
+        logging.info(f"Schema migration: {step}")
+    return applied
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Any, Callable, Awaitable, Dict, Optional
+
+
+def prompt_key(payload: Dict[str, Any]) -> str:
+    """Ключ запроса: хеш нормализованного тела (регистр и пробелы не учитываются)"""
+    def normalize(value):
+        if isinstance(value, str):
+            return ' '.join(value.lower().split())
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        return value
+
+    raw = json.dumps(normalize(payload), ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class RedisCoordinator:
+    """Межпроцессная координация через Redis
+
+    Лидер захватывает ключ через SET NX и публикует результат,
+    остальные процессы ждут результат до wait_timeout.
+    """
+
+    def __init__(self, url: str, lock_ttl: float = 60.0, wait_timeout: float = 30.0):
+        import redis  # необязательная зависимость
+
+        self.client = redis.Redis.from_url(url)
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+
+    def acquire(self, key: str) -> bool:
+        return bool(self.client.set(f"sf:lock:{key}", b'1', nx=True, px=int(self.lock_ttl * 1000)))
+
+    def publish(self, key: str, value: Any):
+        self.client.set(f"sf:result:{key}", json.dumps(value, ensure_ascii=False), px=int(self.lock_ttl * 1000))
+        self.client.delete(f"sf:lock:{key}")
+
+    def release(self, key: str):
+        self.client.delete(f"sf:lock:{key}")
+
+    def wait(self, key: str) -> Optional[Any]:
+        """Ожидание результата лидера; None, если лидер не успел или упал"""
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            raw = self.client.get(f"sf:result:{key}")
+            if raw is not None:
+                return json.loads(raw)
+            if not self.client.exists(f"sf:lock:{key}"):
+                raw = self.client.get(f"sf:result:{key}")
+                return json.loads(raw) if raw is not None else None
+            time.sleep(0.05)
+        return None
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных вызовов в один
+
+    Первый вызов с ключом выполняет функцию, остальные ждут и получают
+    тот же результат (или то же исключение). Поддерживает потоки и asyncio
+    внутри процесса и, при наличии координатора, несколько процессов.
+
+    Ключ — хеш всего тела запроса, поэтому объединять имеет смысл только
+    вызовы без истории разговора: с контекстом тело уникально для чата
+    и почти никогда не совпадает. Такие вызовы выполняются напрямую
+    и учитываются в статистике как bypassed.
+    """
+
+    def __init__(self, coordinator=None):
+        self.coordinator = coordinator
+        self._calls: Dict[str, _Call] = {}
+        self._async_calls: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'executed': 0, 'coalesced': 0, 'coalesced_remote': 0, 'bypassed': 0}
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def bypass(self, func: Callable[[], Any]) -> Any:
+        """Выполнение без объединения (запрос с контекстом разговора)"""
+        self._count('bypassed')
+        return func()
+
+    async def abypass(self, func: Callable[[], Awaitable[Any]]) -> Any:
+        self._count('bypassed')
+        return await func()
+
+    def do(self, key: str, func: Callable[[], Any]) -> Any:
+        """Выполнение func один раз на ключ среди одновременных вызовов"""
+        with self._lock:
+            self._stats['calls'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            self._count('coalesced')
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._execute(key, func)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def _execute(self, key: str, func: Callable[[], Any]) -> Any:
+        if self.coordinator is None:
+            self._count('executed')
+            return func()
+
+        try:
+            is_leader = self.coordinator.acquire(key)
+        except Exception as e:
+            logging.warning(f"Single-flight coordinator unavailable: {str(e)}")
+            self._count('executed')
+            return func()
+
+        if not is_leader:
+            try:
+                result = self.coordinator.wait(key)
+            except Exception as e:
+                logging.warning(f"Single-flight coordinator wait failed: {str(e)}")
+                result = None
+            if result is not None:
+                self._count('coalesced_remote')
+                return result
+            self._count('executed')
+            return func()
+
+        self._count('executed')
+        try:
+            result = func()
+        except BaseException:
+            self._safe_coordinator_call(self.coordinator.release, key)
+            raise
+        self._safe_coordinator_call(self.coordinator.publish, key, result)
+        return result
+
+    def _safe_coordinator_call(self, method, *args):
+        try:
+            method(*args)
+        except Exception as e:
+            logging.warning(f"Single-flight coordinator error: {str(e)}")
+
+    async def ado(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Асинхронный вариант do для вызовов в цикле событий"""
+        with self._lock:
+            self._stats['calls'] += 1
+        future = self._async_calls.get(key)
+        if future is not None:
+            self._count('coalesced')
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._async_calls[key] = future
+        try:
+            if self.coordinator is None:
+                self._count('executed')
+                result = await func()
+            else:
+                result = await self._aexecute(key, func)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение получат ожидающие; помечаем его обработанным для лидера
+            future.exception()
+            raise
+        finally:
+            self._async_calls.pop(key, None)
+
+    async def _aexecute(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            is_leader = await asyncio.to_thread(self.coordinator.acquire, key)
+        except Exception as e:
+            logging.warning(f"Single-flight coordinator unavailable: {str(e)}")
+            is_leader = True
+
+        if not is_leader:
+            try:
+                result = await asyncio.to_thread(self.coordinator.wait, key)
+            except Exception:
+                result = None
+            if result is not None:
+                self._count('coalesced_remote')
+                return result
+            self._count('executed')
+            return await func()
+
+        self._count('executed')
+        try:
+            result = await func()
+        except BaseException:
+            await asyncio.to_thread(self._safe_coordinator_call, self.coordinator.release, key)
+            raise
+        await asyncio.to_thread(self._safe_coordinator_call, self.coordinator.publish, key, result)
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики объединения: доля вызовов, получивших чужой результат
+
+        coalescing_ratio считается по вызовам без контекста; bypassed —
+        запросы с историей разговора, которые не объединяются.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls) + len(self._async_calls)
+        coalesced = stats['coalesced'] + stats['coalesced_remote']
+        stats['coalescing_ratio'] = round(coalesced / stats['calls'], 4) if stats['calls'] else 0.0
+        return stats
+
+
+def create_single_flight() -> SingleFlight:
+    """SingleFlight с координатором из окружения (SINGLE_FLIGHT_REDIS_URL)"""
+    redis_url = os.environ.get('SINGLE_FLIGHT_REDIS_URL', '')
+    coordinator = None
+    if redis_url:
+        try:
+            coordinator = RedisCoordinator(
+                redis_url,
+                wait_timeout=float(os.environ.get('SINGLE_FLIGHT_WAIT_SECONDS', '30'))
+            )
+        except ImportError:
+            logging.warning("redis package is not installed, single-flight works within the process only")
+    return SingleFlight(coordinator)
+
+
+llm_single_flight = create_single_flight()
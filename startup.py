@@ -0,0 +1,124 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Any, Optional
+
+from flask import request
+
+
+class StartupReport:
+    """Замер времени холодного старта: импорт, фазы инициализации и первый запрос"""
+
+    def __init__(self):
+        self.budget_ms = float(os.environ.get('STARTUP_BUDGET_MS', '2000'))
+        self.import_started: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        self.phases: Dict[str, float] = {}
+        self.services: Dict[str, float] = {}
+        self.first_request_ms: Optional[float] = None
+        self.first_request_path: Optional[str] = None
+        self._lock = threading.Lock()
+        self._first_request_started: Optional[float] = None
+
+    def mark_import_started(self, started: float):
+        self.import_started = started
+
+    @contextmanager
+    def phase(self, name: str):
+        """Замер длительности фазы инициализации"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.perf_counter() - started) * 1000, 2)
+
+    def record_service(self, name: str, duration_ms: float):
+        self.services[name] = round(duration_ms, 2)
+
+    def mark_ready(self):
+        self.ready_at = time.perf_counter()
+        startup_ms = self.startup_ms
+        if startup_ms is not None and startup_ms > self.budget_ms:
+            logging.warning("Startup took %.0f ms, budget is %.0f ms: %s", startup_ms, self.budget_ms, self.phases)
+        else:
+            logging.info("Startup finished in %s ms", startup_ms)
+
+    @property
+    def startup_ms(self) -> Optional[float]:
+        if self.import_started is None or self.ready_at is None:
+            return None
+        return round((self.ready_at - self.import_started) * 1000, 2)
+
+    def init_app(self, app):
+        """Замер первого запроса, обслуженного процессом"""
+        app.before_request(self._before_first_request)
+        app.after_request(self._after_first_request)
+
+    def _before_first_request(self):
+        if self._first_request_started is None:
+            with self._lock:
+                if self._first_request_started is None:
+                    self._first_request_started = time.perf_counter()
+
+    def _after_first_request(self, response):
+        if self.first_request_ms is None and self._first_request_started is not None:
+            with self._lock:
+                if self.first_request_ms is None:
+                    self.first_request_ms = round((time.perf_counter() - self._first_request_started) * 1000, 2)
+                    self.first_request_path = request.path
+                    logging.info("First request %s served in %s ms", request.path, self.first_request_ms)
+        return response
+
+    def get_report(self) -> Dict[str, Any]:
+        return {
+            'pid': os.getpid(),
+            'startup_ms': self.startup_ms,
+            'budget_ms': self.budget_ms,
+            'within_budget': self.startup_ms is not None and self.startup_ms <= self.budget_ms,
+            'phases_ms': dict(self.phases),
+            'services_ms': dict(self.services),
+            'first_request_ms': self.first_request_ms,
+            'first_request_path': self.first_request_path,
+        }
+
+
+startup_report = StartupReport()
+
+
+class LazyService:
+    """Отложенное создание клиента при первом обращении к его атрибутам"""
+
+    _registry: Dict[str, 'LazyService'] = {}
+
+    def __init__(self, name: str, factory: Callable[[], Any]):
+        self._name = name
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+        LazyService._registry[name] = self
+
+    def _get_instance(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    started = time.perf_counter()
+                    self._instance = self._factory()
+                    startup_report.record_service(self._name, (time.perf_counter() - started) * 1000)
+        return self._instance
+
+    def __getattr__(self, item):
+        if item in ('_name', '_factory', '_instance', '_lock'):
+            raise AttributeError(item)
+        return getattr(self._get_instance(), item)
+
+    @classmethod
+    def warm_all(cls):
+        """Создание всех зарегистрированных клиентов заранее (например, в мастере gunicorn)"""
+        for service in cls._registry.values():
+            service._get_instance()
+
+
+def lazy_service(name: str, factory: Callable[[], Any]) -> Any:
+    return LazyService(name, factory)
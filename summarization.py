@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import select, update
+from app import db
+from models import Conversation, Message, MessageArchive
+from yandex_gpt_client import CircuitOpenError
+
+
+SPEAKERS = {'user': 'Сотрудник', 'bot': 'Бот', 'system': 'Система'}
+
+
+class RateLimiter:
+    """Ограничение частоты вызовов: не больше rate запросов в секунду"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_at)
+            self._next_at = start_at + self.interval
+        if start_at > now:
+            time.sleep(start_at - now)
+
+
+class ConversationSummarizer:
+    """Пакетное резюмирование закрытых и эскалированных разговоров
+
+    Разговоры без резюме выбираются пачками по возрастанию id, запросы
+    к YandexGPT выполняются пулом потоков с ограничением частоты, а
+    резюме сохраняются по мере готовности. Прерванный запуск продолжается
+    с первого разговора без резюме.
+    """
+
+    STATUSES = ('closed', 'escalated')
+
+    def __init__(self, gpt_client, concurrency: Optional[int] = None, rate: Optional[float] = None):
+        self.gpt_client = gpt_client
+        self.concurrency = concurrency or int(os.environ.get('SUMMARY_CONCURRENCY', '4'))
+        self.rate = rate or float(os.environ.get('SUMMARY_RATE_PER_SECOND', '2'))
+        self.batch_size = int(os.environ.get('SUMMARY_BATCH_SIZE', '100'))
+        self.messages_per_conversation = 10
+
+    def _pending_ids(self, after_id: int, limit: int) -> List[int]:
+        return list(db.session.execute(
+            select(Conversation.id).where(
+                Conversation.status.in_(self.STATUSES),
+                Conversation.summarized_at.is_(None),
+                Conversation.id > after_id
+            ).order_by(Conversation.id).limit(limit)
+        ).scalars())
+
+    def _load_transcripts(self, conversation_ids: List[int]) -> Dict[int, List[str]]:
+        """Последние сообщения каждого разговора пачки, включая архив"""
+        transcripts = defaultdict(lambda: deque(maxlen=self.messages_per_conversation))
+
+        for model in (MessageArchive, Message):
+            rows = db.session.execute(
+                select(model).where(
+                    model.conversation_id.in_(conversation_ids)
+                ).order_by(model.conversation_id, model.timestamp, model.id)
+            ).scalars()
+            for message in rows:
+                speaker = SPEAKERS.get(message.message_type, message.message_type)
+                transcripts[message.conversation_id].append(f"{speaker}: {message.content}")
+
+        # Из сессии удаляются прочитанные объекты: пачка не копит память
+        db.session.expunge_all()
+        return {conversation_id: list(lines) for conversation_id, lines in transcripts.items()}
+
+    def _summarize(self, limiter: RateLimiter, lines: List[str]) -> Dict:
+        limiter.wait()
+        return self.gpt_client.request_summary(lines)
+
+    def _save(self, summaries: Dict[int, str]):
+        now = datetime.utcnow()
+        for conversation_id, summary in summaries.items():
+            db.session.execute(
+                update(Conversation).where(Conversation.id == conversation_id).values(
+                    summary=summary, summarized_at=now
+                )
+            )
+        db.session.commit()
+
+    def run(self, limit: Optional[int] = None) -> Dict:
+        """Резюмирование до limit разговоров; возвращает отчет о пропускной способности"""
+        report = {'summarized': 0, 'empty': 0, 'failed': 0, 'input_tokens': 0, 'completion_tokens': 0}
+        limiter = RateLimiter(self.rate)
+        started = time.monotonic()
+        after_id = 0
+        circuit_open = False
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='summary') as executor:
+            while not circuit_open:
+                remaining = None if limit is None else limit - report['summarized'] - report['empty']
+                if remaining is not None and remaining <= 0:
+                    break
+                batch_limit = self.batch_size if remaining is None else min(self.batch_size, remaining)
+
+                conversation_ids = self._pending_ids(after_id, batch_limit)
+                if not conversation_ids:
+                    break
+                after_id = conversation_ids[-1]
+                transcripts = self._load_transcripts(conversation_ids)
+
+                # Разговоры без сообщений помечаются сразу, чтобы не выбирать их снова
+                empty = {conversation_id: '' for conversation_id in conversation_ids if conversation_id not in transcripts}
+                futures = {
+                    executor.submit(self._summarize, limiter, lines): conversation_id
+                    for conversation_id, lines in transcripts.items()
+                }
+
+                summaries = dict(empty)
+                for future in as_completed(futures):
+                    conversation_id = futures[future]
+                    try:
+                        result = future.result()
+                    except CircuitOpenError:
+                        circuit_open = True
+                        report['failed'] += 1
+                        continue
+                    except Exception as e:
+                        logging.error(f"Error summarizing conversation {conversation_id}: {str(e)}")
+                        report['failed'] += 1
+                        continue
+
+                    summary = self.gpt_client._extract_text(result)
+                    if not summary:
+                        report['failed'] += 1
+                        continue
+                    usage = result.get('result', {}).get('usage', {})
+                    report['input_tokens'] += int(usage.get('inputTextTokens', 0))
+                    report['completion_tokens'] += int(usage.get('completionTokens', 0))
+                    summaries[conversation_id] = summary
+
+                self._save(summaries)
+                report['summarized'] += len(summaries) - len(empty)
+                report['empty'] += len(empty)
+
+                elapsed = time.monotonic() - started
+                logging.info(
+                    f"Summarized {report['summarized']} conversations "
+                    f"({report['summarized'] * 60 / elapsed:.1f}/min), failed {report['failed']}"
+                )
+
+        if circuit_open:
+            logging.warning("YandexGPT circuit is open, summarization stopped; rerun to resume")
+
+        elapsed = time.monotonic() - started
+        report['seconds'] = round(elapsed, 1)
+        report['per_minute'] = round(report['summarized'] * 60 / elapsed, 1) if elapsed else 0.0
+        report['stopped_by_circuit'] = circuit_open
+        return report
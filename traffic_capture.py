@@ -0,0 +1,143 @@
+import os
+import re
+import hmac
+import gzip
+import json
+import time
+import queue
+import random
+import hashlib
+import logging
+import threading
+from typing import Dict, Any, Optional
+
+
+# Значения этих ключей заменяются устойчивыми псевдонимами
+ID_KEYS = {'id', 'user_id', 'chat_id', 'dialog_id', 'from_user_id', 'author_id', 'to_user_id', 'chat_entity_id'}
+NAME_KEYS = {'name', 'first_name', 'last_name', 'second_name', 'user_name', 'login', 'email', 'personal_photo', 'phone'}
+# Учетные данные не записываются вовсе
+# Из auth удаляются только секреты: по auth.domain реестр порталов определяет портал события
+SECRET_KEYS = {'access_token', 'refresh_token', 'application_token', 'client_secret', 'member_id', 'password'}
+TEXT_KEYS = {'text', 'message'}
+
+EMAIL_PATTERN = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+')
+PHONE_PATTERN = re.compile(r'\+?\d[\d\s()-]{8,}\d')
+
+
+class TrafficCapture:
+    """Запись обезличенных входящих веб-хуков для последующего воспроизведения
+
+    Включается переменной TRAFFIC_CAPTURE_PATH. Записи (время, путь, тело)
+    копятся в очереди и дописываются фоновым потоком пачками: каждая пачка —
+    один вызов write в файл, открытый на добавление, а для .gz — отдельный
+    gzip-член. Поэтому несколько воркеров могут писать в один файл.
+    """
+
+    def __init__(self):
+        self.path = os.environ.get('TRAFFIC_CAPTURE_PATH', '')
+        self.sample_rate = float(os.environ.get('TRAFFIC_CAPTURE_SAMPLE', '1.0'))
+        # Соль общая для всех воркеров, иначе псевдонимы одного пользователя разойдутся
+        salt = os.environ.get('TRAFFIC_CAPTURE_SALT') or os.environ.get('SESSION_SECRET', '')
+        self.salt = salt.encode('utf-8')
+        self.batch_size = 200
+
+        self._queue: queue.Queue = queue.Queue(maxsize=int(os.environ.get('TRAFFIC_CAPTURE_QUEUE', '10000')))
+        self._writer: Optional[threading.Thread] = None
+        self._writer_pid = None
+        self._lock = threading.Lock()
+        self.stats = {'captured': 0, 'dropped': 0, 'written': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    # ==== Обезличивание ====
+
+    def pseudonym(self, value: Any, keep_prefix: bool = False) -> str:
+        """Устойчивый псевдоним: одно и то же значение дает один и тот же псевдоним"""
+        raw = str(value)
+        digest = hmac.new(self.salt, raw.encode('utf-8'), hashlib.sha256).hexdigest()[:12]
+        number = str(int(digest, 16) % 10 ** 9)
+        # Префикс диалога (chat123) сохраняется: по нему Битрикс24 различает типы чатов
+        return re.match(r'^[a-zA-Z]*', raw).group(0) + number if keep_prefix else number
+
+    def mask_text(self, text: str) -> str:
+        text = EMAIL_PATTERN.sub('user@example.com', text)
+        return PHONE_PATTERN.sub('+70000000000', text)
+
+    def anonymize(self, value: Any, key: str = '') -> Any:
+        key = key.lower()
+        if isinstance(value, dict):
+            return {
+                item_key: self.anonymize(item, item_key)
+                for item_key, item in value.items()
+                if item_key.lower() not in SECRET_KEYS
+            }
+        if isinstance(value, list):
+            return [self.anonymize(item, key) for item in value]
+        if value is None or value == '':
+            return value
+        if key in ID_KEYS:
+            return self.pseudonym(value, keep_prefix=True)
+        if key in NAME_KEYS:
+            return f"user-{self.pseudonym(value)}"
+        if key in TEXT_KEYS and isinstance(value, str):
+            return self.mask_text(value)
+        return value
+
+    # ==== Запись ====
+
+    def record(self, path: str, payload: Dict[str, Any]):
+        """Постановка веб-хука в очередь записи без ожидания диска"""
+        if not self.enabled or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            return
+        try:
+            line = json.dumps(
+                {'t': round(time.time(), 3), 'p': path, 'b': self.anonymize(payload)},
+                ensure_ascii=False,
+                separators=(',', ':')
+            )
+        except (TypeError, ValueError) as e:
+            logging.warning(f"Failed to capture webhook payload: {str(e)}")
+            return
+
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(line)
+            self.stats['captured'] += 1
+        except queue.Full:
+            self.stats['dropped'] += 1
+
+    def _ensure_writer(self):
+        # После fork поток записи в дочернем процессе нужно запустить заново
+        if self._writer is not None and self._writer_pid == os.getpid() and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._writer is None or self._writer_pid != os.getpid() or not self._writer.is_alive():
+                self._writer_pid = os.getpid()
+                self._writer = threading.Thread(target=self._run, name='traffic-capture', daemon=True)
+                self._writer.start()
+
+    def _run(self):
+        descriptor = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        compress = self.path.endswith('.gz')
+        while True:
+            lines = [self._queue.get()]
+            while len(lines) < self.batch_size:
+                try:
+                    lines.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            data = ('\n'.join(lines) + '\n').encode('utf-8')
+            try:
+                os.write(descriptor, gzip.compress(data) if compress else data)
+                self.stats['written'] += len(lines)
+            except OSError as e:
+                logging.error(f"Failed to write captured traffic: {str(e)}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'enabled': self.enabled, 'path': self.path or None, 'queue_size': self._queue.qsize(), **self.stats}
+
+
+traffic_capture = TrafficCapture()
@@ -0,0 +1,262 @@
+import gzip
+import json
+import time
+import random
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Iterator, List, Optional
+
+import requests
+
+
+# Эндпоинты с кэшами и объединением запросов, по которым считаются попадания
+CACHE_ENDPOINTS = {
+    'single_flight': '/api/debug/single-flight',
+    'profiles': '/api/debug/profiles',
+    'classifier': '/api/debug/classifier',
+    'answers': '/api/debug/answer-cache',
+}
+
+
+def load_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Чтение записанного трафика (NDJSON или NDJSON.gz из нескольких gzip-членов)"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as source:
+        for line in source:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class TrafficReplayer:
+    """Воспроизведение записанных веб-хуков против локального экземпляра
+
+    speed=1 сохраняет исходные интервалы, speed=N сжимает их в N раз,
+    speed=0 отправляет запросы без пауз (ограничено только concurrency).
+    portal_tokens (домен → application_token) возвращает в auth событий
+    токены, удаленные при записи, для порталов целевого экземпляра.
+    """
+
+    def __init__(self, target: str, speed: float = 1.0, concurrency: int = 32, stub_url: Optional[str] = None,
+                 portal_tokens: Optional[Dict[str, str]] = None, debug_token: str = ''):
+        self.target = target.rstrip('/')
+        self.portal_tokens = {domain.lower(): token for domain, token in (portal_tokens or {}).items()}
+        self.speed = speed
+        self.concurrency = concurrency
+        self.stub_url = stub_url.rstrip('/') if stub_url else None
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.debug_token = debug_token
+
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def _with_token(self, body: Any) -> Any:
+        auth = body.get('auth') if isinstance(body, dict) else None
+        token = self.portal_tokens.get((auth or {}).get('domain', '').lower()) if isinstance(auth, dict) else None
+        if not token:
+            return body
+        return {**body, 'auth': {**auth, 'application_token': token}}
+
+    def _send(self, record: Dict[str, Any]):
+        path = record['p']
+        started = time.perf_counter()
+        try:
+            response = self.session.post(self.target + path, json=self._with_token(record['b']), timeout=120)
+            status = str(response.status_code)
+        except requests.exceptions.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self.latencies[path].append(elapsed)
+            self.statuses[path][status] += 1
+
+    def _snapshot(self) -> Dict[str, Any]:
+        snapshot = {}
+        for name, endpoint in CACHE_ENDPOINTS.items():
+            try:
+                snapshot[name] = self.session.get(
+                    self.target + endpoint, headers={'X-Debug-Token': self.debug_token}, timeout=5
+                ).json()
+            except (requests.exceptions.RequestException, ValueError):
+                snapshot[name] = None
+        if self.stub_url:
+            try:
+                snapshot['stub'] = self.session.get(self.stub_url + '/__stats', timeout=5).json()
+            except (requests.exceptions.RequestException, ValueError):
+                snapshot['stub'] = None
+        return snapshot
+
+    def run(self, records: Iterator[Dict[str, Any]]) -> Dict[str, Any]:
+        before = self._snapshot()
+        started = time.monotonic()
+        first_ts = None
+        sent = 0
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='replay') as executor:
+            for record in records:
+                if first_ts is None:
+                    first_ts = record['t']
+                if self.speed > 0:
+                    delay = (record['t'] - first_ts) / self.speed - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(self._send, record)
+                sent += 1
+
+        duration = time.monotonic() - started
+        return self.report(sent, duration, before, self._snapshot())
+
+    def report(self, sent: int, duration: float, before: Dict, after: Dict) -> Dict[str, Any]:
+        paths = {}
+        for path, samples in self.latencies.items():
+            samples = sorted(samples)
+            paths[path] = {
+                'requests': len(samples),
+                'statuses': dict(self.statuses[path]),
+                'p50_ms': round(percentile(samples, 0.5) * 1000, 1),
+                'p90_ms': round(percentile(samples, 0.9) * 1000, 1),
+                'p99_ms': round(percentile(samples, 0.99) * 1000, 1),
+                'max_ms': round(samples[-1] * 1000, 1) if samples else 0.0,
+            }
+
+        return {
+            'sent': sent,
+            'seconds': round(duration, 2),
+            'rps': round(sent / duration, 1) if duration else 0.0,
+            'speed': self.speed or 'max',
+            'paths': paths,
+            'caches': self._cache_report(sent, before, after),
+        }
+
+    def _cache_report(self, sent: int, before: Dict, after: Dict) -> Dict[str, Any]:
+        def delta(name, *keys):
+            values = []
+            for snapshot in (before, after):
+                value = snapshot.get(name)
+                for key in keys:
+                    value = value.get(key) if isinstance(value, dict) else None
+                values.append(value or 0)
+            return values[1] - values[0]
+
+        def ratio(hits, total):
+            return round(hits / total, 4) if total else None
+
+        calls = delta('single_flight', 'calls')
+        coalesced = delta('single_flight', 'coalesced') + delta('single_flight', 'coalesced_remote')
+        profile_hits = sum(delta('profiles', 'users_cache', key) for key in ('hits', 'stale_hits', 'negative_hits'))
+        profile_misses = delta('profiles', 'users_cache', 'misses')
+
+        caches = {
+            'llm_coalescing_ratio': ratio(coalesced, calls),
+            'profile_cache_hit_ratio': ratio(profile_hits, profile_hits + profile_misses),
+            'classifier_reloads': delta('classifier', 'reloads'),
+            'answer_cache_hit_ratio': ratio(
+                delta('answers', 'cache', 'hits') + delta('answers', 'cache', 'negative_hits'),
+                delta('answers', 'cache', 'hits') + delta('answers', 'cache', 'negative_hits')
+                + delta('answers', 'cache', 'misses')
+            ),
+        }
+        if self.stub_url:
+            # Доля сообщений, ответ на которые получен без обращения к LLM
+            llm_calls = delta('stub', 'llm')
+            caches['llm_calls'] = llm_calls
+            caches['answered_without_llm_ratio'] = ratio(max(sent - llm_calls, 0), sent)
+            caches['bitrix_calls'] = delta('stub', 'bitrix')
+        return caches
+
+
+class StubBackends:
+    """Заглушки Битрикс24, YandexGPT и OpenAI для воспроизведения трафика
+
+    Экземпляр приложения направляется на заглушку через BITRIX_WEBHOOK_URL,
+    YANDEX_GPT_URL и OPENAI_API_URL. Задержки ответов LLM и Битрикс24
+    настраиваются, счетчики вызовов доступны по GET /__stats.
+    """
+
+    def __init__(self, llm_latency: float = 1.0, bitrix_latency: float = 0.05, jitter: float = 0.2):
+        self.llm_latency = llm_latency
+        self.bitrix_latency = bitrix_latency
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        self.stats = {'llm': 0, 'bitrix': 0}
+
+    def _delay(self, base: float):
+        if base > 0:
+            time.sleep(base * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def respond(self, path: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        text = "Это тестовый ответ для воспроизведения трафика."
+        if path.endswith('/completion'):
+            self._count('llm')
+            self._delay(self.llm_latency)
+            return {'result': {
+                'alternatives': [{'message': {'role': 'assistant', 'text': text}, 'status': 'ALTERNATIVE_STATUS_FINAL'}],
+                'usage': {'inputTextTokens': '100', 'completionTokens': '20', 'totalTokens': '120'},
+            }}
+        if path.endswith('/chat/completions'):
+            self._count('llm')
+            self._delay(self.llm_latency)
+            return {'choices': [{'message': {'role': 'assistant', 'content': text}}]}
+
+        self._count('bitrix')
+        self._delay(self.bitrix_latency)
+        if 'user.get' in path:
+            user_id = (body.get('ID') or body.get('id') or '1')
+            return {'result': [{'ID': str(user_id), 'NAME': 'Тест', 'LAST_NAME': 'Пользователь',
+                                'ACTIVE': True, 'UF_DEPARTMENT': [1]}], 'total': 1}
+        if 'department.get' in path:
+            return {'result': [{'ID': '1', 'NAME': 'Тестовый отдел'}], 'total': 1}
+        return {'result': True}
+
+    def serve(self, host: str = '127.0.0.1', port: int = 8090):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == '/__stats':
+                    with stub._lock:
+                        return self._reply(dict(stub.stats))
+                self._reply(stub.respond(self.path.split('?')[0], {}))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                try:
+                    body = json.loads(raw) if raw else {}
+                except ValueError:
+                    body = {}
+                self._reply(stub.respond(self.path.split('?')[0], body if isinstance(body, dict) else {}))
+
+            def log_message(self, format, *args):
+                logging.debug("stub: " + format, *args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        logging.info(f"Stub backends listening on http://{host}:{port}")
+        server.serve_forever()
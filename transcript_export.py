@@ -0,0 +1,175 @@
+import io
+import csv
+import json
+import zlib
+import logging
+from datetime import datetime
+from typing import Iterator, Optional, Dict, Any
+
+from sqlalchemy import select
+from app import db
+from models import User, Conversation, Message, MessageArchive
+
+
+TRANSCRIPT_FIELDS = [
+    'message_id', 'timestamp', 'message_type', 'content',
+    'processed_by_gpt', 'response_time', 'knowledge_base_used',
+    'conversation_id', 'chat_id', 'conversation_status', 'escalated_to_human',
+    'started_at', 'ended_at',
+    'user_id', 'bitrix_user_id', 'user_name', 'department', 'position',
+]
+
+
+class TranscriptExporter:
+    """Потоковая выгрузка переписки для офлайн-аналитики
+
+    Строки читаются пачками по Message.id серверным курсором (yield_per),
+    каждая пачка в своей короткой транзакции, поэтому память постоянна,
+    а снапшот и блокировки не держатся на все время выгрузки.
+    При include_archive после рабочей таблицы выгружается архив сообщений.
+    """
+
+    def __init__(self, batch_size: int = 5000, date_from: Optional[datetime] = None,
+                 date_to: Optional[datetime] = None, status: Optional[str] = None,
+                 department: Optional[str] = None, include_archive: bool = False):
+        self.batch_size = batch_size
+        self.include_archive = include_archive
+        self.date_from = date_from
+        self.date_to = date_to
+        self.status = status
+        self.department = department
+
+    def _base_statement(self, source):
+        content = source.content_compressed if source is MessageArchive else source.content
+        statement = select(
+            source.id.label('message_id'),
+            source.timestamp,
+            source.message_type,
+            content.label('content'),
+            source.processed_by_gpt,
+            source.response_time,
+            source.knowledge_base_used,
+            Conversation.id.label('conversation_id'),
+            Conversation.chat_id,
+            Conversation.status.label('conversation_status'),
+            Conversation.escalated_to_human,
+            Conversation.started_at,
+            Conversation.ended_at,
+            User.id.label('user_id'),
+            User.bitrix_user_id,
+            User.name.label('user_name'),
+            User.department,
+            User.position,
+        ).join(
+            Conversation, source.conversation_id == Conversation.id
+        ).join(
+            User, Conversation.user_id == User.id
+        )
+
+        if self.date_from:
+            statement = statement.where(source.timestamp >= self.date_from)
+        if self.date_to:
+            statement = statement.where(source.timestamp < self.date_to)
+        if self.status:
+            statement = statement.where(Conversation.status == self.status)
+        if self.department:
+            statement = statement.where(User.department == self.department)
+
+        return statement
+
+    def iter_rows(self) -> Iterator[Dict[str, Any]]:
+        """Генератор строк выгрузки"""
+        yield from self._iter_source(Message)
+        if self.include_archive:
+            yield from self._iter_source(MessageArchive)
+
+    def _iter_source(self, source) -> Iterator[Dict[str, Any]]:
+        base = self._base_statement(source)
+        last_id = 0
+
+        while True:
+            statement = base.where(source.id > last_id).order_by(source.id).limit(self.batch_size)
+            result = db.session.execute(statement.execution_options(yield_per=1000))
+
+            fetched = 0
+            try:
+                for row in result.mappings():
+                    fetched += 1
+                    last_id = row['message_id']
+                    yield self._serialize(row)
+            finally:
+                result.close()
+                # Завершаем транзакцию после каждой пачки
+                db.session.rollback()
+
+            if fetched < self.batch_size:
+                break
+
+    def _serialize(self, row) -> Dict[str, Any]:
+        data = {}
+        for field in TRANSCRIPT_FIELDS:
+            value = row[field]
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            elif isinstance(value, bytes):
+                value = zlib.decompress(value).decode('utf-8')
+            data[field] = value
+        return data
+
+    def export_ndjson(self) -> Iterator[str]:
+        """Выгрузка в NDJSON"""
+        for row in self.iter_rows():
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+
+    def export_csv(self, flush_every: int = 500) -> Iterator[str]:
+        """Выгрузка в CSV"""
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=TRANSCRIPT_FIELDS)
+        writer.writeheader()
+
+        for count, row in enumerate(self.iter_rows(), start=1):
+            writer.writerow(row)
+            if count % flush_every == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+
+        yield buffer.getvalue()
+
+    def export_csv_gzip(self) -> Iterator[bytes]:
+        """Выгрузка в CSV со сжатием gzip на лету"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = формат gzip
+        for chunk in self.export_csv():
+            compressed = compressor.compress(chunk.encode('utf-8'))
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    def export(self, data_format: str) -> Iterator:
+        """Выбор формата выгрузки: ndjson, csv или csv.gz"""
+        exporters = {
+            'ndjson': self.export_ndjson,
+            'csv': self.export_csv,
+            'csv.gz': self.export_csv_gzip,
+        }
+        if data_format not in exporters:
+            raise ValueError(f"Unsupported export format: {data_format}")
+        return exporters[data_format]()
+
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'csv.gz': 'application/gzip',
+}
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    """Разбор даты фильтра в формате ISO"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        logging.error(f"Invalid date filter: {value}")
+        raise
@@ -0,0 +1,80 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с временем жизни записей
+
+    Запись считается устаревшей (stale) после ttl и удаляется после
+    ttl + stale_ttl: в этом промежутке ее можно отдать и обновить в фоне.
+    Отсутствие значения кэшируется отдельно с negative_ttl.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600.0, stale_ttl: float = 3600.0,
+                 negative_ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+
+        self._data: 'OrderedDict[Hashable, Tuple[Any, float, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'stale_hits': 0, 'negative_hits': 0, 'misses': 0}
+
+    def lookup(self, key: Hashable) -> Tuple[bool, Any, bool]:
+        """Поиск: (найдено, значение, устарело)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return False, None, False
+
+            value, fresh_until, expires_at = entry
+            if now >= expires_at:
+                del self._data[key]
+                self.stats['misses'] += 1
+                return False, None, False
+
+            self._data.move_to_end(key)
+            stale = now >= fresh_until
+            if value is None:
+                self.stats['negative_hits'] += 1
+            elif stale:
+                self.stats['stale_hits'] += 1
+            else:
+                self.stats['hits'] += 1
+            return True, value, stale
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        found, value, _ = self.lookup(key)
+        return value if found else default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Сохранение значения; None кэшируется как отрицательный результат"""
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        now = time.monotonic()
+        stale_ttl = 0.0 if value is None else self.stale_ttl
+        with self._lock:
+            self._data[key] = (value, now + ttl, now + ttl + stale_ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, **self.stats}
@@ -0,0 +1,170 @@
+import os
+import re
+import time
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import select, func
+from app import db
+from models import Conversation, Message, KnowledgeBaseArticle, User
+from db_routing import replica_reads
+from startup import startup_report
+
+
+PUNCTUATION = re.compile(r'[^\w\s]+')
+
+
+def normalize_question(text: str) -> str:
+    """Вопрос для подсчета частоты: нижний регистр, ё→е, без пунктуации и лишних пробелов"""
+    return ' '.join(PUNCTUATION.sub(' ', text.lower().replace('ё', 'е')).split())
+
+
+class CacheWarmer:
+    """Прогрев кэшей процесса по истории обращений до приема трафика
+
+    Из сообщений за WARMUP_HISTORY_DAYS выбираются самые частые вопросы,
+    к ним добавляются заголовки самых используемых статей; для них заранее
+    заполняется кэш готовых ответов. Затем в кэш профилей загружаются
+    недавно писавшие пользователи. Все этапы укладываются в
+    WARMUP_BUDGET_SECONDS: по истечении бюджета прогрев прекращается,
+    и процесс сообщает о готовности с тем, что успел загрузить.
+    """
+
+    def __init__(self):
+        self.enabled = os.environ.get('WARMUP_ENABLED', 'true').lower() == 'true'
+        self.budget = float(os.environ.get('WARMUP_BUDGET_SECONDS', '20'))
+        self.history_days = int(os.environ.get('WARMUP_HISTORY_DAYS', '14'))
+        self.scan_limit = int(os.environ.get('WARMUP_SCAN_LIMIT', '20000'))
+        self.min_count = int(os.environ.get('WARMUP_MIN_COUNT', '2'))
+        self.top_questions = int(os.environ.get('WARMUP_TOP_QUESTIONS', '200'))
+        self.top_articles = int(os.environ.get('WARMUP_TOP_ARTICLES', '50'))
+        self.top_users = int(os.environ.get('WARMUP_TOP_USERS', '500'))
+
+        self.state = 'pending'  # pending, running, done, disabled, failed
+        self.report: Dict[str, Any] = {}
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ('done', 'disabled', 'failed')
+
+    # ==== Выборка из истории ====
+
+    def frequent_questions(self, since: datetime) -> List[Tuple[Optional[int], str, int]]:
+        """Частые вопросы пользователей: (портал, пример текста, число повторов)"""
+        rows = db.session.execute(
+            select(Message.content, Conversation.portal_id).join(
+                Conversation, Message.conversation_id == Conversation.id
+            ).where(
+                Message.message_type == 'user',
+                Message.timestamp >= since
+            ).order_by(Message.id.desc()).limit(self.scan_limit)
+        ).all()
+
+        counts: Counter = Counter()
+        samples: Dict[Tuple, str] = {}
+        for content, portal_id in rows:
+            key = (portal_id, normalize_question(content or ''))
+            if not key[1]:
+                continue
+            counts[key] += 1
+            # Пример — самая свежая формулировка вопроса
+            samples.setdefault(key, content)
+
+        return [
+            (portal_id, samples[(portal_id, question)], count)
+            for (portal_id, question), count in counts.most_common(self.top_questions)
+            if count >= self.min_count
+        ]
+
+    def popular_articles(self) -> List[Tuple[Optional[int], str]]:
+        """Заголовки самых используемых статей: ответ на вопрос-заголовок — точное совпадение"""
+        return db.session.execute(
+            select(KnowledgeBaseArticle.portal_id, KnowledgeBaseArticle.title).where(
+                KnowledgeBaseArticle.is_active == True  # noqa: E712
+            ).order_by(KnowledgeBaseArticle.usage_count.desc()).limit(self.top_articles)
+        ).all()
+
+    def recent_users(self, since: datetime) -> Dict[Optional[int], List[str]]:
+        """Недавно писавшие пользователи по порталам, самые активные первыми"""
+        rows = db.session.execute(
+            select(User.portal_id, User.bitrix_user_id).join(
+                Conversation, Conversation.user_id == User.id
+            ).where(
+                Conversation.started_at >= since
+            ).group_by(User.id, User.portal_id, User.bitrix_user_id).order_by(
+                func.max(Conversation.started_at).desc()
+            ).limit(self.top_users)
+        ).all()
+
+        users = defaultdict(list)
+        for portal_id, bitrix_user_id in rows:
+            users[portal_id].append(bitrix_user_id)
+        return users
+
+    # ==== Прогрев ====
+
+    def run(self) -> Dict[str, Any]:
+        """Прогрев в контексте приложения; возвращает отчет"""
+        if not self.enabled:
+            self.state = 'disabled'
+            return {'state': self.state}
+
+        import routes
+        from message_classifier import message_classifier
+        from portals import portal_registry
+
+        self.state = 'running'
+        started = time.monotonic()
+        deadline = started + self.budget
+        since = datetime.utcnow() - timedelta(days=self.history_days)
+        report = {'questions': 0, 'answers_cached': 0, 'articles': 0, 'users': 0, 'budget_exhausted': False}
+
+        try:
+            with startup_report.phase('warmup'):
+                message_classifier.reload()
+
+                with replica_reads():
+                    questions = [(portal_id, text) for portal_id, text, _ in self.frequent_questions(since)]
+                    articles = list(self.popular_articles())
+                    users = self.recent_users(since)
+
+                for kind, items in (('questions', questions), ('articles', articles)):
+                    for portal_id, text in items:
+                        if time.monotonic() >= deadline:
+                            report['budget_exhausted'] = True
+                            break
+                        report['answers_cached'] += int(routes.warm_prepared_response(text, portal_id))
+                        report[kind] += 1
+
+                for portal_id, user_ids in users.items():
+                    portal = portal_registry.get(portal_id)
+                    if portal is None:
+                        continue
+                    if time.monotonic() >= deadline:
+                        report['budget_exhausted'] = True
+                        break
+                    report['users'] += portal.enricher.prefetch_users(user_ids, deadline)
+
+                if time.monotonic() >= deadline:
+                    report['budget_exhausted'] = True
+            self.state = 'done'
+        except Exception as e:
+            # Сбой прогрева не должен оставлять процесс неготовым: кэши заполнятся трафиком
+            logging.error(f"Cache warm-up failed: {str(e)}")
+            db.session.rollback()
+            self.state = 'failed'
+            report['error'] = str(e)
+
+        report['seconds'] = round(time.monotonic() - started, 2)
+        report['state'] = self.state
+        self.report = report
+        logging.info(f"Cache warm-up finished: {report}")
+        return report
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'state': self.state, 'budget_seconds': self.budget, **self.report}
+
+
+cache_warmer = CacheWarmer()
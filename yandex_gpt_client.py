@@ -2,29 +2,45 @@ import os
 import requests
 import json
 import logging
-from typing import List, Dict, Optional
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+from circuit_breaker import resilience
+from single_flight import llm_single_flight, prompt_key
+from completion_planner import CompletionPlanner
+from message_classifier import message_classifier
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонен: предохранитель модели открыт"""
+
+
+UNAVAILABLE_RESPONSE = "Извините, сервис временно перегружен. Попробуйте повторить запрос через несколько секунд."
 
 
 class YandexGPTClient:
     """Клиент для работы с YandexGPT API"""
     
-    def __init__(self):
+    def __init__(self, planner: Optional[CompletionPlanner] = None):
         self.api_key = os.environ.get('YANDEX_GPT_API_KEY', '')
         self.folder_id = os.environ.get('YANDEX_FOLDER_ID', 'ajetj6onsl7b25g8n0ji')
         self.model_uri = f"gpt://{self.folder_id}/yandexgpt-lite"
-        self.base_url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+        self.base_url = os.environ.get(
+            'YANDEX_GPT_URL', "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+        )
+        self.planner = planner or CompletionPlanner()
         
         if not self.api_key:
             logging.warning("YandexGPT API key not found in environment variables")
     
-    def generate_response(self, user_message: str, context: Optional[List[Dict]] = None) -> str:
-        """Генерация ответа с помощью YandexGPT"""
-        try:
-            if not self.api_key:
-                return "Извините, сервис временно недоступен. Обратитесь к HR-специалисту."
-            
-            # Системный промпт для HR-бота
-            system_prompt = """Вы - корпоративный HR-помощник для сотрудников компании. 
+    def _build_completion_request(self, user_message: str, context: Optional[List[Dict]] = None,
+                                  plan: Optional[Dict[str, Any]] = None) -> Tuple[Dict, Dict]:
+        """Формирование заголовков и тела запроса на генерацию ответа"""
+        if plan is None:
+            plan = self.planner.plan(user_message, context)
+        
+        # Системный промпт для HR-бота
+        system_prompt = """Вы - корпоративный HR-помощник для сотрудников компании. 
             
 Ваша роль:
 - Отвечайте на вопросы о HR-процедурах, отпусках, больничных, льготах
@@ -42,75 +58,199 @@ class YandexGPTClient:
 
 Если спрашивают о чем-то, что не относится к HR или работе компании, вежливо перенаправьте разговор на рабочие темы."""
 
-            # Формируем сообщения для API
-            messages = [
-                {
-                    "role": "system",
-                    "text": system_prompt
-                }
-            ]
-            
-            # Добавляем контекст предыдущих сообщений
-            if context:
-                for msg in context[-5:]:  # Берем только последние 5 сообщений
-                    if msg.get('role') == 'user':
-                        messages.append({
-                            "role": "user",
-                            "text": msg['content']
-                        })
-                    elif msg.get('role') == 'assistant':
-                        messages.append({
-                            "role": "assistant",
-                            "text": msg['content']
-                        })
-            
-            # Добавляем текущее сообщение пользователя
-            messages.append({
-                "role": "user",
-                "text": user_message
-            })
-            
-            # Подготавливаем запрос
-            headers = {
-                "Authorization": f"Api-Key {self.api_key}",
-                "Content-Type": "application/json"
+        # Формируем сообщения для API
+        messages = [
+            {
+                "role": "system",
+                "text": system_prompt
             }
+        ]
+        
+        # Добавляем контекст предыдущих сообщений
+        if context:
+            for msg in context[-5:]:  # Берем только последние 5 сообщений
+                if msg.get('role') == 'user':
+                    messages.append({
+                        "role": "user",
+                        "text": msg['content']
+                    })
+                elif msg.get('role') == 'assistant':
+                    messages.append({
+                        "role": "assistant",
+                        "text": msg['content']
+                    })
+        
+        # Добавляем текущее сообщение пользователя
+        messages.append({
+            "role": "user",
+            "text": user_message
+        })
+        
+        # Подготавливаем запрос
+        headers = {
+            "Authorization": f"Api-Key {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        
+        data = {
+            "modelUri": f"gpt://{self.folder_id}/{plan['model']}",
+            "completionOptions": {
+                "stream": False,
+                "temperature": plan['temperature'],
+                "maxTokens": plan['max_tokens']
+            },
+            "messages": messages
+        }
+        
+        return headers, data
+    
+    def is_available(self, user_message: Optional[str] = None, context: Optional[List[Dict]] = None) -> bool:
+        """Доступна ли модель (окно open предохранителя не истекло)
+
+        Для сообщения проверяется модель из его плана: у каждой модели
+        свой предохранитель.
+        """
+        model_uri = self.model_uri
+        if user_message is not None:
+            model_uri = f"gpt://{self.folder_id}/{self.planner.plan(user_message, context)['model']}"
+        return bool(self.api_key) and not resilience.breaker(model_uri).is_open()
+    
+    def _is_failure_status(self, status_code: int) -> bool:
+        """Ошибки, говорящие о деградации сервиса, а не о некорректном запросе"""
+        return status_code >= 500 or status_code == 429
+    
+    def _post(self, operation: str, max_timeout: float, headers: Dict, data: Dict) -> Dict:
+        """Синхронный вызов API через предохранитель с адаптивным таймаутом"""
+        model_uri = data['modelUri']
+        breaker = resilience.breaker(model_uri)
+        latency = resilience.latency(model_uri, operation, max_timeout)
+        allowed, probe = breaker.allow_probe()
+        if not allowed:
+            raise CircuitOpenError(model_uri)
+        
+        # Пробный вызов получает верхнюю границу: адаптивный таймаут мог стать слишком коротким
+        timeout = max_timeout if probe else latency.timeout()
+        started = time.monotonic()
+        try:
+            try:
+                response = requests.post(self.base_url, headers=headers, json=data, timeout=timeout)
+            except requests.exceptions.RequestException as e:
+                if isinstance(e, requests.exceptions.Timeout):
+                    # Таймаут — тоже замер: иначе при замедлении модели таймаут никогда не вырастет
+                    latency.record(timeout)
+                breaker.record_failure()
+                raise
             
-            data = {
-                "modelUri": self.model_uri,
-                "completionOptions": {
-                    "stream": False,
-                    "temperature": 0.3,
-                    "maxTokens": 2000
-                },
-                "messages": messages
-            }
+            if self._is_failure_status(response.status_code):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+                latency.record(time.monotonic() - started)
+        finally:
+            if probe:
+                breaker.abandon_probe()
+        
+        response.raise_for_status()
+        return response.json()
+    
+    async def _apost(self, operation: str, max_timeout: float, headers: Dict, data: Dict, http_client) -> Dict:
+        """Асинхронный вызов API через предохранитель с адаптивным таймаутом"""
+        import httpx
+        
+        model_uri = data['modelUri']
+        breaker = resilience.breaker(model_uri)
+        latency = resilience.latency(model_uri, operation, max_timeout)
+        allowed, probe = breaker.allow_probe()
+        if not allowed:
+            raise CircuitOpenError(model_uri)
+        
+        timeout = max_timeout if probe else latency.timeout()
+        started = time.monotonic()
+        try:
+            try:
+                response = await http_client.post(self.base_url, headers=headers, json=data, timeout=timeout)
+            except httpx.HTTPError as e:
+                if isinstance(e, httpx.TimeoutException):
+                    latency.record(timeout)
+                breaker.record_failure()
+                raise
             
-            # Отправляем запрос
-            response = requests.post(
-                self.base_url,
-                headers=headers,
-                json=data,
-                timeout=30
-            )
+            if self._is_failure_status(response.status_code):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+                latency.record(time.monotonic() - started)
+        finally:
+            # Отмена корутины не должна оставлять пробу «в полете»
+            if probe:
+                breaker.abandon_probe()
+        
+        response.raise_for_status()
+        return response.json()
+    
+    def _complete(self, plan: Dict[str, Any], headers: Dict, data: Dict) -> Dict:
+        """Запрос генерации с учетом расхода токенов по классу вопроса"""
+        started = time.monotonic()
+        result = self._post(f"completion:{plan['question_class']}", 30, headers, data)
+        self.planner.record(plan, result, time.monotonic() - started)
+        return result
+    
+    async def _acomplete(self, plan: Dict[str, Any], headers: Dict, data: Dict, http_client) -> Dict:
+        started = time.monotonic()
+        result = await self._apost(f"completion:{plan['question_class']}", 30, headers, data, http_client)
+        self.planner.record(plan, result, time.monotonic() - started)
+        return result
+    
+    @staticmethod
+    def _has_history(user_message: str, context: Optional[List[Dict]]) -> bool:
+        """Есть ли в контексте что-то кроме самого вопроса (контекст из БД уже включает его)"""
+        return any(
+            msg.get('role') != 'user' or msg.get('content') != user_message
+            for msg in context or ()
+        )
+    
+    def _extract_text(self, result: Dict) -> Optional[str]:
+        """Извлечение текста ответа из результата API"""
+        if 'result' in result and 'alternatives' in result['result']:
+            alternatives = result['result']['alternatives']
+            if alternatives and 'message' in alternatives[0]:
+                return alternatives[0]['message']['text']
+        return None
+    
+    def generate_response(self, user_message: str, context: Optional[List[Dict]] = None) -> str:
+        """Генерация ответа с помощью YandexGPT"""
+        try:
+            if not self.api_key:
+                return "Извините, сервис временно недоступен. Обратитесь к HR-специалисту."
             
-            response.raise_for_status()
-            result = response.json()
+            plan = self.planner.plan(user_message, context)
+            headers, data = self._build_completion_request(user_message, context, plan)
+            
+            # Одинаковые одновременные вопросы без истории разговора объединяются в один
+            if self._has_history(user_message, context):
+                result = llm_single_flight.bypass(lambda: self._complete(plan, headers, data))
+            else:
+                result = llm_single_flight.do(
+                    prompt_key(data),
+                    lambda: self._complete(plan, headers, data)
+                )
             
             # Извлекаем ответ
-            if 'result' in result and 'alternatives' in result['result']:
-                alternatives = result['result']['alternatives']
-                if alternatives and 'message' in alternatives[0]:
-                    bot_response = alternatives[0]['message']['text']
-                    logging.info(f"YandexGPT response generated successfully")
-                    return bot_response
+            bot_response = self._extract_text(result)
+            if bot_response is not None:
+                logging.info("YandexGPT response generated successfully")
+                return bot_response
             
             logging.error(f"Unexpected response format: {result}")
             return "Извините, произошла ошибка при генерации ответа. Попробуйте переформулировать вопрос."
             
+        except CircuitOpenError:
+            logging.warning("YandexGPT circuit is open, request rejected")
+            return UNAVAILABLE_RESPONSE
+            
         except requests.exceptions.Timeout:
             logging.error("YandexGPT request timeout")
-            return "Извините, сервис временно перегружен. Попробуйте повторить запрос через несколько секунд."
+            return UNAVAILABLE_RESPONSE
             
         except requests.exceptions.RequestException as e:
             logging.error(f"YandexGPT API error: {str(e)}")
@@ -120,36 +260,70 @@ class YandexGPTClient:
             logging.error(f"Unexpected error in YandexGPT client: {str(e)}")
             return "Извините, произошла техническая ошибка. Обратитесь к HR-специалисту."
     
+    async def agenerate_response(self, user_message: str, context: Optional[List[Dict]] = None,
+                                 http_client=None) -> str:
+        """Асинхронная генерация ответа через общий httpx.AsyncClient"""
+        import httpx
+        
+        try:
+            if not self.api_key:
+                return "Извините, сервис временно недоступен. Обратитесь к HR-специалисту."
+            
+            plan = self.planner.plan(user_message, context)
+            headers, data = self._build_completion_request(user_message, context, plan)
+            
+            if http_client is None:
+                from http_pool import get_async_client
+                http_client = get_async_client()
+            
+            if self._has_history(user_message, context):
+                result = await llm_single_flight.abypass(lambda: self._acomplete(plan, headers, data, http_client))
+            else:
+                result = await llm_single_flight.ado(
+                    prompt_key(data),
+                    lambda: self._acomplete(plan, headers, data, http_client)
+                )
+            
+            bot_response = self._extract_text(result)
+            if bot_response is not None:
+                logging.info("YandexGPT response generated successfully")
+                return bot_response
+            
+            logging.error(f"Unexpected response format: {result}")
+            return "Извините, произошла ошибка при генерации ответа. Попробуйте переформулировать вопрос."
+            
+        except CircuitOpenError:
+            logging.warning("YandexGPT circuit is open, request rejected")
+            return UNAVAILABLE_RESPONSE
+            
+        except httpx.TimeoutException:
+            logging.error("YandexGPT request timeout")
+            return UNAVAILABLE_RESPONSE
+            
+        except httpx.HTTPError as e:
+            logging.error(f"YandexGPT API error: {str(e)}")
+            return "Извините, произошла ошибка связи с сервисом. Обратитесь к HR-специалисту."
+            
+        except Exception as e:
+            logging.error(f"Unexpected error in YandexGPT client: {str(e)}")
+            return "Извините, произошла техническая ошибка. Обратитесь к HR-специалисту."
+    
     def check_content_safety(self, text: str) -> bool:
         """Проверка контента на безопасность (если доступно в API)"""
         try:
             # Базовая проверка на запрещенные слова
-            forbidden_words = [
-                'пароль', 'password', 'логин', 'login',
-                'конфиденциально', 'секретно', 'зарплата других'
-            ]
-            
-            text_lower = text.lower()
-            for word in forbidden_words:
-                if word in text_lower:
-                    return False
-            
-            return True
+            return not message_classifier.classify(text)['unsafe']
             
         except Exception as e:
             logging.error(f"Error checking content safety: {str(e)}")
             return True  # По умолчанию разрешаем, если проверка не работает
     
-    def generate_summary(self, conversation_messages: List[str]) -> str:
-        """Генерация краткого резюме разговора"""
-        try:
-            if not self.api_key or not conversation_messages:
-                return ""
-            
-            # Объединяем сообщения
-            conversation_text = "\n".join(conversation_messages[-10:])  # Последние 10 сообщений
-            
-            summary_prompt = f"""Создайте краткое резюме следующего разговора с HR-ботом:
+    def request_summary(self, conversation_messages: List[str]) -> Dict:
+        """Запрос резюме разговора; возвращает ответ API вместе с расходом токенов"""
+        # Объединяем сообщения
+        conversation_text = "\n".join(conversation_messages[-10:])  # Последние 10 сообщений
+        
+        summary_prompt = f"""Создайте краткое резюме следующего разговора с HR-ботом:
 
 {conversation_text}
 
@@ -160,44 +334,37 @@ class YandexGPTClient:
 
 Максимум 3-4 предложения."""
 
-            messages = [
-                {
-                    "role": "user",
-                    "text": summary_prompt
-                }
-            ]
-            
-            headers = {
-                "Authorization": f"Api-Key {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            data = {
-                "modelUri": self.model_uri,
-                "completionOptions": {
-                    "stream": False,
-                    "temperature": 0.1,
-                    "maxTokens": 500
-                },
-                "messages": messages
+        messages = [
+            {
+                "role": "user",
+                "text": summary_prompt
             }
+        ]
+        
+        headers = {
+            "Authorization": f"Api-Key {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        
+        data = {
+            "modelUri": self.model_uri,
+            "completionOptions": {
+                "stream": False,
+                "temperature": 0.1,
+                "maxTokens": 500
+            },
+            "messages": messages
+        }
+        
+        return self._post('summary', 20, headers, data)
+    
+    def generate_summary(self, conversation_messages: List[str]) -> str:
+        """Генерация краткого резюме разговора"""
+        try:
+            if not self.api_key or not conversation_messages:
+                return ""
             
-            response = requests.post(
-                self.base_url,
-                headers=headers,
-                json=data,
-                timeout=20
-            )
-            
-            response.raise_for_status()
-            result = response.json()
-            
-            if 'result' in result and 'alternatives' in result['result']:
-                alternatives = result['result']['alternatives']
-                if alternatives and 'message' in alternatives[0]:
-                    return alternatives[0]['message']['text']
-            
-            return ""
+            return self._extract_text(self.request_summary(conversation_messages)) or ""
             
         except Exception as e:
             logging.error(f"Error generating summary: {str(e)}")
@@ -207,20 +374,7 @@ class YandexGPTClient:
         """Анализ тональности сообщения"""
         try:
             # Простой анализ на основе ключевых слов
-            positive_words = ['спасибо', 'хорошо', 'отлично', 'понятно', 'помогли']
-            negative_words = ['плохо', 'не понятно', 'ошибка', 'проблема', 'не работает']
-            
-            text_lower = text.lower()
-            
-            positive_count = sum(1 for word in positive_words if word in text_lower)
-            negative_count = sum(1 for word in negative_words if word in text_lower)
-            
-            if positive_count > negative_count:
-                return "positive"
-            elif negative_count > positive_count:
-                return "negative"
-            else:
-                return "neutral"
+            return message_classifier.classify(text)['sentiment']
                 
         except Exception as e:
             logging.error(f"Error analyzing sentiment: {str(e)}")